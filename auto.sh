@@ -1,17 +1,21 @@
 #!/bin/bash
 
-# wait to make sure usb stick is automounted
-sleep 10
+# USB stick mount point, and the longest to wait for it to be automounted
+USB_MOUNT=/media/usb
+MOUNT_WAIT=30
 
 # make the directory of this script the current working directory
 cd "$(dirname "${BASH_SOURCE[0]}")"
 
-# display the ip address on led pixel strip, twice
-./blinkt_display_ip_address.py
-sleep 2
-./blinkt_display_ip_address.py
+# start as soon as the usb stick is mounted rather than after a fixed delay; if it never
+# appears continuous_read.py spools readings in RAM until it does
+for i in $(seq $((MOUNT_WAIT * 2))); do
+    mountpoint -q "$USB_MOUNT" && break
+    sleep 0.5
+done
 
-# now start the kwh meter logging 
+# now start the kwh meter logging; it shows the ip address on the led pixel strip
+# in the background while it logs
 ./continuous_read.py
 
 # if an error occurred causing the script to exit, attempt a restart
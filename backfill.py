@@ -0,0 +1,127 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Fills gaps in the CC128 log from the base station's history messages.
+# While the logger is down (USB stick swap, restart loop, power cut) the base station keeps
+# its own 2 hourly and daily energy totals per sensor, and sends them in <hist> messages
+# (see current_cost.history_intervals). A period is backfilled only if nothing was logged
+# in any hour of it, so a partly logged period is never counted twice. Logged hours are
+# taken from the tail of rollup-hourly.csv when the logger starts (the raw logs are not
+# read) and from each reading logged since. Periods older than the first rollup row read
+# (the first the logger ever wrote, when the file fits in the tail), or than the first
+# start when there are no rollups yet, are left alone. Backfilled periods are written as
+# rows of rollup-backfill.csv beside the rollups, with the mean power over the period and
+# a Backfilled column naming the history period type. Backfilled hours are remembered
+# (from the tail of that file across restarts), so each period is written once and a day
+# is not written over 2 hour periods already backfilled. Nothing already logged is
+# rewritten.
+
+import csv
+import os
+import sys
+import threading
+import time
+from binary_log import parse_time
+from log_writer import LogWriter
+
+
+HOURLY_ROLLUP = 'rollup-hourly.csv'
+BACKFILL_FILE = 'rollup-backfill.csv'
+BACKFILL_HEADERS = '"Start","End","Sensor","Energy delta","Power mean","Backfilled"'
+TAIL_BYTES = 256 * 1024       # bytes read from the end of a rollup file, more than a month of hourly rows
+SENSORS = range(1, 10)        # sensors logged as "Watts #1" to "Watts #9"
+PERIOD_NAMES = { 'h': '2 hourly', 'd': 'daily' }
+TIME_FORMAT = '%Y/%m/%d %H:%M:%S'
+
+
+def tail_rows(path, size=TAIL_BYTES):
+    """The CSV rows in the last size bytes of a file, and whether that was the whole file"""
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            length = f.tell()
+            f.seek(max(length - size, 0))
+            data = f.read()
+    except OSError:
+        return [], True
+    # the first line is either the header or cut off part way
+    lines = data.decode('utf-8', 'replace').splitlines()[1:]
+    return list(csv.reader(lines, skipinitialspace=True)), length <= size
+
+
+def hours(start, end):
+    return range(int(start - start % 3600), int(end), 3600)
+
+
+class HistoryBackfill:
+
+    def __init__(self, directory, writer=None):
+        self.lock = threading.Lock()
+        self.logged = set()             # start of each hour with a logged reading
+        self.horizon = None             # periods starting before this are not checked
+        self.filled = set()             # (sensor, start of hour) covered by a backfilled period
+        self.backfilled = 0
+        rows = tail_rows(os.path.join(directory, HOURLY_ROLLUP))[0]
+        last = None
+        for row in rows:
+            stamp = parse_time(row[0]) if row else None
+            if stamp is None:
+                continue
+            if self.horizon is None:
+                # history from before the first rollup row is from before the logger was
+                # installed, or is older than the rows read
+                self.horizon = stamp[0]
+            if len(row) > 2 and row[2] not in ('', '0'):
+                self.logged.add(stamp[0])
+            last = stamp[0]
+        if last is not None:
+            # the hour in progress when the logger stopped had no rollup row written, but may
+            # have been logged in part
+            self.logged.add(last + 3600)
+        elif self.horizon is None:
+            # no rollups yet: this logger has just been installed, and history from before
+            # then is not a gap in its log
+            self.horizon = time.time()
+        for row in tail_rows(os.path.join(directory, BACKFILL_FILE))[0]:
+            start, end = (parse_time(row[0]), parse_time(row[1])) if len(row) > 2 else (None, None)
+            if start is not None and end is not None:
+                self.filled.update((int(row[2]), hour) for hour in hours(start[0], end[0]))
+        if writer is None:
+            writer = LogWriter(os.path.join(directory, BACKFILL_FILE), BACKFILL_HEADERS + '\n', flush_records=1)
+        self.writer = writer
+
+    def add_csv(self, text):
+        """Note the hours of logged readings, from CSV lines starting with the time"""
+        for values in csv.reader(text.splitlines(), skipinitialspace=True):
+            stamp = parse_time(values[0]) if values else None
+            if stamp is not None:
+                with self.lock:
+                    self.logged.add(stamp[0] - stamp[0] % 3600)
+
+    def missing(self, sensor, start, end):
+        if sensor not in SENSORS or end > time.time():
+            return False
+        if self.horizon is not None and start < self.horizon:
+            return False
+        return not any(hour in self.logged or (sensor, hour) in self.filled for hour in hours(start, end))
+
+    def add_history(self, intervals):
+        """Write each interval (from current_cost.history_intervals) nothing was logged in"""
+        rows = []
+        with self.lock:
+            # shortest periods first, so a day is only used where no 2 hour period filled it
+            for sensor, start, end, energy, period in sorted(intervals, key=lambda interval: interval[2] - interval[1]):
+                if not self.missing(sensor, start, end):
+                    continue
+                self.filled.update((sensor, hour) for hour in hours(start, end))
+                rows.append(f'"{time.strftime(TIME_FORMAT, time.gmtime(start))}",'
+                            f'"{time.strftime(TIME_FORMAT, time.gmtime(end))}",{sensor},{energy},'
+                            f'{energy * 1000 * 3600 / (end - start)},"{PERIOD_NAMES.get(period, period)}"\n')
+        for row in rows:
+            self.writer.write(row)
+        self.backfilled = self.backfilled + len(rows)
+        if rows:
+            sys.stderr.write(f'Backfilled {len(rows)} periods from the base station history.\n')
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# Copyright 2024 Arup
+# MIT License
+
+# Compact binary log format, and a converter back to CSV.
+# A log file is a self-describing header followed by checksummed segments of fixed-width
+# packed records, so a year of readings can be loaded with mmap or numpy.memmap instead
+# of parsing text, and each reading takes a fraction of the space of a CSV line.
+# Header: the 8-byte magic b'ESBLOG1\n', a 4-byte length and a JSON description holding
+# the column names (from CSVHEADERS or the register map), column types, record size and
+# records per segment, padded to a multiple of 16 bytes.
+# Segment: a 16-byte header (b'SEG1', record count, CRC32 of those records, reserved)
+# followed by room for segment_records records, written as zeros when the segment is
+# started so every segment has the same stride. Records past the count are ignored.
+# Column types come from the driver's schema (meter_drivers.py, from the register map where
+# there is one), so every value converts back to the CSV text it was written as: 'time'
+# and 'isotime' timestamps are stored as float64 seconds since epoch ('isotimez' for ISO
+# times written with a 'Z' suffix), 'f4' for float32 register values, 'f8' for integers
+# (exact to 2**53) and energy, and 'textN' for N bytes of UTF-8 text ('text' is 16 bytes).
+# Without a schema, eg for an acquisition program's output, types are guessed from the
+# first record: text as 16 bytes, columns with 'energy' in the name as float64 and other
+# numbers as float32. Numbers that can't be parsed are stored as NaN and exported as empty
+# fields.
+# BinaryLog also reads logs compressed by log rotation (.bin.gz, .bin.xz), decompressed
+# into memory instead of mapped.
+# Usage: ./binary_log.py 20240101-00.00.00.bin > 20240101-00.00.00.csv
+#        ./binary_log.py --check 20240101-00.00.00.bin
+
+import argparse
+import calendar
+import csv
+import datetime
+import gzip
+import io
+import json
+import math
+import mmap
+import lzma
+import os
+import struct
+import sys
+import time
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+MAGIC = b'ESBLOG1\n'
+SEGMENT_MAGIC = b'SEG1'
+SEGMENT_RECORDS = 1024        # records per segment
+TEXT_LENGTH = 16              # bytes stored for a text column
+TIME_FORMAT = '%Y/%m/%d %H:%M:%S'
+EPOCH = datetime.datetime(1970, 1, 1)
+
+SEGMENT_HEADER = struct.Struct('<4sIII')     # magic, record count, CRC32, reserved
+# column type: (struct code, numpy dtype); 'textN' columns are N bytes
+COLUMN_TYPES = {
+    'time':     ('d', '<f8'),
+    'isotime':  ('d', '<f8'),
+    'isotimez': ('d', '<f8'),
+    'f4':       ('f', '<f4'),
+    'f8':       ('d', '<f8'),
+    'text':     (f'{TEXT_LENGTH}s', f'S{TEXT_LENGTH}'),
+}
+TIME_COLUMNS = ('time', 'isotime', 'isotimez')
+OPENERS = { '.gz': gzip.open, '.xz': lzma.open }
+
+
+def parse_time(value):
+    """Seconds since epoch and the column type, or None if value isn't a timestamp"""
+    try:
+        return calendar.timegm(time.strptime(value, TIME_FORMAT)), 'time'
+    except (TypeError, ValueError):
+        pass
+    try:
+        # the PM5100 driver writes UTC ISO times with a 'Z' suffix
+        stamp = datetime.datetime.fromisoformat(value[:-1] + '+00:00' if str(value).endswith('Z') else value)
+    except (TypeError, ValueError):
+        return None
+    if stamp.tzinfo is None:
+        stamp = stamp.replace(tzinfo=datetime.timezone.utc)
+    return stamp.timestamp(), 'isotime'
+
+
+def column_type(name, value):
+    """Column type guessed from a first value, for logs written without a schema"""
+    if parse_time(value) is not None:
+        return 'isotimez' if str(value).endswith('Z') else parse_time(value)[1]
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        if value not in ('', None):
+            return 'text'
+    return 'f8' if 'energy' in name.lower() else 'f4'
+
+
+def is_text(column):
+    return column[:4] == 'text'
+
+
+def column_codes(column):
+    """(struct code, numpy dtype) of a column type"""
+    if is_text(column) and column[4:].isdigit():
+        return f'{column[4:]}s', f'S{column[4:]}'
+    return COLUMN_TYPES[column]
+
+
+def text_length(column):
+    return int(column[4:]) if column[4:].isdigit() else TEXT_LENGTH
+
+
+def format_time(seconds, column):
+    if column in ('isotime', 'isotimez'):
+        # rounded to the microsecond the time was written with, which float64 seconds can't hold exactly
+        stamp = EPOCH + datetime.timedelta(microseconds=round(seconds * 1e6))
+        return stamp.isoformat() + ('Z' if column == 'isotimez' else '')
+    return time.strftime(TIME_FORMAT, time.gmtime(seconds))
+
+
+def format_number(value, column):
+    if value != value:
+        return ''
+    if value.is_integer():
+        return str(int(value))
+    if column == 'f4':
+        # shortest text that reads back as the same float32
+        for precision in range(6, 10):
+            text = f'{value:.{precision}g}'
+            if struct.unpack('<f', struct.pack('<f', float(text)))[0] == value:
+                return text
+    return repr(value)
+
+
+def is_binary_log(path):
+    """True for a binary log, compressed by log rotation or not"""
+    root, extension = os.path.splitext(path)
+    return (root if extension in OPENERS else path).endswith('.bin')
+
+
+def segment_stride(description):
+    return SEGMENT_HEADER.size + description['segment_records'] * description['record_size']
+
+
+def record_struct(description):
+    return struct.Struct('<' + ''.join(column_codes(column)[0] for name, column in description['columns']))
+
+
+def read_description(f):
+    """The header description of an open log file and the offset of its first segment"""
+    f.seek(0)
+    start = f.read(len(MAGIC) + 4)
+    if len(start) < len(MAGIC) + 4 or start[:len(MAGIC)] != MAGIC:
+        sys.stderr.write('Not a binary log file.\n')
+        raise ValueError()
+    length = struct.unpack('<I', start[len(MAGIC):])[0]
+    description = json.loads(f.read(length).rstrip(b' ').decode('utf-8'))
+    return description, data_offset(length)
+
+
+def data_offset(length):
+    return (len(MAGIC) + 4 + length + 15) // 16 * 16
+
+
+class BinaryLogFile:
+    """Writes CSV lines to a binary log. Has the file methods LogWriter uses, so it can take
+    the place of a text log file; an existing log is appended to."""
+
+    def __init__(self, path, csv_headers, segment_records=SEGMENT_RECORDS, column_types=None):
+        self.path = path
+        self.names = next(csv.reader([csv_headers.strip()], skipinitialspace=True))
+        self.segment_records = segment_records
+        self.column_types = column_types        # a type per column, guessed from the first record if None
+        self.description = None
+        self.segment = None             # file offset of the current segment
+        self.count = 0
+        self.crc = 0
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.file = open(path, 'r+b')
+            self.resume()
+        else:
+            self.file = open(path, 'w+b')
+
+    def resume(self):
+        self.description, self.first_segment = read_description(self.file)
+        self.record = record_struct(self.description)
+        self.stride = segment_stride(self.description)
+        size = os.path.getsize(self.path)
+        segments = (size - self.first_segment) // self.stride
+        if segments == 0:
+            self.start_segment(self.first_segment)
+            return
+        self.segment = self.first_segment + (segments - 1) * self.stride
+        self.file.seek(self.segment)
+        magic, count, crc, reserved = SEGMENT_HEADER.unpack(self.file.read(SEGMENT_HEADER.size))
+        self.count = count
+        self.crc = zlib.crc32(self.file.read(count * self.record.size))
+
+    def create(self, values):
+        if self.column_types is not None and len(self.column_types) == len(self.names):
+            columns = [[name, column] for name, column in zip(self.names, self.column_types)]
+        else:
+            columns = [[name, column_type(name, value)] for name, value in zip(self.names, values)]
+        self.description = { 'version': 1, 'columns': columns, 'segment_records': self.segment_records,
+                             'csv_headers': ','.join(f'"{name}"' for name in self.names) }
+        self.record = record_struct(self.description)
+        self.description['record_size'] = self.record.size
+        self.stride = segment_stride(self.description)
+        text = json.dumps(self.description).encode('utf-8')
+        self.first_segment = data_offset(len(text))
+        header = MAGIC + struct.pack('<I', len(text)) + text
+        self.file.write(header + b' ' * (self.first_segment - len(header)))
+        self.start_segment(self.first_segment)
+
+    def start_segment(self, offset):
+        self.segment = offset
+        self.count = 0
+        self.crc = 0
+        self.file.seek(offset)
+        self.file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, 0, 0, 0) + bytes(self.stride - SEGMENT_HEADER.size))
+
+    def pack(self, values):
+        packed = []
+        for (name, column), value in zip(self.description['columns'], values):
+            if column in TIME_COLUMNS:
+                stamp = parse_time(value)
+                packed.append(stamp[0] if stamp is not None else math.nan)
+            elif is_text(column):
+                packed.append(str(value).encode('utf-8')[:text_length(column)])
+            else:
+                try:
+                    packed.append(float(value))
+                except (TypeError, ValueError):
+                    packed.append(math.nan)
+        # a short line is padded with missing values
+        for name, column in self.description['columns'][len(packed):]:
+            packed.append(b'' if is_text(column) else math.nan)
+        return self.record.pack(*packed[:len(self.description['columns'])])
+
+    def append(self, values):
+        if self.description is None:
+            self.create(values)
+        if self.count == self.description['segment_records']:
+            self.write_segment_header()
+            self.start_segment(self.segment + self.stride)
+        packed = self.pack(values)
+        self.file.seek(self.segment + SEGMENT_HEADER.size + self.count * self.record.size)
+        self.file.write(packed)
+        self.count = self.count + 1
+        self.crc = zlib.crc32(packed, self.crc)
+
+    def write(self, text):
+        for values in csv.reader(text.splitlines(), skipinitialspace=True):
+            if values:
+                self.append(values)
+
+    def write_segment_header(self):
+        if self.segment is not None:
+            self.file.seek(self.segment)
+            self.file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, self.count, self.crc, 0))
+
+    def flush(self):
+        # the record count and checksum are only written here, so a segment is never
+        # described as holding records that aren't on the device yet
+        self.write_segment_header()
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.file.close()
+
+
+class BinaryLog:
+    """Read access to a binary log through mmap, without parsing"""
+
+    def __init__(self, path):
+        self.path = path
+        opener = OPENERS.get(os.path.splitext(path)[1])
+        if opener is not None:
+            with opener(path, 'rb') as f:
+                self.map = f.read()
+            self.description, self.first_segment = read_description(io.BytesIO(self.map))
+        else:
+            with open(path, 'rb') as f:
+                self.description, self.first_segment = read_description(f)
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.columns = self.description['columns']
+        self.names = [name for name, column in self.columns]
+        self.record = record_struct(self.description)
+        self.stride = segment_stride(self.description)
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+
+    def segments(self, verify=True):
+        """(offset of first record, record count) for each segment, skipping any that fail
+        their checksum when verify is True"""
+        offset = self.first_segment
+        while offset + self.stride <= len(self.map):
+            magic, count, crc, reserved = SEGMENT_HEADER.unpack_from(self.map, offset)
+            start = offset + SEGMENT_HEADER.size
+            if magic != SEGMENT_MAGIC or count > self.description['segment_records']:
+                sys.stderr.write(f'Bad segment header at {offset} in {self.path}.\n')
+            elif verify and zlib.crc32(self.map[start:start + count * self.record.size]) != crc:
+                sys.stderr.write(f'Checksum failed for segment at {offset} in {self.path}: skipped.\n')
+            else:
+                yield start, count
+            offset = offset + self.stride
+
+    def records(self, verify=True):
+        """Each record as a tuple of stored values"""
+        for start, count in self.segments(verify):
+            yield from self.record.iter_unpack(self.map[start:start + count * self.record.size])
+
+    def dtype(self):
+        return numpy.dtype([(name, column_codes(column)[1]) for name, column in self.columns])
+
+    def array(self, verify=True):
+        """Every record as a NumPy structured array, built from views of the mapped file"""
+        if numpy is None:
+            sys.stderr.write('NumPy is needed to load a binary log as an array.\n')
+            raise ImportError()
+        dtype = self.dtype()
+        views = [numpy.frombuffer(self.map, dtype, count, start) for start, count in self.segments(verify)]
+        if len(views) == 1:
+            return views[0]
+        return numpy.concatenate(views) if views else numpy.zeros(0, dtype)
+
+    def csv_row(self, values):
+        row = []
+        for (name, column), value in zip(self.columns, values):
+            if column in TIME_COLUMNS:
+                row.append(format_time(value, column) if value == value else '')
+            elif is_text(column):
+                row.append(value.rstrip(b'\x00').decode('utf-8', 'replace'))
+            else:
+                row.append(format_number(value, column))
+        return row
+
+    def export_csv(self, output, verify=True):
+        """Write the log as CSV in the format continuous_read.py writes, text columns quoted"""
+        output.write(self.description['csv_headers'] + '\n')
+        quoted = [column in TIME_COLUMNS or is_text(column) for name, column in self.columns]
+        for values in self.records(verify):
+            output.write(','.join(f'"{field}"' if quote else field
+                                  for field, quote in zip(self.csv_row(values), quoted)) + '\n')
+
+
+# starts here
+if __name__ == '__main__':
+    cmd_parser = argparse.ArgumentParser(description='Convert a binary meter log to CSV.')
+    cmd_parser.add_argument('path', help='binary log file')
+    cmd_parser.add_argument('--output', nargs='?', default=None, help='CSV file to write, stdout by default')
+    cmd_parser.add_argument('--check', action='store_true', help='only verify segment checksums')
+    args = cmd_parser.parse_args()
+    try:
+        log = BinaryLog(args.path)
+        if args.check:
+            total = sum(count for start, count in log.segments())
+            print(f'{args.path}: {total} records, {len(log.names)} columns')
+        elif args.output is None:
+            log.export_csv(sys.stdout)
+        else:
+            with open(args.output, 'w') as output:
+                log.export_csv(output)
+        log.close()
+
+    except (OSError, ValueError):
+        sys.stderr.write(f"Couldn't read {args.path}.\n")
+        sys.exit(1)
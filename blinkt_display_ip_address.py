@@ -14,43 +14,31 @@
 # 9                     ***..***  blue
 # dot                   *......*  white
 
-import blinkt
+# The address is drawn on the background layer of led_status.LedService, so the status
+# LEDs showing a fault stay visible; continuous_read.py runs display_address on a thread
+# at start up instead of delaying logging while it plays.
+
 import sys
 import time
 import socket
+import led_status
 
-colours = { 'red': (200,0,0), 'green': (0,200,0), 'blue': (0,0,200), 'yellow': (200,200,0),\
-        'cyan': (0,200,200), 'magenta': (200,0,200), 'white': (200,200,200), 'off': (0,0,0) }
 
+IP_WAIT = 60                  # seconds to wait for the network to give an address
 
-def display_number(number):
-    try:
-        col = colours['blue']
-        if number == 9:
-            for i in range(0, 3):
-                blinkt.set_pixel(i, col[0], col[1], col[2])
-            for i in range(5, 8):
-                blinkt.set_pixel(i, col[0], col[1], col[2])
-        elif number == 0:
-            for i in range(3, 5):
-                blinkt.set_pixel(i, col[0], col[1], col[2])
-        else:
-            for i in range(0, number):
-                blinkt.set_pixel(i, col[0], col[1], col[2])
-        blinkt.show()
-    except:
-        sys.stderr.write('Colour or pixel not recognised.\n')
-        sys.exit(1)
 
-def display_dot():
-    try:
-        col = colours['white']
-        blinkt.set_pixel(0, col[0], col[1], col[2])
-        blinkt.set_pixel(7, col[0], col[1], col[2])
-        blinkt.show()
-    except:
-        sys.stderr.write('Colour or pixel not recognised.\n')
-        sys.exit(1)
+def display_number(leds, number):
+    if number == 9:
+        pixels = [0, 1, 2, 5, 6, 7]
+    elif number == 0:
+        pixels = [3, 4]
+    else:
+        pixels = range(0, number)
+    # one frame for the whole digit
+    leds.set_background({ i: 'blue' if i in pixels else 'off' for i in range(8) })
+
+def display_dot(leds):
+    leds.set_background({ i: 'white' if i in (0, 7) else 'off' for i in range(8) })
 
 def get_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -64,24 +52,40 @@ def get_ip():
         s.close()
     return IP
 
+def wait_for_ip(timeout=IP_WAIT):
+    # at boot the network may come up after the logger has started
+    deadline = time.monotonic() + timeout
+    ip = get_ip()
+    while ip == '127.0.0.1' and time.monotonic() < deadline:
+        time.sleep(1)
+        ip = get_ip()
+    return ip
 
-if __name__ == '__main__':
-    blinkt.set_clear_on_exit(False)
-    blinkt.clear()
-    blinkt.show()
+def display_address(leds, repeats=2, timeout=IP_WAIT):
+    """Play the IP address on the background layer repeats times, then remove the layer"""
     try:
-        for char in get_ip():
-            if char == '.':
-                display_dot()
-                time.sleep(3)
-                blinkt.clear()
-                blinkt.show()
-            else: 
-                display_number(int(char))
+        ip = wait_for_ip(timeout)
+        for repeat in range(repeats):
+            if repeat > 0:
+                leds.set_background({ i: 'off' for i in range(8) })
                 time.sleep(2)
-                blinkt.clear()
-                blinkt.show()
+            for char in ip:
+                if char == '.':
+                    display_dot(leds)
+                    time.sleep(3)
+                else:
+                    display_number(leds, int(char))
+                    time.sleep(2)
+    finally:
+        leds.set_background(None)
+
+
+if __name__ == '__main__':
+    leds = led_status.LedService()
+    leds.clear()
+    try:
+        display_address(leds, repeats=1, timeout=0)
+        leds.close()
     except:
         sys.stderr.write('Character in string not recognised.\n')
         sys.exit(1)
-
@@ -5,23 +5,15 @@
 # blinkt-indicator.py 2 off                  to extinguish 3rd pixel
 
 
-import blinkt
 import sys
-
-
-colours = { 'red': (200,0,0), 'green': (0,200,0), 'blue': (0,0,200), 'yellow': (200,200,0),\
-        'cyan': (0,200,200), 'magenta': (200,0,200), 'white': (200,200,200), 'off': (0,0,0) }
+import led_status
 
 
 if __name__ == '__main__':
     try:
-        col = colours[sys.argv[2]]
-        blinkt.set_clear_on_exit(False)
-        blinkt.set_pixel(int(sys.argv[1]), col[0], col[1], col[2])
-        blinkt.show()
+        leds = led_status.LedService()
+        leds.set_pixel(int(sys.argv[1]), sys.argv[2])
+        leds.close()
     except:
         sys.stderr.write('Colour or pixel not recognised.\n')
         sys.exit(1)
-
-
-
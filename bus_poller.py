@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+# Copyright 2024 Arup
+# MIT License
+
+# Polls several modbus meters sharing one RS485 bus from a single process.
+# The serial port is opened once and shared by one instrument per meter (a
+# modbus_rtu.RtuInstrument, or a minimalmodbus Instrument with the drivers' MODBUS_ENGINE
+# set to 'minimalmodbus'), so transactions for different meters run back to back without
+# reopening the port or waiting on the /rs485 semaphore. Each meter can have its own polling period.
+# Meters on different USB-RS485 adapters are polled in parallel, one worker thread per
+# bus (the blocking work is serial I/O), and their records merged per scheduler tick.
+# Records are written per meter: one CSV file per meter with --output, otherwise one
+# NDJSON line on stdout per tick holding every meter read on that tick. Per-meter cycle
+# time (the bus time taken to read one meter) is reported on stderr with --verbose.
+# With --publish each meter's latest record is also placed in shared memory for other
+# local tools to read without bus traffic (see latest_values.py).
+# When every meter on a bus fails REOPEN_FAILURES polls in a row, eg because its USB-RS485
+# adapter was unplugged or stopped answering, the bus's serial port is closed and reopened,
+# so the bus recovers without restarting the process.
+# Usage: ./bus_poller.py --meter 1:iem2150 --meter 2:pm5100:60 --interval 10
+#        ./bus_poller.py --meter 0=1:iem2150 --meter 1=1:iem2150      (first and second adapter)
+# requires minimalmodbus library: sudo pip3 install minimalmodbus
+import argparse
+import csv
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import serial.tools.list_ports
+import schneider_iEM2150
+import schneider_PM5100
+import hiking_dds238_2
+import modbus_rtu
+from scheduler import Scheduler
+
+
+REOPEN_FAILURES = 3           # polls of a bus in a row with no meter answering before its port is reopened
+
+
+def read_iem2150(meter):
+    values = schneider_iEM2150.get_readings(meter.instrument, meter.cache)
+    return dict(zip(['timestamp'] + list(schneider_iEM2150.IEM2150_REGISTER_MAP.keys()) + ['quality'], values))
+
+
+def read_dds238(meter):
+    readings = hiking_dds238_2.get_readings(meter.instrument, meter.port, meter.cache)
+    return dict(timestamp=hiking_dds238_2.get_timestamp(), **readings)
+
+
+def read_pm5100(meter):
+    # slow and identity registers are cached per meter, see get_tiered_readings()
+    readings = schneider_PM5100.get_tiered_readings(meter.instrument, schneider_PM5100.PM5100_REGISTER_MAP,
+                                                    meter.tick, meter.cache, plans=meter.plans)
+    timestamp = readings.pop('timestamp')
+    return dict(timestamp=timestamp, **readings)
+
+
+# on Ubuntu/Raspberry Pi, serial ports are in the form '/dev/ttyUSBx' where x is an integer 0-7
+# on Windows, serial ports are in the form 'COMx' where x is an integer 1-8
+def find_serial_devices():
+    """Every serial adapter found, rather than just the first"""
+    ports = serial.tools.list_ports.comports()
+    port_names = []
+    for port in sorted(ports, key=lambda port: port.device):
+        description = port.description.lower()
+        if port.device[0:11] == '/dev/ttyUSB' or port.device[0:3] == 'COM' or \
+                'serial' in description or 'uart' in description:
+            port_names.append(port.device)
+    if len(port_names) == 0:
+        sys.stderr.write('Couldn\'t find serial device.\n')
+        raise ConnectionError('Modbus error')
+    return port_names
+
+
+# model name: (configure function taking (port, address), record reader)
+METER_MODELS = {
+    'iem2150': (schneider_iEM2150.configure, read_iem2150),
+    'dds238':  (hiking_dds238_2.configure, read_dds238),
+    'pm5100':  (lambda port, address: schneider_PM5100.configure(port, address, 9600), read_pm5100),
+}
+
+# model name: driver module, with probe(instrument), SUPPORTED_BAUDRATES and, for meters
+# that can be told a new rate, set_baud_rate(instrument, speed, address)
+METER_MODULES = {
+    'iem2150': schneider_iEM2150,
+    'dds238':  hiking_dds238_2,
+    'pm5100':  schneider_PM5100,
+}
+
+
+class BusMeter:
+
+    def __init__(self, address, model, period=None, bus=None):
+        if model not in METER_MODELS:
+            sys.stderr.write(f'No meter model called {model}.\n')
+            raise ValueError()
+        self.address = address
+        self.model = model
+        self.period = period
+        self.bus = bus                  # serial port, or index into find_serial_devices()
+        self.label = None               # bus label added to names when several buses are polled
+        self.name = f'{model}@{address}'
+        self.instrument = None
+        self.port = None
+        self.tick = 0
+        self.cache = {}
+        self.plans = {}
+        self.reads = 0
+        self.failures = 0
+        self.cycle_time = None          # seconds of bus time for the last read of this meter
+        self.total_cycle_time = 0.0
+
+    def open(self, port, baudrate):
+        configure, reader = METER_MODELS[self.model]
+        self.port = port
+        # instruments on the same port share one serial port object, RtuInstruments through their RtuBus
+        self.instrument = configure(port, self.address)
+        if not self.instrument.serial.is_open:
+            self.instrument.serial.open()
+        self.instrument.serial.baudrate = baudrate
+
+    def read(self):
+        configure, reader = METER_MODELS[self.model]
+        start = time.monotonic()
+        try:
+            record = reader(self)
+        except ConnectionError:
+            self.failures = self.failures + 1
+            raise
+        finally:
+            self.cycle_time = time.monotonic() - start
+        self.tick = self.tick + 1
+        self.reads = self.reads + 1
+        self.total_cycle_time = self.total_cycle_time + self.cycle_time
+        return record
+
+    def stats(self):
+        mean = self.total_cycle_time / self.reads if self.reads else None
+        return { 'meter': self.name, 'reads': self.reads, 'failures': self.failures,
+                 'cycle_time': self.cycle_time, 'mean_cycle_time': mean }
+
+
+class BusPoller:
+    """Interleaves the transactions of every meter on one bus, back to back on one open port"""
+
+    def __init__(self, port, meters, baudrate=9600, auto_baud=False):
+        self.port = port
+        self.meters = { meter.name:meter for meter in meters }
+        self.baudrate = baudrate
+        self.auto_baud = auto_baud
+        self.failed_polls = 0           # polls in a row in which no meter answered
+
+    def open(self):
+        for meter in self.meters.values():
+            meter.open(self.port, self.baudrate)
+        if self.auto_baud:
+            self.negotiate_baudrate()
+
+    def negotiate_baudrate(self):
+        """Find the rate the meters answer at, and if every meter can be told a new rate, move
+        the bus to the fastest rate they all support (see modbus_rtu.py)"""
+        meters = list(self.meters.values())
+        modules = [METER_MODULES[meter.model] for meter in meters]
+        probes = [lambda meter=meter, module=module: module.probe(meter.instrument) for meter, module in zip(meters, modules)]
+        serial_port = meters[0].instrument.serial
+        if all(hasattr(module, 'set_baud_rate') for module in modules):
+            rates = set.intersection(*(set(module.SUPPORTED_BAUDRATES) for module in modules))
+            switches = [lambda speed, meter=meter, module=module: module.set_baud_rate(meter.instrument, speed, meter.address)
+                        for meter, module in zip(meters, modules)]
+            self.baudrate = modbus_rtu.upgrade_baudrate(serial_port, probes, switches, rates)
+        else:
+            rates = set.union(*(set(module.SUPPORTED_BAUDRATES) for module in modules))
+            self.baudrate = modbus_rtu.find_baudrate(serial_port, probes, rates)
+        for meter in meters:
+            if isinstance(meter.instrument, modbus_rtu.RtuInstrument):
+                meter.instrument.latencies.clear()
+        sys.stderr.write(f'{self.port} at {self.baudrate} baud.\n')
+
+    def poll(self, names=None):
+        """Read the named meters (all by default) in turn, returning (meter, record) pairs.
+        A meter that fails is reported and skipped so the rest of the bus is still read."""
+        results = []
+        names = list(names if names is not None else self.meters.keys())
+        for name in names:
+            meter = self.meters[name]
+            try:
+                results.append((meter, meter.read()))
+            except ConnectionError:
+                sys.stderr.write(f'Failed to read meter {meter.name}.\n')
+        if results or not names:
+            self.failed_polls = 0
+        else:
+            self.failed_polls = self.failed_polls + 1
+            if self.failed_polls >= REOPEN_FAILURES:
+                self.reopen()
+        return results
+
+    def reopen(self):
+        """Close and reopen the bus's serial port, eg after its adapter was unplugged"""
+        sys.stderr.write(f'No meter answering on {self.port}: reopening it.\n')
+        self.failed_polls = 0
+        self.close()
+        try:
+            self.open()
+        except (ConnectionError, OSError):
+            # tried again after another REOPEN_FAILURES failed polls
+            sys.stderr.write(f"Couldn't reopen {self.port}.\n")
+
+    def close(self):
+        for meter in self.meters.values():
+            if meter.instrument is not None:
+                try:
+                    meter.instrument.serial.close()
+                except Exception:
+                    pass                # eg the adapter has gone
+                break
+
+
+class BusWorker(threading.Thread):
+    """Polls one bus on its own thread when asked, so several buses do serial I/O in parallel"""
+
+    def __init__(self, poller, results):
+        super().__init__(daemon=True)
+        self.poller = poller
+        self.requests = queue.Queue()
+        self.results = results
+
+    def run(self):
+        while True:
+            names = self.requests.get()
+            if names is None:
+                break
+            try:
+                self.results.put((self, self.poller.poll(names)))
+            except Exception as e:
+                # eg the adapter was unplugged: report it and let the other buses carry on
+                sys.stderr.write(f'Failed to poll bus {self.poller.port}: {e}\n')
+                self.results.put((self, []))
+
+
+class MultiBusPoller:
+    """One BusPoller and worker thread per serial port, driven by one scheduler so every
+    bus is polled on the same ticks and the results merge into one stream"""
+
+    def __init__(self, pollers, interval):
+        self.pollers = pollers
+        self.results = queue.Queue()
+        self.workers = [BusWorker(poller, self.results) for poller in pollers]
+        self.scheduler = Scheduler()
+        self.meters = {}
+        for worker in self.workers:
+            for name, meter in worker.poller.meters.items():
+                if len(pollers) > 1:
+                    meter.label = os.path.basename(worker.poller.port)
+                    meter.name = f'{meter.label}/{name}'
+                self.meters[meter.name] = (worker, name)
+                self.scheduler.add(meter.name, meter.period or interval)
+
+    def open(self):
+        for worker in self.workers:
+            worker.poller.open()
+            worker.start()
+
+    def poll(self, names=None):
+        """Read the named meters (all by default), each bus in parallel, and return
+        (meter, record) pairs once every bus involved has finished"""
+        requests = {}
+        for name in names if names is not None else self.meters.keys():
+            worker, bus_name = self.meters[name]
+            requests.setdefault(worker, []).append(bus_name)
+        for worker, bus_names in requests.items():
+            worker.requests.put(bus_names)
+        results = []
+        for i in range(len(requests)):
+            worker, bus_results = self.results.get()
+            results.extend(bus_results)
+        return results
+
+    def wait(self):
+        return self.scheduler.wait()
+
+    def close(self):
+        for worker in self.workers:
+            worker.requests.put(None)
+            worker.join()
+            worker.poller.close()
+
+
+def bus_pollers(meters, baudrate, port=None, auto_baud=False):
+    """Group meters into one BusPoller per serial port. A meter's bus may be a device
+    name or an index into find_serial_devices(); meters without one use port, or the
+    first adapter found."""
+    groups = {}
+    devices = None
+    for meter in meters:
+        bus = meter.bus if meter.bus is not None else port
+        if bus is None or bus.isdigit():
+            if devices is None:
+                devices = find_serial_devices()
+            try:
+                bus = devices[int(bus or 0)]
+            except IndexError:
+                sys.stderr.write(f'No serial adapter number {bus}.\n')
+                raise ConnectionError('Modbus error')
+        groups.setdefault(bus, []).append(meter)
+    return [BusPoller(bus, group, baudrate, auto_baud) for bus, group in groups.items()]
+
+
+class RecordWriter:
+    """One record stream per meter in CSV files in a directory, or one merged NDJSON line
+    per tick on stdout"""
+
+    def __init__(self, output_dir=None):
+        self.output_dir = output_dir
+        self.files = {}
+
+    def write_tick(self, tick_time, results):
+        if self.output_dir is None:
+            meters = { meter.name:record for meter, record in results }
+            print(json.dumps({ 'timestamp': time.strftime('%Y/%m/%d %H:%M:%S', time.gmtime(tick_time)),
+                               'meters': meters }), flush=True)
+            return
+        for meter, record in results:
+            self.write(meter, record)
+
+    def write(self, meter, record):
+        if meter.name not in self.files:
+            prefix = f'{meter.label}-' if meter.label else ''
+            path = os.path.join(self.output_dir, f'{prefix}{meter.model}-{meter.address}.csv')
+            new_file = not os.path.exists(path)
+            f = open(path, 'a', newline='')
+            self.files[meter.name] = (f, csv.writer(f))
+            if new_file:
+                self.files[meter.name][1].writerow(record.keys())
+        f, writer = self.files[meter.name]
+        writer.writerow(record.values())
+        f.flush()
+
+    def close(self):
+        for f, writer in self.files.values():
+            f.close()
+
+
+def parse_meter(spec):
+    # [bus=]address:model[:period]
+    try:
+        bus, _, spec = spec.rpartition('=')
+        fields = spec.split(':')
+        period = float(fields[2]) if len(fields) > 2 else None
+        return BusMeter(int(fields[0]), fields[1], period, bus or None)
+    except (IndexError, ValueError):
+        raise argparse.ArgumentTypeError(f'expected [bus=]address:model[:period], got {spec}')
+
+
+# starts here
+if __name__ == '__main__':
+    cmd_parser = argparse.ArgumentParser(description='Poll several modbus meters on one RS485 bus.')
+    cmd_parser.add_argument('--meter', type=parse_meter, action='append', required=True,
+                            help='meter as [bus=]address:model[:period], bus a serial port or adapter number, '
+                                 'model one of ' + ', '.join(METER_MODELS.keys()))
+    cmd_parser.add_argument('--port', nargs='?', default=None, help='serial port for meters without a bus, first adapter found by default')
+    cmd_parser.add_argument('--baudrate', nargs='?', type=int, default=9600, help='RS485 communication baud rate')
+    cmd_parser.add_argument('--auto_baud', action='store_true', help='detect the baud rate of each bus, raising it where the meters can be switched')
+    cmd_parser.add_argument('--interval', type=float, nargs='?', default=10.0, help='default seconds between readings of each meter')
+    cmd_parser.add_argument('--quantity', type=int, nargs='?', default=0, help='number of polling cycles, 0 to run until stopped')
+    cmd_parser.add_argument('--output', nargs='?', default=None, help='directory for per-meter CSV files, NDJSON on stdout by default')
+    cmd_parser.add_argument('--verbose', action='store_true', help='report per-meter cycle time on stderr')
+    cmd_parser.add_argument('--publish', action='store_true', help='publish latest values to shared memory')
+    args = cmd_parser.parse_args()
+    try:
+        if args.publish:
+            import latest_values
+            publisher = latest_values.LatestValuesWriter()
+        else:
+            publisher = None
+        poller = MultiBusPoller(bus_pollers(args.meter, args.baudrate, args.port, args.auto_baud), args.interval)
+        poller.open()
+        writer = RecordWriter(args.output)
+        # first cycle reads every meter, then each meter on its own period
+        due = list(poller.meters.keys())
+        tick_time = time.time()
+        cycles = 0
+        while True:
+            results = poller.poll(due)
+            writer.write_tick(tick_time, results)
+            if publisher is not None:
+                for meter, record in results:
+                    publisher.publish(meter.name, record)
+            if args.verbose:
+                for meter, record in results:
+                    sys.stderr.write(f'{meter.name}: {meter.cycle_time:.3f} s\n')
+            cycles = cycles + 1
+            if args.quantity and cycles >= args.quantity:
+                break
+            due = poller.wait()
+            tick_time = poller.scheduler.tick_time
+        writer.close()
+        poller.close()
+        if publisher is not None:
+            publisher.close()
+
+    except ConnectionError:
+        sys.stderr.write('Error communicating with hardware.\n')
+        sys.exit(1)
@@ -7,50 +7,133 @@
 # Raspberry Pi GPIO.
 # requires blinkt library: sudo pip3 install blinkt
 
-import blinkt
 import sys
 import os
 import time
 import subprocess
+import threading
+import meter_drivers
+import led_status
+from log_writer import LogWriter
+from scheduler import Schedule
+from supervisor import Supervisor
 
 
 LOGDIR = '/media/usb/kwhmeter'
-LOGFILE = LOGDIR + '/' + time.strftime('%Y%m%d-%H.%M.%S', time.gmtime()) + '.csv'
+# 'csv', or 'binary' for compact packed records (convert to CSV with binary_log.py)
+LOG_FORMAT = 'csv'
+# Each log file is named by the UTC time of its first reading
+LOGFILE = LOGDIR + '/%Y%m%d-%H.%M.%S' + ('.bin' if LOG_FORMAT == 'binary' else '.csv')
+# Start a new log file 'hourly', 'daily' or None, and/or once it reaches LOG_ROTATE_BYTES. Closed files
+# are compressed with LOG_COMPRESSION ('gzip', 'xz' or None) and listed in manifest.csv in LOGDIR.
+LOG_ROTATE = 'daily'
+LOG_ROTATE_BYTES = None
+LOG_COMPRESSION = 'gzip'
+# Write 1 minute, 15 minute, hourly and daily rollups of power and energy to rollup-*.csv in LOGDIR
+# (see rollups.py). Power and energy columns come from the driver, or ROLLUP_POWER and ROLLUP_ENERGY
+# with an acquisition program; ROLLUP_ROLLOVER is the energy counter's modulus, if it wraps.
+ROLLUPS = True
+ROLLUP_POWER = 'Power'
+ROLLUP_ENERGY = 'Cumulative energy'
+ROLLUP_ROLLOVER = None
+# With the 'cc128' driver and ROLLUPS, periods the logger missed are filled from the base station's
+# history messages into rollup-backfill.csv in LOGDIR (see backfill.py)
+BACKFILL = True
 TIME_SLICE = 10.0
+# Times to play the IP address on the LEDs at start up, alongside logging (0 to skip)
+SHOW_IP_ADDRESS = 2
+# Durability policy: readings are spooled in RAM and written to the USB stick in one batch and
+# fsync'd after FLUSH_RECORDS readings, FLUSH_BYTES bytes or FLUSH_SECONDS seconds, whichever
+# comes first (None disables that trigger). Writing happens on a background thread so a slow
+# stick cannot delay the next reading. While the stick is missing or remounting up to
+# SPOOL_SIZE bytes of readings are kept and written once it is back.
+FLUSH_RECORDS = 10
+FLUSH_BYTES = None
+FLUSH_SECONDS = None
+SPOOL_SIZE = 4 * 1024 * 1024
 
 # Select meter hardware
+# ACQUISITION_DRIVER reads the meter in-process, keeping the serial port open between readings:
+# one of 'iem2150', 'pm5100', 'dds238' or 'cc128' (see meter_drivers.py).
+# Set ACQUISITION_DRIVER to None to run ACQUISITION_PROGRAM as a sub-process instead: for every
+# reading, or once with --stream when ACQUISITION_STREAM is True, restarting it if it stalls or exits.
+ACQUISITION_DRIVER = 'iem2150'
+ACQUISITION_STREAM = False
+# Socket of a running rs485_arbiter.py to share the bus with other processes, or None to open the port directly
+ACQUISITION_ARBITER = None
+# Shared memory segment the latest readings are published to for other local tools (see latest_values.py), or None
+LATEST_VALUES = '/energy_scribe_latest'
 # Uncomment ACQUISITION_PROGRAM and CSVHEADERS to switch to different meter hardware
 ACQUISITION_PROGRAM = './schneider_iEM2150.py'
-CSVHEADERS = '"Time","Voltage","Current","Power","Reactive power","Power factor","Power factor direction","Frequency","Cumulative energy"'
+CSVHEADERS = '"Time","Voltage","Current","Power","Reactive power","Power factor","Power factor direction","Frequency","Cumulative energy","Quality"'
 #ACQUISITION_PROGRAM = './current_cost.py'
 #CSVHEADERS = '"Time", "Watts #1", "Watts #2", "Watts #3", "Watts #4", "Watts #5", "Watts #6", "Watts #7", "Watts #8", "Watts #9"'
 #ACQUISITION_PROGRAM = './hiking_dds238_2.py'
-#CSVHEADERS = '"Time","Voltage","Current","Power","Reactive power","Power factor","Frequency","Cumulative energy"'
+#CSVHEADERS = '"Time","Voltage","Current","Power","Reactive power","Power factor","Frequency","Cumulative energy","Quality"'
 
 
-COLOURS = { 'red': (200,0,0), 'green': (0,200,0), 'blue': (0,0,200), 'yellow': (200,200,0),\
-        'cyan': (0,200,200), 'magenta': (200,0,200), 'white': (200,200,200), 'off': (0,0,0) }
-
 def set_pixel(index, colour):
+    # returns at once: the LED service thread pushes changed pixels to the shield
     try:
-        col = COLOURS[colour]
-        blinkt.set_pixel(index, col[0], col[1], col[2])
-        blinkt.show()
+        supervisor.call('leds', led_status.LedService.set_pixel, index, colour)
     except:
-        sys.stderr.write("Index or colour was out of range.\n")
-        raise ValueError()
+        # the LEDs must never stop the log; a failed LED service is restarted by the supervisor
+        pass
+
+def start_leds(previous):
+    return led_status.LedService(brightness=0.1, previous=previous)
+
+def open_log_file(header, previous=None, column_types=None):
+    # the file is opened by the writer thread, and reopened if the USB stick is replaced; a writer
+    # replacing one whose thread died carries on with the same file
+    return LogWriter(LOGFILE, header, FLUSH_RECORDS, FLUSH_BYTES, FLUSH_SECONDS, SPOOL_SIZE, log_format=LOG_FORMAT,
+                     rotate=LOG_ROTATE, rotate_bytes=LOG_ROTATE_BYTES, compression=LOG_COMPRESSION, previous=previous,
+                     column_types=column_types)
 
-def open_log_file():
+def start_driver(previous):
+    if ACQUISITION_DRIVER is not None:
+        options = { 'arbiter': ACQUISITION_ARBITER } if ACQUISITION_ARBITER is not None else {}
+        if backfill is not None:
+            options['on_history'] = backfill.add_history
+        if ROLLUPS and ACQUISITION_DRIVER == 'pm5100':
+            options['fast_energy'] = True
+        return meter_drivers.load_driver(ACQUISITION_DRIVER, **options)
+    return meter_drivers.StreamDriver(ACQUISITION_PROGRAM, TIME_SLICE, CSVHEADERS)
+
+def close_all():
+    # show the final status and write out everything spooled before exiting, with the rollup
+    # rows of the intervals in progress
     try:
-        f = open(LOGFILE, 'w+')
-        return f
+        leds = supervisor.get('leds')
+        if leds is not None:
+            leds.flush()
+        (supervisor.get('writer') or log_file).close()
     except:
-        sys.stderr.write("Couldn't open the log file.\n")
-        raise OSError()
+        pass
+    try:
+        if rollups is not None:
+            rollups.close()
+        for writer in rollup_writers.values():
+            writer.close()
+        if backfill is not None:
+            backfill.close()
+    except:
+        pass
+
+def show_spool(log_file):
+    # LED 2 shows how much of the RAM spool is waiting for the USB stick
+    fill = log_file.spool_fill()
+    if log_file.detached:
+        set_pixel(2, 'red' if fill > 0.75 else 'yellow')
+    else:
+        set_pixel(2, 'off')
 
-def get_readings():
+def get_readings(driver):
+    if driver is not None:
+        # raises ConnectionError on failure and reconnects on the next call
+        return driver.read_line()
     try:
-        result = subprocess.run([READMETER], stdout = subprocess.PIPE)
+        result = subprocess.run([ACQUISITION_PROGRAM], stdout = subprocess.PIPE)
         if result.returncode == 0:
             return result.stdout.decode('utf-8')
         else:
@@ -64,35 +147,94 @@ def get_readings():
 
 # We start here
 try:
-    blinkt.set_clear_on_exit(False)
-    blinkt.set_brightness(0.1)
+    # The meter driver, log writer and LED service are restarted on their own if they fail, with
+    # a backoff, while the loop keeps its cadence (see supervisor.py)
+    supervisor = Supervisor()
+    supervisor.add('leds', start_leds, alive=led_status.LedService.is_alive)
 
     set_pixel(0, 'magenta')
-    captures = 0
-    log_file = open_log_file()
-    log_file.write(CSVHEADERS + '\n')
-    time_start = time.time()
+    if SHOW_IP_ADDRESS:
+        # plays on the LED background layer while readings are taken, so it never delays the first reading
+        import blinkt_display_ip_address
+        threading.Thread(target=blinkt_display_ip_address.display_address,
+                         args=(supervisor.get('leds'), SHOW_IP_ADDRESS), daemon=True).start()
+    backfill = None
+    rollups = None
+    rollup_writers = {}
+    if BACKFILL and ROLLUPS and ACQUISITION_DRIVER == 'cc128':
+        try:
+            import backfill as history_backfill
+            backfill = history_backfill.HistoryBackfill(LOGDIR)
+        except ValueError:
+            sys.stderr.write("Gaps will not be backfilled.\n")
+    if ACQUISITION_DRIVER is not None or ACQUISITION_STREAM:
+        driver = supervisor.add('driver', start_driver, stop=lambda driver: driver.close())
+    else:
+        driver = None
+    csv_headers = driver.csv_headers if driver is not None else CSVHEADERS
+    # binary logs take their column types from the driver, and guess them for an acquisition program
+    column_types = driver.column_types if driver is not None else None
+    log_file = supervisor.add('writer', lambda previous: open_log_file(csv_headers + '\n', previous, column_types),
+                              alive=LogWriter.is_alive)
+    publisher = None
+    if LATEST_VALUES is not None:
+        try:
+            import latest_values
+            publisher = latest_values.LatestValuesWriter(LATEST_VALUES)
+        except (ImportError, ConnectionError):
+            sys.stderr.write("Latest values will not be published.\n")
+    meter_name = driver.name if driver is not None else os.path.basename(ACQUISITION_PROGRAM)
+    if ROLLUPS:
+        if driver is not None and driver.power_column is not None:
+            power_column, energy_column = driver.power_column, driver.energy_column
+        else:
+            power_column, energy_column = ROLLUP_POWER, ROLLUP_ENERGY
+        try:
+            import rollups as rollup_levels
+            rollups, rollup_writers = rollup_levels.open_rollups(LOGDIR, csv_headers, power_column,
+                                                                 energy_column, ROLLUP_ROLLOVER)
+        except ValueError:
+            sys.stderr.write("Readings will not be rolled up.\n")
+    schedule = Schedule(TIME_SLICE)
     def sleeping():
-        # calculated sleep time syncs to system clock so that N cycles over a long period
-        # will have the correct average interval
-        time.sleep(TIME_SLICE - ((time.time() - time_start) % TIME_SLICE))
+        # sleeps until the next TIME_SLICE boundary of the system clock so that N cycles over
+        # a long period have the correct average interval, without drifting if the clock is stepped
+        schedule.wait()
     while True:
+        supervisor.check()
+        # while a failed writer waits to restart, readings stay on its queue for its replacement
+        log_file = supervisor.get('writer') or log_file
         try:
             set_pixel(1, 'blue')
-            readings = get_readings()
-        except ConnectionError:
+            if driver is not None:
+                # a failed read closes the driver and it is restarted on a later tick
+                readings = supervisor.call('driver', get_readings)
+            else:
+                readings = get_readings(None)
+        except Exception:
             set_pixel(1, 'red')
             sleeping()
             continue
         set_pixel(2, 'green')
         log_file.write(readings)
+        if publisher is not None:
+            try:
+                publisher.publish_csv(meter_name, csv_headers, readings)
+            except:
+                # publishing is only for local displays and must never stop the log
+                pass
+        if rollups is not None:
+            try:
+                rollups.add_csv(readings)
+            except:
+                sys.stderr.write("Couldn't roll up readings.\n")
+        if backfill is not None:
+            try:
+                backfill.add_csv(readings)
+            except:
+                sys.stderr.write("Couldn't note readings for backfill.\n")
         set_pixel(1, 'off')
-        set_pixel(2, 'off')
-        captures = captures + 1
-        if captures % 10 == 0:
-            # flushes cached writes to USB stick every 10 cycles
-            log_file.flush()
-            os.fsync(log_file.fileno())
+        show_spool(log_file)
         sleeping() 
 
 except ConnectionError:
@@ -100,7 +242,7 @@ except ConnectionError:
     set_pixel(0, 'red')
     set_pixel(1, 'red')
     set_pixel(2, 'off')
-    log_file.close()
+    close_all()
     sys.exit(1)
 
 except OSError:
@@ -108,7 +250,7 @@ except OSError:
     set_pixel(0, 'red')
     set_pixel(1, 'off')
     set_pixel(2, 'red')
-    log_file.close()
+    close_all()
     sys.exit(1)
 
 except:
@@ -116,10 +258,5 @@ except:
     set_pixel(0, 'red')
     set_pixel(1, 'off')
     set_pixel(2, 'off')
-    log_file.close()
+    close_all()
     sys.exit(1)
-
-
-
-
-
@@ -1,44 +1,265 @@
 #!/usr/bin/env python3
 # Read from currentcost serial interface
+# The CC128 base station broadcasts one <msg> XML document per sensor transmission,
+# about every 6 seconds for each sensor. MessageParser parses the byte stream
+# incrementally with an XML pull parser, whatever the line breaks, and resynchronises on
+# the next <msg> after noise or a partial message. CC128Reader keeps the port open and
+# parses on its own thread into a table of each sensor's latest watts and receive time,
+# so snapshot() returns at once on the logger's schedule instead of waiting for a round
+# of transmissions from every sensor. Sensors not heard for STALE_SECONDS are left empty.
+# The one-shot command still waits for a full round, as before.
+# The base station also sends <hist> messages of stored energy per sensor in kWh: 2 hour
+# periods (h004 is the period ending 2 hours before the current one, up to about a month
+# back), days (d001 is yesterday) and months. history_intervals() turns the 2 hour and
+# daily periods into UTC time ranges, counted back from the start of the 2 hour period or
+# day the message is received in (the base station's own clock isn't used), and
+# CC128Reader passes them to on_history (see backfill.py). Monthly totals are too coarse
+# to fill a gap and are ignored.
 # requires serial library: sudo pip3 install pyserial
 
 import serial
-import re
 import sys
 import csv
 import time
+import json
+import argparse
+import threading
+from xml.etree import ElementTree
+from scheduler import Schedule
 
+PORT = '/dev/ttyUSB0'
+BAUDRATE = 57600
+SENSORS = 10                  # sensor numbers 0-9; readings hold sensors 1-9 after the timestamp
+STALE_SECONDS = 30.0          # a sensor's reading is dropped if it hasn't transmitted for this long
+FIRST_MESSAGE_WAIT = 10.0     # seconds snapshot() waits for the first message after opening the port
+READ_TIMEOUT = 1.0            # seconds a serial read waits, so the reader thread can be stopped
+HISTORY_PERIODS = { 'h': (3600, 2), 'd': (86400, 1) }    # tag prefix: (seconds per unit, units per period)
 
-def get_timestamp():
-    now = time.gmtime()
+
+def get_timestamp(now=None):
+    now = time.gmtime(now)
     return time.strftime('%Y/%m/%d %H:%M:%S', now)
 
 
-try:
-    meter = serial.Serial('/dev/ttyUSB0', 57600)
-    readings = [None] * 10
-    csv_output = csv.writer(sys.stdout, quoting=csv.QUOTE_NONNUMERIC)
+def open_meter(port=PORT):
+    return serial.Serial(port, BAUDRATE, timeout=READ_TIMEOUT)
+
+
+class MessageParser:
+    """Incremental parser for the stream of <msg> documents from the base station"""
+
+    def __init__(self):
+        self.parser = None
+        self.root = None
+        self.pending = b''              # bytes kept while looking for the start of a message
+        self.errors = 0
+
+    def feed(self, data):
+        """Every <msg> element completed by data"""
+        if self.parser is None:
+            data = self.pending + data
+            start = data.find(b'<msg>')
+            if start < 0:
+                self.pending = data[-4:]
+                return []
+            self.pending = b''
+            data = data[start:]
+            # the messages are parsed as children of one endless document
+            self.parser = ElementTree.XMLPullParser(['start', 'end'])
+            self.parser.feed(b'<stream>')
+        messages = []
+        try:
+            self.parser.feed(data)
+            for event, element in self.parser.read_events():
+                if event == 'start' and self.root is None:
+                    self.root = element
+                elif event == 'end' and element.tag == 'msg':
+                    messages.append(element)
+                    self.root.remove(element)
+        except ElementTree.ParseError:
+            # noise on the line: drop the rest and start again at the next message
+            self.errors = self.errors + 1
+            self.parser = None
+            self.root = None
+        return messages
+
+
+def sensor_reading(message):
+    """(sensor, watts of each channel) from a real-time message, or None"""
+    sensor = message.findtext('sensor')
+    if sensor is None or message.find('hist') is not None:
+        return None
+    channels = []
+    for channel in message:
+        if channel.tag.startswith('ch'):
+            channels.append(int(channel.findtext('watts', '0')))
+    if not channels:
+        return None
+    return int(sensor), channels
+
+
+def history_intervals(message, received):
+    """(sensor, start, end, kWh, period tag prefix) for each 2 hour and daily period in a
+    history message, with start and end in seconds since epoch"""
+    history = message.find('hist')
+    if history is None:
+        return []
+    intervals = []
+    for data in history.iter('data'):
+        try:
+            sensor = int(data.findtext('sensor'))
+        except (TypeError, ValueError):
+            continue
+        for period in data:
+            if period.tag[:1] not in HISTORY_PERIODS or not period.tag[1:].isdigit():
+                continue
+            unit, length = HISTORY_PERIODS[period.tag[:1]]
+            try:
+                energy = float(period.text)
+            except (TypeError, ValueError):
+                continue
+            # the current, incomplete period is not sent: h004 ends 2 hours before this one starts
+            current = received - received % (unit * length) if length > 1 else received - received % unit
+            end = current - (int(period.tag[1:]) - length) * unit
+            intervals.append((sensor, end - length * unit, end, energy, period.tag[:1]))
+    return intervals
+
+
+class CC128Reader(threading.Thread):
+    """Reads the base station continuously into a table of each sensor's latest reading.
+    on_history, if given, is called from the reader thread with the intervals of each
+    history message."""
+
+    def __init__(self, port=PORT, on_history=None):
+        super().__init__(daemon=True)
+        self.port = port
+        self.on_history = on_history
+        self.meter = open_meter(port)
+        self.parser = MessageParser()
+        self.lock = threading.Lock()
+        self.received = threading.Condition(self.lock)
+        self.table = {}                 # sensor: (watts, receive time, watts of each channel)
+        self.messages = 0
+        self.running = True
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            while self.running:
+                data = self.meter.read(max(self.meter.in_waiting, 1))
+                if data:
+                    for message in self.parser.feed(data):
+                        self.handle(message)
+        except Exception as e:
+            if self.running:
+                sys.stderr.write(f"Couldn't read from serial interface: {e}\n")
+                self.error = e
+        with self.lock:
+            self.running = False
+            self.received.notify_all()
+
+    def handle(self, message):
+        if message.find('hist') is not None:
+            if self.on_history is not None:
+                try:
+                    self.on_history(history_intervals(message, time.time()))
+                except Exception as e:
+                    sys.stderr.write(f"Couldn't use history message: {e}\n")
+            return
+        reading = sensor_reading(message)
+        if reading is None or not 0 <= reading[0] < SENSORS:
+            return
+        sensor, channels = reading
+        with self.lock:
+            self.table[sensor] = (channels[0], time.time(), channels)
+            self.messages = self.messages + 1
+            self.received.notify_all()
+
+    def sensors(self):
+        with self.lock:
+            return dict(self.table)
+
+    def snapshot(self, timeout=FIRST_MESSAGE_WAIT, stale=STALE_SECONDS):
+        """Timestamp and the latest watts of sensors 1-9 (None if not heard recently), without
+        waiting for a new transmission. Raises ConnectionError if the port has failed or
+        nothing has been received."""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while not self.table and self.running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.received.wait(remaining)
+            if not self.running:
+                raise ConnectionError('Serial error')
+            now = time.time()
+            fresh = { sensor: watts for sensor, (watts, received, channels) in self.table.items() if now - received <= stale }
+        if not fresh:
+            sys.stderr.write('No messages from the base station.\n')
+            raise ConnectionError('No messages')
+        return [get_timestamp(now)] + [fresh.get(sensor) for sensor in range(1, SENSORS)]
+
+    def close(self):
+        self.running = False
+        try:
+            self.meter.close()
+        except:
+            pass
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(READ_TIMEOUT * 2)
+
+
+def get_readings(meter):
+    """One full round: read until a sensor transmits a second time"""
+    parser = MessageParser()
+    readings = [None] * SENSORS
+    seen = set()
     while True:
-        meter_reading = meter.readline().decode('utf-8')
-        name_match = re.search(r"<sensor>(\d)</sensor>", meter_reading)
-        if name_match:
-            name = int(name_match.group(1))
-        watts_match = re.search(r"<watts>(\d+)</watts>", meter_reading)
-        if watts_match:
-            watts = int(watts_match.group(1))
-        if readings[name] != None:
-            # break if the element is already populated
-            break
-        else:
-            readings[name] = watts
-    readings[0] = get_timestamp()
-    csv_output.writerow(readings)
+        data = meter.read(max(meter.in_waiting, 1))
+        if not data:
+            continue
+        for message in parser.feed(data):
+            reading = sensor_reading(message)
+            if reading is None or not 0 <= reading[0] < SENSORS:
+                continue
+            sensor, channels = reading
+            if sensor in seen:
+                # break when a sensor is already populated
+                readings[0] = get_timestamp()
+                return readings
+            seen.add(sensor)
+            readings[sensor] = channels[0]
 
-except:
-    sys.stdout.flush()
-    sys.stderr.write("Couldn't read from serial interface.\n")
-    sys.exit(1)
 
+def stream_readings(reader, interval, ndjson):
+    # keep the port open and write one line per tick, flushed so a reading process sees it at once
+    csv_output = csv.writer(sys.stdout, quoting=csv.QUOTE_NONNUMERIC)
+    schedule = Schedule(interval)
+    while True:
+        readings = reader.snapshot()
+        if ndjson:
+            sys.stdout.write(json.dumps({ 'timestamp': readings[0], 'watts': readings[1:] }) + '\n')
+        else:
+            csv_output.writerow(readings)
+        sys.stdout.flush()
+        schedule.wait()
 
 
+if __name__ == '__main__':
+    cmd_parser = argparse.ArgumentParser(description='Read data from Current Cost CC128 base station.')
+    cmd_parser.add_argument('--stream', action='store_true', help='keep reading, one CSV line per interval')
+    cmd_parser.add_argument('--interval', type=float, nargs='?', default=10.0, help='interval in seconds between streamed readings')
+    cmd_parser.add_argument('--ndjson', action='store_true', help='stream one JSON object per line instead of CSV')
+    args = cmd_parser.parse_args()
+    try:
+        if args.stream:
+            stream_readings(CC128Reader(), args.interval, args.ndjson)
+        meter = open_meter()
+        csv_output = csv.writer(sys.stdout, quoting=csv.QUOTE_NONNUMERIC)
+        csv_output.writerow(get_readings(meter))
 
+    except:
+        sys.stdout.flush()
+        sys.stderr.write("Couldn't read from serial interface.\n")
+        sys.exit(1)
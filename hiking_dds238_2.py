@@ -7,11 +7,33 @@
 # requires minimalmodbus library: sudo pip3 install minimalmodbus
 
 import minimalmodbus
+import modbus_rtu
 import datetime
 import time
 import sys
 import os
+import json
+import argparse
 import serial.tools.list_ports
+from scheduler import Schedule
+from register_decoder import plan_block_reads, compile_block_plan, read_blocks, quality_codes
+
+WORD_ORDER = 'big'            # most significant register first
+BYTE_ORDER = 'big'            # most significant byte first within each register
+SUPPORTED_BAUDRATES = (9600, 4800, 2400, 1200)
+MODBUS_ENGINE = 'rtu'         # 'rtu' for the lean transactions of modbus_rtu.py, or 'minimalmodbus'
+
+# register addresses as sent on the wire, decimals given as a decoder suffix
+DDS238_REGISTER_MAP = {
+    "volts":            (0x000c, 1, 'INT16U.1'),
+    "amps":             (0x000d, 1, 'INT16U.2'),
+    "power":            (0x000e, 1, 'INT16U'),
+    "reactive_power":   (0x000f, 1, 'INT16U'),
+    "pf":               (0x0010, 1, 'INT16U.3'),
+    "freq":             (0x0011, 1, 'INT16U.2'),
+    "energy":           (0x000a, 2, 'INT32U.2')
+}
+DDS238_BLOCK_PLAN = compile_block_plan(DDS238_REGISTER_MAP, plan_block_reads(DDS238_REGISTER_MAP), WORD_ORDER, BYTE_ORDER)
 
 # on Ubuntu, serial ports are in the form '/dev/ttyUSBx' where x is an integer 0-7
 # on Windows, serial ports are in the form 'COMx' where x is an integer 1-8
@@ -29,9 +51,12 @@ def find_serial_device():
  
 
         
-def configure(port):
+def configure(port, modbus_device_address=1):
     try:
-        instrument = minimalmodbus.Instrument(port, 1, mode='rtu')
+        if MODBUS_ENGINE == 'rtu':
+            # cached request frames on the open port, see modbus_rtu.py
+            return modbus_rtu.RtuInstrument(port, modbus_device_address, 9600, timeout=0.5)
+        instrument = minimalmodbus.Instrument(port, modbus_device_address, mode='rtu')
         instrument.serial.baudrate = 9600
         instrument.serial.bytesize = 8
         instrument.serial.stopbits = 1
@@ -46,18 +71,23 @@ def get_timestamp():
     now = time.gmtime()
     return time.strftime('%Y/%m/%d %H:%M:%S', now)
 
+def csv_readings(instrument, port, cache=None):
+    readings = get_readings(instrument, port, cache)
+    # date,voltage,current,power,reactive power,power factor,frequency,cumulative energy,quality
+    return '"' + get_timestamp() +  '",' +\
+            readings['volts'] + ',' +\
+            readings['amps'] + ',' +\
+            readings['power'] + ',' +\
+            readings['reactive_power'] + ',' +\
+            readings['pf'] + ',' +\
+            readings['freq'] + ',' +\
+            readings['energy'] + ',"' +\
+            readings['quality'] + '"\n'
+
+
 def print_csv_all_readings(instrument, port):
     try:
-        # date,voltage,current,power,reactive power,power factor,frequency,cumulative energy
-        output = '"' + get_timestamp() +  '",' +\
-                read_modbus(instrument, 0x000c, port, 1) + ',' +\
-                read_modbus(instrument, 0x000d, port, 2) + ',' +\
-                read_modbus(instrument, 0x000e, port, 0) + ',' +\
-                read_modbus(instrument, 0x000f, port, 0) + ',' +\
-                read_modbus(instrument, 0x0010, port, 3) + ',' +\
-                read_modbus(instrument, 0x0011, port, 2) + ',' +\
-                read_modbus(instrument, 0x000a, port, 2, True) + '\n'
-        sys.stdout.write(output)
+        sys.stdout.write(csv_readings(instrument, port))
     except:
         sys.stderr.write('Failed to read instrument or write output.\n')
         raise ConnectionError('Modbus or write error')
@@ -65,15 +95,17 @@ def print_csv_all_readings(instrument, port):
 
 def print_json_all_readings(instrument, port):
     try:
+        readings = { k:v or 'null' for k, v in get_readings(instrument, port).items() }
         output = '{"version": 1, ' +\
                  '"timestamp": "' + get_timestamp() + '", ' +\
-                 '"points": {"voltage": {"present_value": ' + read_modbus(instrument, 0x000c, port, 1) + '}, ' +\
-                 '"current": {"present_value": '            + read_modbus(instrument, 0x000d, port, 2) + '}, ' +\
-                 '"power": {"present_value": '              + read_modbus(instrument, 0x000e, port, 0) + '}, ' +\
-                 '"reactive power": {"present_value": '     + read_modbus(instrument, 0x000f, port, 0) + '}, ' +\
-                 '"power factor": {"present_value": '       + read_modbus(instrument, 0x0010, port, 3) + '}, ' +\
-                 '"frequency": {"present_value": '          + read_modbus(instrument, 0x0011, port, 2) + '}, ' +\
-                 '"energy": {"present_value": '             + read_modbus(instrument, 0x000a, port, 2, True) + '}}}\n'
+                 '"quality": "' + readings['quality'] + '", ' +\
+                 '"points": {"voltage": {"present_value": ' + readings['volts'] + '}, ' +\
+                 '"current": {"present_value": '            + readings['amps'] + '}, ' +\
+                 '"power": {"present_value": '              + readings['power'] + '}, ' +\
+                 '"reactive power": {"present_value": '     + readings['reactive_power'] + '}, ' +\
+                 '"power factor": {"present_value": '       + readings['pf'] + '}, ' +\
+                 '"frequency": {"present_value": '          + readings['freq'] + '}, ' +\
+                 '"energy": {"present_value": '             + readings['energy'] + '}}}\n'
         # only write the output if we have successfully acquired the payload
         sys.stdout.write(output)
     except:
@@ -82,52 +114,93 @@ def print_json_all_readings(instrument, port):
 
 def print_all_readings(instrument, port):
     try:
-        output = read_modbus(instrument, 0x000c, port, 1) + ' V\n' +\
-                 read_modbus(instrument, 0x000d, port, 2) + ' A\n' +\
-                 read_modbus(instrument, 0x000e, port, 0) + ' W\n' +\
-                 read_modbus(instrument, 0x000f, port, 0) + ' VAR\n' +\
-                 read_modbus(instrument, 0x0010, port, 3) + ' pf\n' +\
-                 read_modbus(instrument, 0x0011, port, 2) + ' Hz\n' +\
-                 read_modbus(instrument, 0x000a, port, 2, True) + ' kWh\n'
+        readings = get_readings(instrument, port)
+        output = readings['volts'] + ' V\n' +\
+                 readings['amps'] + ' A\n' +\
+                 readings['power'] + ' W\n' +\
+                 readings['reactive_power'] + ' VAR\n' +\
+                 readings['pf'] + ' pf\n' +\
+                 readings['freq'] + ' Hz\n' +\
+                 readings['energy'] + ' kWh\n' +\
+                 readings['quality'] + ' quality\n'
         sys.stdout.write(output)
     except:
         sys.stderr.write('Failed to complete read of instrument state.\n')
         raise ConnectionError('Modbus error')
 
-def read_modbus(instrument, register, port, decimals, longvalue=False):
+def get_readings(instrument, port, cache=None):
+    # all seven values come from one block read of registers 0x000a-0x0011; if it fails each
+    # register is retried on its own, and a missing value is left empty with its quality in 'quality'
     try:
-        if longvalue == True:
-            reading = float(instrument.read_long(register)) / (10 ** decimals)
-        else:
-            reading = float(instrument.read_register(register, decimals))
-        return str.format('%.2f' % reading)
+        readings, quality = read_blocks(instrument.read_registers, DDS238_BLOCK_PLAN, DDS238_REGISTER_MAP, cache)
     except:
-        sys.stderr.write('Failed to read from register ' + format(register, '#04x') + '\n')
+        sys.stderr.write('Failed to read from registers ' + format(DDS238_BLOCK_PLAN[0].start, '#04x') + '-' +\
+                         format(DDS238_BLOCK_PLAN[-1].start + DDS238_BLOCK_PLAN[-1].length - 1, '#04x') + '\n')
         raise ConnectionError('Modbus error')
+    values = { k:'' if readings[k] is None else str.format('%.2f' % float(readings[k])) for k in DDS238_REGISTER_MAP.keys() }
+    values['quality'] = quality_codes(quality, DDS238_REGISTER_MAP.keys())
+    return values
 
 def write_modbus(instrument, register, *values):
     try:
-        instrument.write_multiple_registers(register, values)
+        instrument.write_registers(register, list(values))
     except:
-        sys.stderr.write('Failed to write to port ' + port + '\n')
+        sys.stderr.write('Failed to write to register ' + format(register, '#04x') + '\n')
         raise ConnectionError('Modbus error')
 
-def set_baud_rate(speed, port):
-    lookup = { 9600:0b00010001, 4800:0b00010010, 2400:0b000010011, 1200:0b00010100 }
-    write_modbus(0x15, port, lookup[speed])
-
-
-try:
-    port = find_serial_device()
-    instrument = configure(port)
-    print_csv_all_readings(instrument, port)
-
-except ConnectionError:
-    sys.stderr.write('Error communicating with hardware.\n')
-    sys.exit(1)
-
-
-        
-
+def set_baud_rate(instrument, speed, modbus_device_address=1):
+    # register 0x15 holds the modbus address in its high byte and the baud rate code in its low byte
+    lookup = { 9600:1, 4800:2, 2400:3, 1200:4 }
+    write_modbus(instrument, 0x15, (modbus_device_address << 8) | lookup[speed])
+
+def probe(instrument):
+    instrument.read_registers(0x0011, 1)
+
+def negotiate_baudrate(instrument):
+    # finds the rate the meter answers at, without changing the meter's configuration
+    if MODBUS_ENGINE == 'rtu':
+        modbus_rtu.find_baudrate(instrument.serial, [lambda: probe(instrument)], SUPPORTED_BAUDRATES)
+        instrument.latencies.clear()
+
+def upgrade_baudrate(instrument, modbus_device_address=1):
+    # moves the meter up to the fastest rate it supports, writing its configuration register
+    if MODBUS_ENGINE == 'rtu':
+        modbus_rtu.upgrade_baudrate(instrument.serial, [lambda: probe(instrument)],
+                                    [lambda speed: set_baud_rate(instrument, speed, modbus_device_address)],
+                                    SUPPORTED_BAUDRATES)
+        instrument.latencies.clear()
+
+
+def stream_readings(instrument, port, interval, ndjson):
+    # keep the port open and write one line per tick, flushed so a reading process sees it at once
+    schedule = Schedule(interval)
+    cache = {}
+    while True:
+        if ndjson:
+            readings = get_readings(instrument, port, cache)
+            quality = readings.pop('quality')
+            readings = { k:float(v) if v else None for k, v in readings.items() }
+            sys.stdout.write(json.dumps(dict(timestamp=get_timestamp(), **readings, quality=quality)) + '\n')
+        else:
+            sys.stdout.write(csv_readings(instrument, port, cache))
+        sys.stdout.flush()
+        schedule.wait()
 
 
+if __name__ == '__main__':
+    try:
+        cmd_parser = argparse.ArgumentParser(description='Read data from Hiking DDS238-2 energy meter.')
+        cmd_parser.add_argument('--stream', action='store_true', help='keep reading, one CSV line per interval')
+        cmd_parser.add_argument('--interval', type=float, nargs='?', default=10.0, help='interval in seconds between streamed readings')
+        cmd_parser.add_argument('--ndjson', action='store_true', help='stream one JSON object per line instead of CSV')
+        args = cmd_parser.parse_args()
+
+        port = find_serial_device()
+        instrument = configure(port)
+        if args.stream:
+            stream_readings(instrument, port, args.interval, args.ndjson)
+        print_csv_all_readings(instrument, port)
+
+    except ConnectionError:
+        sys.stderr.write('Error communicating with hardware.\n')
+        sys.exit(1)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# Copyright 2024 Arup
+# MIT License
+
+# Latest-value cache in POSIX shared memory.
+# The acquisition process publishes each meter's latest decoded record into a fixed-layout
+# segment (/energy_scribe_latest), so dashboards, LED indicators and scripts can read the
+# current voltage or power without sending their own modbus transactions.
+# The segment has a header and one slot per meter. Each slot holds a sequence counter,
+# the publish time, the meter name, up to MAX_FIELDS field names and their values as
+# doubles (non-numeric fields such as timestamps and 'leading'/'lagging' are left out, and
+# a missing value is NaN, keeping its field's place). Names are up to NAME_LENGTH bytes of
+# UTF-8, enough for every PM5100 register name; longer field names are left out rather
+# than cut short, so a reader never looks for a name that was stored differently.
+# Slots are guarded by a seqlock: the writer makes the sequence odd, writes the values
+# (and the field names when a field is added) and makes it even again, and readers retry
+# if the sequence was odd or changed while they read. The writer never waits for readers,
+# so reading can never stall acquisition.
+# There should be one publishing process per segment name.
+# Usage: ./latest_values.py                      print every meter's latest values
+#        ./latest_values.py --meter iem2150 --field Power
+# requires posix_ipc library: sudo pip3 install posix_ipc
+
+import argparse
+import csv
+import math
+import mmap
+import struct
+import sys
+import time
+import posix_ipc
+
+
+SHM_NAME = '/energy_scribe_latest'
+MAGIC = b'ESL2'
+MAX_METERS = 16
+MAX_FIELDS = 48
+NAME_LENGTH = 64              # bytes for meter and field names
+READ_RETRIES = 100            # attempts at a consistent read before giving up
+
+HEADER = struct.Struct('<4sII')                         # magic, slot count, fields per slot
+SLOT_HEADER = struct.Struct(f'<QdII{NAME_LENGTH}s')     # sequence, publish time, layout, field count, meter name
+SEQUENCE = struct.Struct('<Q')
+NAMES_OFFSET = SLOT_HEADER.size
+VALUES_OFFSET = NAMES_OFFSET + MAX_FIELDS * NAME_LENGTH
+SLOT_SIZE = VALUES_OFFSET + MAX_FIELDS * 8
+
+
+def segment_size(slots=MAX_METERS):
+    return HEADER.size + slots * SLOT_SIZE
+
+
+def numeric(value):
+    """The value as a float, or None for values that are not numbers"""
+    if isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class LatestValuesWriter:
+    """Publishes records into the shared memory segment, creating it if needed"""
+
+    def __init__(self, name=SHM_NAME, slots=MAX_METERS):
+        try:
+            memory = posix_ipc.SharedMemory(name, posix_ipc.O_CREAT, size=segment_size(slots))
+            self.map = mmap.mmap(memory.fd, memory.size)
+            memory.close_fd()
+        except (posix_ipc.Error, OSError):
+            sys.stderr.write(f"Couldn't create shared memory {name}.\n")
+            raise ConnectionError('Shared memory error')
+        self.slots = slots
+        self.meters = {}                # meter name: (slot offset, field names, values Struct)
+        self.long_names = set()         # field names left out for not fitting in NAME_LENGTH
+        self.map[:] = bytes(len(self.map))
+        HEADER.pack_into(self.map, 0, MAGIC, slots, MAX_FIELDS)
+
+    def slot(self, meter, fields):
+        """(slot offset, field names, values Struct) of a meter, and whether its layout changed"""
+        entry = self.meters.get(meter)
+        if entry is not None and entry[1] == fields:
+            return entry, False
+        if entry is None:
+            if len(meter.encode('utf-8')) > NAME_LENGTH:
+                sys.stderr.write(f'Meter name {meter} is longer than {NAME_LENGTH} bytes.\n')
+                raise ValueError()
+            if len(self.meters) >= self.slots:
+                sys.stderr.write(f'No shared memory slot left for {meter}.\n')
+                raise ValueError()
+            offset = HEADER.size + len(self.meters) * SLOT_SIZE
+        else:
+            offset = entry[0]
+        fields = fields[:MAX_FIELDS]
+        entry = (offset, fields, struct.Struct(f'<{len(fields)}d'))
+        self.meters[meter] = entry
+        return entry, True
+
+    def write_layout(self, meter, offset, fields, sequence, stamp):
+        # called with the sequence odd; the layout number is bumped so readers drop any field
+        # offsets they have cached
+        layout = SLOT_HEADER.unpack_from(self.map, offset)[2]
+        for i in range(MAX_FIELDS):
+            field = fields[i] if i < len(fields) else ''
+            struct.pack_into(f'{NAME_LENGTH}s', self.map, offset + NAMES_OFFSET + i * NAME_LENGTH,
+                             field.encode('utf-8'))
+        SLOT_HEADER.pack_into(self.map, offset, sequence, stamp, layout + 1, len(fields), meter.encode('utf-8'))
+
+    def publish(self, meter, record):
+        """Store the numeric fields of a record (a dict) as the meter's latest values. A field
+        published before keeps its place and is NaN while missing, so the layout only changes
+        when a new field appears."""
+        values = { k:numeric(v) for k, v in record.items() }
+        for k in values:
+            if len(k.encode('utf-8')) > NAME_LENGTH and k not in self.long_names:
+                self.long_names.add(k)
+                sys.stderr.write(f'Field name {k} is longer than {NAME_LENGTH} bytes: not published.\n')
+        values = { k:v for k, v in values.items() if k not in self.long_names }
+        known = self.meters[meter][1] if meter in self.meters else ()
+        fields = known + tuple(k for k, v in values.items() if v is not None and k not in known)
+        (offset, fields, values_struct), changed = self.slot(meter, fields)
+        # the new layout and the values under it are written in one update
+        sequence = SEQUENCE.unpack_from(self.map, offset)[0]
+        SEQUENCE.pack_into(self.map, offset, sequence + 1)
+        stamp = time.time()
+        if changed:
+            self.write_layout(meter, offset, fields, sequence + 1, stamp)
+        struct.pack_into('<d', self.map, offset + SEQUENCE.size, stamp)
+        values_struct.pack_into(self.map, offset + VALUES_OFFSET,
+                                *[math.nan if values.get(k) is None else values[k] for k in fields])
+        SEQUENCE.pack_into(self.map, offset, sequence + 2)
+
+    def publish_csv(self, meter, csv_headers, csv_line):
+        """Publish the last line of acquisition program output, named by its CSV headers"""
+        headers = next(csv.reader([csv_headers], skipinitialspace=True))
+        lines = csv_line.strip().split('\n')
+        self.publish(meter, dict(zip(headers, next(csv.reader([lines[-1]], skipinitialspace=True)))))
+
+    def close(self):
+        # the segment is left in place so readers keep the last values; the publish time shows their age
+        self.map.close()
+
+
+class LatestValuesReader:
+    """Reads the latest values without touching the bus or blocking the writer"""
+
+    def __init__(self, name=SHM_NAME):
+        try:
+            memory = posix_ipc.SharedMemory(name)
+            self.map = mmap.mmap(memory.fd, memory.size, prot=mmap.PROT_READ)
+            memory.close_fd()
+        except (posix_ipc.Error, OSError):
+            sys.stderr.write(f"Couldn't open shared memory {name}: is the acquisition program running?\n")
+            raise ConnectionError('Shared memory error')
+        magic, self.slots, max_fields = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or max_fields != MAX_FIELDS:
+            sys.stderr.write(f'Shared memory {name} has an unknown layout.\n')
+            raise ConnectionError('Shared memory error')
+        self.view = memoryview(self.map)
+        self.layouts = {}               # meter name: (slot offset, layout number, {field: value offset})
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+
+    def consistent(self, offset, read):
+        # seqlock read: retry while the writer is part way through an update
+        for attempt in range(READ_RETRIES):
+            before = SEQUENCE.unpack_from(self.map, offset)[0]
+            if before % 2 == 0:
+                result = read()
+                if SEQUENCE.unpack_from(self.map, offset)[0] == before:
+                    return result
+        return None
+
+    def read_layout(self, offset):
+        sequence, stamp, layout, count, name = SLOT_HEADER.unpack_from(self.map, offset)
+        fields = {}
+        for i in range(count):
+            field = bytes(self.view[offset + NAMES_OFFSET + i * NAME_LENGTH:offset + NAMES_OFFSET + (i + 1) * NAME_LENGTH])
+            fields[field.rstrip(b'\x00').decode('utf-8')] = offset + VALUES_OFFSET + 8 * i
+        return name.rstrip(b'\x00').decode('utf-8'), layout, fields
+
+    def meters(self):
+        """Names of the meters published so far"""
+        names = []
+        for slot in range(self.slots):
+            offset = HEADER.size + slot * SLOT_SIZE
+            name = self.consistent(offset, lambda: SLOT_HEADER.unpack_from(self.map, offset)[4].rstrip(b'\x00'))
+            if name:
+                names.append(name.decode('utf-8'))
+        return names
+
+    def find(self, meter):
+        entry = self.layouts.get(meter)
+        if entry is not None and SLOT_HEADER.unpack_from(self.map, entry[0])[2] == entry[1]:
+            return entry
+        for slot in range(self.slots):
+            offset = HEADER.size + slot * SLOT_SIZE
+            layout = self.consistent(offset, lambda: self.read_layout(offset))
+            if layout is not None and layout[0] == meter:
+                self.layouts[meter] = (offset, layout[1], layout[2])
+                return self.layouts[meter]
+        return None
+
+    def value(self, meter, field):
+        """One field's latest value, or None if it has not been published"""
+        entry = self.find(meter)
+        if entry is None or field not in entry[2]:
+            return None
+        position = entry[2][field]
+        def read_value():
+            return SLOT_HEADER.unpack_from(self.map, entry[0])[2], struct.unpack_from('<d', self.map, position)[0]
+        result = self.consistent(entry[0], read_value)
+        if result is None:
+            return None
+        if result[0] != entry[1]:
+            # the layout changed since it was cached: look the field up again
+            self.layouts.pop(meter, None)
+            return self.value(meter, field)
+        return result[1]
+
+    def read(self, meter):
+        """A consistent (publish time, {field: value}) snapshot of one meter, or None"""
+        entry = self.find(meter)
+        if entry is None:
+            return None
+        offset, layout, fields = entry
+        values_struct = struct.Struct(f'<{len(fields)}d')
+        def read_slot():
+            sequence, stamp, slot_layout, count, name = SLOT_HEADER.unpack_from(self.map, offset)
+            return slot_layout, stamp, values_struct.unpack_from(self.map, offset + VALUES_OFFSET)
+        snapshot = self.consistent(offset, read_slot)
+        if snapshot is None:
+            return None
+        if snapshot[0] != layout:
+            self.layouts.pop(meter, None)
+            return self.read(meter)
+        return snapshot[1], dict(zip(fields.keys(), snapshot[2]))
+
+
+# starts here
+if __name__ == '__main__':
+    cmd_parser = argparse.ArgumentParser(description='Print the latest meter values from shared memory.')
+    cmd_parser.add_argument('--meter', nargs='?', default=None, help='meter name, all meters by default')
+    cmd_parser.add_argument('--field', nargs='?', default=None, help='print only this field\'s value')
+    cmd_parser.add_argument('--name', nargs='?', default=SHM_NAME, help='shared memory segment name')
+    args = cmd_parser.parse_args()
+    try:
+        reader = LatestValuesReader(args.name)
+        for meter in [args.meter] if args.meter else reader.meters():
+            if args.field:
+                print(reader.value(meter, args.field))
+                continue
+            snapshot = reader.read(meter)
+            if snapshot is None:
+                sys.stderr.write(f'No values for {meter}.\n')
+                continue
+            stamp, values = snapshot
+            print(meter, time.strftime('%Y/%m/%d %H:%M:%S', time.gmtime(stamp)),
+                  ' '.join(f'{k}={v:g}' for k, v in values.items()))
+        reader.close()
+
+    except ConnectionError:
+        sys.exit(1)
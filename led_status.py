@@ -0,0 +1,141 @@
+# Copyright 2024 Arup
+# MIT License
+
+# LED status service for the blinkt shield.
+# Callers set the colours they want and return at once; a service thread holds the
+# desired state of the 8 pixels, merges changes made between frames and pushes a frame
+# to the shield only when the state differs from what is shown, at most MAX_REFRESH
+# times a second. The GPIO bit-banging of blinkt.show() therefore never runs on the
+# acquisition loop, and a burst of changes costs one frame rather than one per pixel.
+# flush() waits until the shield shows the desired state, for scripts about to exit.
+# A background layer (set_background) can fill the strip for low priority displays such
+# as the IP address at boot: it covers the status pixels while it runs, except any showing
+# a fault in one of URGENT_COLOURS, which always shows over it.
+# requires blinkt library: sudo pip3 install blinkt
+
+import sys
+import threading
+import time
+import blinkt
+
+
+COLOURS = { 'red': (200,0,0), 'green': (0,200,0), 'blue': (0,0,200), 'yellow': (200,200,0),\
+        'cyan': (0,200,200), 'magenta': (200,0,200), 'white': (200,200,200), 'off': (0,0,0) }
+MAX_REFRESH = 20              # frames per second at most
+PIXELS = blinkt.NUM_PIXELS if hasattr(blinkt, 'NUM_PIXELS') else 8
+URGENT_COLOURS = ('red', 'yellow')     # status colours never hidden by the background layer
+
+
+class LedService(threading.Thread):
+
+    def __init__(self, brightness=None, max_refresh=MAX_REFRESH, previous=None):
+        super().__init__(daemon=True)
+        blinkt.set_clear_on_exit(False)
+        self.brightness = brightness
+        self.min_interval = 1.0 / max_refresh
+        self.desired = [(0, 0, 0)] * PIXELS
+        self.background = None          # list of colour or None per pixel while a background display runs
+        if previous is not None:
+            # a service replacing one whose thread died shows the state it was given
+            self.desired = list(previous.desired)
+            self.background = previous.background
+        self.shown = None               # unknown until the first frame is pushed
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.running = True
+        self.frames = 0
+        self.start()
+
+    def set_pixel(self, index, colour):
+        """Set one pixel to a named colour; raises ValueError if either is out of range"""
+        if colour not in COLOURS or not 0 <= index < PIXELS:
+            sys.stderr.write("Index or colour was out of range.\n")
+            raise ValueError()
+        with self.lock:
+            self.desired[index] = COLOURS[colour]
+            self.changed.notify_all()
+
+    def set_pixels(self, colours):
+        """Set several pixels at once from a dict of index: colour name"""
+        for index, colour in colours.items():
+            if colour not in COLOURS or not 0 <= index < PIXELS:
+                sys.stderr.write("Index or colour was out of range.\n")
+                raise ValueError()
+        with self.lock:
+            for index, colour in colours.items():
+                self.desired[index] = COLOURS[colour]
+            self.changed.notify_all()
+
+    def clear(self):
+        self.set_pixels({ index: 'off' for index in range(PIXELS) })
+
+    def set_background(self, colours):
+        """Show a dict of index: colour name under the status pixels; None removes the
+        background layer"""
+        if colours is not None:
+            for index, colour in colours.items():
+                if colour not in COLOURS or not 0 <= index < PIXELS:
+                    sys.stderr.write("Index or colour was out of range.\n")
+                    raise ValueError()
+        with self.lock:
+            if colours is None:
+                self.background = None
+            else:
+                self.background = [COLOURS[colours[index]] if index in colours else None for index in range(PIXELS)]
+            self.changed.notify_all()
+
+    def frame(self):
+        # called with the lock held
+        if self.background is None:
+            return self.desired
+        urgent = [COLOURS[colour] for colour in URGENT_COLOURS]
+        return [status if below is None or status in urgent else below
+                for status, below in zip(self.desired, self.background)]
+
+    def flush(self, timeout=1.0):
+        """Wait until the desired state has been shown"""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while self.shown != self.frame() and self.running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.changed.wait(remaining)
+        return True
+
+    def run(self):
+        if self.brightness is not None:
+            blinkt.set_brightness(self.brightness)
+        last_frame = 0.0
+        while True:
+            with self.lock:
+                while self.running and self.shown == self.frame():
+                    self.changed.wait()
+                if not self.running:
+                    break
+            # changes arriving during this pause are merged into the same frame
+            pause = last_frame + self.min_interval - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+            with self.lock:
+                frame = list(self.frame())
+            try:
+                for index, (red, green, blue) in enumerate(frame):
+                    if self.shown is None or self.shown[index] != frame[index]:
+                        blinkt.set_pixel(index, red, green, blue)
+                blinkt.show()
+            except:
+                sys.stderr.write("Couldn't update the LEDs.\n")
+            last_frame = time.monotonic()
+            self.frames = self.frames + 1
+            with self.lock:
+                self.shown = frame
+                self.changed.notify_all()
+
+    def close(self):
+        """Show the last state set and stop the service thread"""
+        self.flush()
+        with self.lock:
+            self.running = False
+            self.changed.notify_all()
+        self.join()
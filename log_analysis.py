@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# Copyright 2024 Arup
+# MIT License
+
+# Bulk analysis of archived meter logs with NumPy.
+# CSV logs (plain or compressed) and binary logs are loaded in chunks of CHUNK_ROWS rows
+# into arrays, and every statistic is computed on whole arrays, carrying only the last
+# reading from one chunk to the next:
+#   consumption per period from the cumulative energy register (rollover and meter
+#   resets handled as in rollups.py), reconciled against power integrated over time
+#   daily load profile: mean power at each time of day
+#   peak demand: the highest mean power over any 15 minute interval
+#   power factor distribution
+# The power, energy and power factor columns are found from the headers each driver in
+# meter_drivers.py writes, and so are the units: each driver's energy_per_power_second
+# converts integrated power to the units of its energy register (kW to kWh for the
+# iEM2150, W to kWh for the DDS238, kW to Wh for the PM5100). --energy_per_power_second
+# overrides it for other meters.
+# Binary logs may be compressed by log rotation (.bin.gz); rows too short to hold every
+# column are skipped.
+# Log files should be given in time order, as their names sort.
+# Usage: ./log_analysis.py /media/usb/kwhmeter/2024*.csv.gz --report consumption --period 86400
+# requires numpy library: sudo pip3 install numpy
+
+import argparse
+import csv
+import itertools
+import operator
+import sys
+import time
+import numpy
+import meter_drivers
+from binary_log import BinaryLog, is_binary_log
+from log_query import open_log, time_column
+
+
+CHUNK_ROWS = 100000           # rows loaded into arrays at a time
+PERIOD = 3600                 # seconds per consumption period
+PROFILE_BIN = 900             # seconds per daily load profile bin
+DEMAND_WINDOW = 900           # seconds over which peak demand is averaged
+MAX_GAP = 60                  # longest gap between readings integrated across, in seconds
+PF_BINS = numpy.linspace(-1.0, 1.0, 41)
+TIME_FORMAT = '%Y/%m/%d %H:%M:%S'
+
+
+def meter_driver(headers):
+    """The driver class that writes logs with these headers: the one whose headers match
+    exactly (the iEM2150 and DDS238 share column names), or else the first with the power column"""
+    for driver in meter_drivers.DRIVERS.values():
+        if driver.csv_headers is not None and next(csv.reader([driver.csv_headers], skipinitialspace=True)) == headers:
+            return driver
+    for driver in meter_drivers.DRIVERS.values():
+        if driver.power_column is not None and driver.power_column in headers:
+            return driver
+    sys.stderr.write('Log columns do not match any meter type.\n')
+    raise ValueError()
+
+
+def meter_columns(headers):
+    """(time, power, energy, power factor) column names for a log's headers; energy and
+    power factor are None if the meter doesn't log them"""
+    driver = meter_driver(headers)
+    energy = driver.energy_column if driver.energy_column in headers else None
+    pf = driver.pf_column if driver.pf_column in headers else None
+    return headers[time_column(headers)], driver.power_column, energy, pf
+
+
+def to_seconds(times):
+    """Seconds since epoch from an array of logged time strings, either format"""
+    times = numpy.char.replace(numpy.char.rstrip(times, 'Z'), '/', '-')
+    times = numpy.char.replace(times, ' ', 'T')
+    return times.astype('datetime64[us]').astype(numpy.int64) / 1e6
+
+
+def to_numbers(values):
+    return numpy.where(values == '', 'nan', values).astype(numpy.float64)
+
+
+def read_chunks(path, chunk_rows=CHUNK_ROWS):
+    """Yield dicts of 'time', 'power', 'energy' and 'pf' arrays (energy and pf may be None),
+    and the meter's 'energy_per_power_second'"""
+    if is_binary_log(path):
+        log = BinaryLog(path)
+        names = meter_columns(log.names)
+        units = meter_driver(log.names).energy_per_power_second
+        records = log.array()
+        for start in range(0, len(records), chunk_rows):
+            chunk = records[start:start + chunk_rows]
+            chunk = { key: chunk[name].astype(numpy.float64) if name is not None else None
+                      for key, name in zip(('time', 'power', 'energy', 'pf'), names) }
+            chunk['energy_per_power_second'] = units
+            yield chunk
+        log.close()
+        return
+    with open_log(path) as f:
+        lines = (line.decode('utf-8') for line in f)
+        reader = csv.reader(lines, skipinitialspace=True)
+        headers = next(reader)
+        names = meter_columns(headers)
+        units = meter_driver(headers).energy_per_power_second
+        keys = [key for key, name in zip(('time', 'power', 'energy', 'pf'), names) if name is not None]
+        indexes = [headers.index(name) for name in names if name is not None]
+        select = operator.itemgetter(*indexes)
+        width = max(indexes) + 1
+        while True:
+            batch = list(itertools.islice(reader, chunk_rows))
+            if not batch:
+                break
+            rows = [select(row) for row in batch if len(row) >= width]
+            if not rows:
+                continue
+            columns = numpy.array(rows, dtype=str).T
+            chunk = { 'time': None, 'power': None, 'energy': None, 'pf': None, 'energy_per_power_second': units }
+            for key, values in zip(keys, columns):
+                chunk[key] = to_seconds(values) if key == 'time' else to_numbers(values)
+            yield chunk
+
+
+def add_by_key(totals, keys, values):
+    """Add values into totals (a dict) grouped by keys, one dict update per distinct key"""
+    unique, inverse = numpy.unique(keys, return_inverse=True)
+    sums = numpy.bincount(inverse, weights=values)
+    for key, value in zip(unique.tolist(), sums.tolist()):
+        totals[key] = totals.get(key, 0.0) + value
+
+
+class MeterAnalysis:
+
+    def __init__(self, period=PERIOD, profile_bin=PROFILE_BIN, demand_window=DEMAND_WINDOW,
+                 max_gap=MAX_GAP, rollover=None, pf_bins=PF_BINS, energy_per_power_second=None):
+        self.period = period
+        self.profile_bin = profile_bin
+        self.demand_window = demand_window
+        self.max_gap = max_gap
+        self.rollover = rollover
+        self.pf_bins = pf_bins
+        self.energy_per_power_second = energy_per_power_second     # None for the units of each log's meter
+        self.last = None                # (time, power, energy) of the last reading of the previous chunk
+        self.energy = {}                # period start: energy used
+        self.integrated = {}            # period start: power integrated over time
+        self.profile_sum = numpy.zeros(86400 // profile_bin)
+        self.profile_count = numpy.zeros(86400 // profile_bin)
+        self.demand_sum = {}            # window start: sum and count of power
+        self.demand_count = {}
+        self.pf_counts = numpy.zeros(len(pf_bins) - 1, dtype=numpy.int64)
+        self.readings = 0
+
+    def add(self, chunk):
+        t, power, energy = chunk['time'], chunk['power'], chunk['energy']
+        order = numpy.argsort(t, kind='stable')
+        t, power = t[order], power[order]
+        energy = energy[order] if energy is not None else None
+        self.readings = self.readings + len(t)
+        valid = ~numpy.isnan(power)
+
+        # daily load profile and demand windows
+        bins = ((t % 86400) // self.profile_bin).astype(numpy.int64)
+        self.profile_sum += numpy.bincount(bins[valid], weights=power[valid], minlength=len(self.profile_sum))
+        self.profile_count += numpy.bincount(bins[valid], minlength=len(self.profile_count))
+        windows = t[valid] - t[valid] % self.demand_window
+        add_by_key(self.demand_sum, windows, power[valid])
+        add_by_key(self.demand_count, windows, numpy.ones(len(windows)))
+
+        if chunk['pf'] is not None:
+            pf = chunk['pf'][~numpy.isnan(chunk['pf'])]
+            self.pf_counts += numpy.histogram(pf, self.pf_bins)[0]
+
+        # differences between consecutive readings, including the last of the previous chunk
+        if self.last is not None:
+            t = numpy.concatenate(([self.last[0]], t))
+            power = numpy.concatenate(([self.last[1]], power))
+            if energy is not None:
+                energy = numpy.concatenate(([self.last[2]], energy))
+        if len(t) == 0:
+            return
+        if energy is not None:
+            # a missing reading doesn't lose consumption: each delta is taken from the last
+            # valid counter value, as in rollups.py, carried across chunks too
+            positions = numpy.where(numpy.isnan(energy), 0, numpy.arange(len(energy)))
+            energy = energy[numpy.maximum.accumulate(positions)]
+        self.last = (t[-1], power[-1], energy[-1] if energy is not None else numpy.nan)
+        if len(t) < 2:
+            return
+        dt = numpy.diff(t)
+        periods = t[1:] - t[1:] % self.period
+        units = self.energy_per_power_second or chunk['energy_per_power_second']
+        trapezoids = (power[1:] + power[:-1]) / 2 * dt * units
+        integrate = (dt <= self.max_gap) & ~numpy.isnan(trapezoids)
+        add_by_key(self.integrated, periods[integrate], trapezoids[integrate])
+        if energy is not None:
+            delta = numpy.diff(energy)
+            decrease = delta < 0
+            if self.rollover is not None:
+                wrapped = decrease & (energy[:-1] > self.rollover / 2)
+                delta = numpy.where(wrapped, delta + self.rollover, delta)
+                decrease = decrease & ~wrapped
+            # a meter reset counts from zero
+            delta = numpy.where(decrease, energy[1:], delta)
+            counted = ~numpy.isnan(delta)
+            add_by_key(self.energy, periods[counted], delta[counted])
+
+    def consumption(self):
+        """Rows of (period start, energy used, integrated power, energy / integrated)"""
+        rows = []
+        for start in sorted(set(self.energy) | set(self.integrated)):
+            energy = self.energy.get(start)
+            integrated = self.integrated.get(start)
+            ratio = energy / integrated if energy is not None and integrated else None
+            rows.append((start, energy, integrated, ratio))
+        return rows
+
+    def daily_profile(self):
+        """Rows of (seconds after midnight UTC, mean power)"""
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            means = self.profile_sum / self.profile_count
+        return [(i * self.profile_bin, None if mean != mean else mean) for i, mean in enumerate(means.tolist())]
+
+    def peak_demand(self):
+        """(window start, mean power) of the highest demand window, or None"""
+        if not self.demand_sum:
+            return None
+        starts = numpy.array(list(self.demand_sum.keys()))
+        means = numpy.array(list(self.demand_sum.values())) / numpy.array([self.demand_count[k] for k in self.demand_sum])
+        peak = numpy.argmax(means)
+        return float(starts[peak]), float(means[peak])
+
+    def pf_distribution(self):
+        """Rows of (bin low, bin high, readings)"""
+        return list(zip(self.pf_bins[:-1].tolist(), self.pf_bins[1:].tolist(), self.pf_counts.tolist()))
+
+
+def analyse(paths, **options):
+    analysis = MeterAnalysis(**options)
+    for path in paths:
+        for chunk in read_chunks(path):
+            analysis.add(chunk)
+    return analysis
+
+
+def format_time(seconds):
+    return time.strftime(TIME_FORMAT, time.gmtime(seconds))
+
+
+# starts here
+if __name__ == '__main__':
+    cmd_parser = argparse.ArgumentParser(description='Analyse logged meter readings.')
+    cmd_parser.add_argument('paths', nargs='+', help='log files of one meter, in time order')
+    cmd_parser.add_argument('--report', choices=['consumption', 'profile', 'peak', 'pf'], default='consumption',
+                            help='statistic to print as CSV')
+    cmd_parser.add_argument('--period', type=int, nargs='?', default=PERIOD, help='seconds per consumption period')
+    cmd_parser.add_argument('--rollover', type=float, nargs='?', default=None, help='energy counter modulus, if it wraps')
+    cmd_parser.add_argument('--energy_per_power_second', type=float, nargs='?', default=None,
+                            help="energy units per power unit for one second, the meter's own units by default")
+    args = cmd_parser.parse_args()
+    try:
+        analysis = analyse(args.paths, period=args.period, rollover=args.rollover,
+                           energy_per_power_second=args.energy_per_power_second)
+        output = csv.writer(sys.stdout, lineterminator='\n')
+        if args.report == 'consumption':
+            output.writerow(['Period start', 'Energy', 'Integrated power', 'Ratio'])
+            for start, energy, integrated, ratio in analysis.consumption():
+                output.writerow([format_time(start), energy, integrated, ratio])
+        elif args.report == 'profile':
+            output.writerow(['Time of day', 'Mean power'])
+            for offset, mean in analysis.daily_profile():
+                output.writerow([time.strftime('%H:%M', time.gmtime(offset)), mean])
+        elif args.report == 'peak':
+            output.writerow(['Window start', 'Mean power'])
+            peak = analysis.peak_demand()
+            if peak is not None:
+                output.writerow([format_time(peak[0]), peak[1]])
+        else:
+            output.writerow(['Power factor from', 'Power factor to', 'Readings'])
+            output.writerows(analysis.pf_distribution())
+
+    except (OSError, ValueError):
+        sys.stderr.write('Error reading the log files.\n')
+        sys.exit(1)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# Copyright 2024 Arup
+# MIT License
+
+# Time-range queries over the logged files.
+# Each CSV log file (plain, or compressed by log rotation) gets a sparse side index,
+# <file>.idx, holding the time and byte offset of every INDEX_STRIDE-th row and the time
+# range of the whole file. Indexes are brought up to date incrementally: only the bytes
+# written since the last query are read. A query skips files outside the range, seeks
+# to the indexed row before the start and streams rows until the end, so its cost
+# depends on the size of the answer rather than the size of the archive.
+# Binary logs (binary_log.py), compressed or not, need no index: whole segments outside the
+# range are skipped. Rollup files are queried by the start of each interval.
+# Files are skipped without being opened when their time range, from the rotation manifest
+# or else from their names (each log is named by the time of its first reading, so it ends
+# before the next one starts), lies outside the query, so a compressed archive is only
+# decompressed for the files the answer comes from.
+# Usage: ./log_query.py --start "2024/01/01 12:00:00" --end "2024/01/01 18:00:00"
+#        ./log_query.py --start "2024/01/01 12:00:00" --columns Time,Power --dir /media/usb/kwhmeter
+
+import argparse
+import bisect
+import calendar
+import csv
+import glob
+import gzip
+import lzma
+import os
+import re
+import struct
+import sys
+import time
+from binary_log import BinaryLog, is_binary_log, parse_time
+
+
+LOGDIR = '/media/usb/kwhmeter'
+INDEX_STRIDE = 128            # rows between index entries
+INDEX_MAGIC = b'ESIDX1\n\x00'
+INDEX_HEADER = struct.Struct('<8sQQdd')      # magic, indexed bytes, indexed rows, first time, last time
+INDEX_ENTRY = struct.Struct('<dQ')           # row time, byte offset
+OPENERS = { '.gz': gzip.open, '.xz': lzma.open }
+MANIFEST = 'manifest.csv'
+SKIPPED_FILES = (MANIFEST,)
+FILE_TIME = re.compile(r'(\d{8}-\d{2}\.\d{2}\.\d{2})')     # as in continuous_read.LOGFILE
+FILE_TIME_FORMAT = '%Y%m%d-%H.%M.%S'
+TIME_COLUMNS = ('time', 'timestamp', 'start')    # in order of preference, 'start' for rollup files
+
+
+def open_log(path):
+    return OPENERS.get(os.path.splitext(path)[1], open)(path, 'rb')
+
+
+def time_column(headers):
+    names = [name.lower() for name in headers]
+    for name in TIME_COLUMNS:
+        if name in names:
+            return names.index(name)
+    sys.stderr.write('No time column in log file.\n')
+    raise ValueError()
+
+
+def row_time(line, index):
+    try:
+        values = next(csv.reader([line.decode('utf-8')], skipinitialspace=True))
+        stamp = parse_time(values[index])
+    except (IndexError, StopIteration, UnicodeDecodeError):
+        return None
+    return stamp[0] if stamp is not None else None
+
+
+class LogIndex:
+    """Sparse index of one CSV log file, updated as the file grows"""
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.indexed = 0                # bytes of complete lines indexed
+        self.rows = 0
+        self.first = None
+        self.last = None
+        self.times = []
+        self.offsets = []
+        self.headers = None
+        self.load()
+        self.update()
+
+    def load(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+            magic, indexed, rows, first, last = INDEX_HEADER.unpack_from(data, 0)
+        except (OSError, struct.error):
+            return
+        if magic != INDEX_MAGIC or indexed > os.path.getsize(self.path) and os.path.splitext(self.path)[1] not in OPENERS:
+            return                      # not an index, or the file was replaced: rebuild it
+        self.indexed, self.rows = indexed, rows
+        self.first = first if first == first else None
+        self.last = last if last == last else None
+        for stamp, offset in INDEX_ENTRY.iter_unpack(data[INDEX_HEADER.size:]):
+            self.times.append(stamp)
+            self.offsets.append(offset)
+
+    def save(self):
+        nan = float('nan')
+        with open(self.index_path + '.tmp', 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, self.indexed, self.rows,
+                                      nan if self.first is None else self.first, nan if self.last is None else self.last))
+            f.write(b''.join(INDEX_ENTRY.pack(stamp, offset) for stamp, offset in zip(self.times, self.offsets)))
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def update(self):
+        compressed = os.path.splitext(self.path)[1] in OPENERS
+        with open_log(self.path) as f:
+            self.headers = next(csv.reader([f.readline().decode('utf-8')], skipinitialspace=True))
+            if compressed and self.indexed:
+                return                  # compressed files are closed, so their index is complete
+            if not compressed and os.path.getsize(self.path) == self.indexed:
+                return
+            index = time_column(self.headers)
+            offset = max(self.indexed, f.tell())
+            f.seek(offset)
+            last_line = None
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break               # a partial line still being written
+                if self.rows % INDEX_STRIDE == 0:
+                    stamp = row_time(line, index)
+                    if stamp is not None:
+                        self.times.append(stamp)
+                        self.offsets.append(offset)
+                        if self.first is None:
+                            self.first = stamp
+                self.rows = self.rows + 1
+                offset = offset + len(line)
+                last_line = line
+            if last_line is not None:
+                stamp = row_time(last_line, index)
+                if stamp is not None:
+                    self.last = stamp
+                    if self.first is None:
+                        self.first = stamp
+        if offset != self.indexed:
+            self.indexed = offset
+            try:
+                self.save()
+            except OSError:
+                pass                    # eg a read-only copy of the logs: the index is just not kept
+
+    def seek_offset(self, start):
+        """Byte offset of the indexed row at or before start"""
+        position = bisect.bisect_right(self.times, start) - 1
+        if position < 0:
+            return None
+        return self.offsets[position]
+
+    def rows_between(self, start, end):
+        index = time_column(self.headers)
+        with open_log(self.path) as f:
+            header_end = len(f.readline())
+            offset = self.seek_offset(start) if start is not None else None
+            f.seek(offset if offset is not None else header_end)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                stamp = row_time(line, index)
+                if stamp is None:
+                    continue
+                if end is not None and stamp > end:
+                    break
+                if start is None or stamp >= start:
+                    yield next(csv.reader([line.decode('utf-8')], skipinitialspace=True))
+
+
+def binary_rows_between(log, start, end):
+    """Rows of an open BinaryLog from start to end, closing it when done"""
+    index = time_column(log.names)
+    try:
+        for first_record, count in log.segments():
+            if count == 0:
+                continue
+            size = log.record.size
+            if start is not None and log.record.unpack_from(log.map, first_record + (count - 1) * size)[index] < start:
+                continue
+            if end is not None and log.record.unpack_from(log.map, first_record)[index] > end:
+                break
+            for values in log.record.iter_unpack(log.map[first_record:first_record + count * size]):
+                stamp = values[index]
+                if end is not None and stamp > end:
+                    return
+                if start is None or stamp >= start:
+                    yield log.csv_row(values)
+    finally:
+        log.close()
+
+
+def log_files(directory, pattern='*'):
+    files = []
+    for path in sorted(glob.glob(os.path.join(directory, pattern))):
+        name = os.path.basename(path)
+        if name.endswith('.idx') or name.endswith('.tmp') or name in SKIPPED_FILES or \
+                (pattern == '*' and name.startswith('rollup-')):
+            continue
+        files.append(path)
+    return files
+
+
+def manifest_ranges(directory):
+    """{file name: (first, last)} of the files log rotation has archived in directory"""
+    ranges = {}
+    try:
+        with open(os.path.join(directory, MANIFEST), newline='') as f:
+            for row in csv.reader(f, skipinitialspace=True):
+                first, last = (parse_time(row[1]), parse_time(row[2])) if len(row) > 2 else (None, None)
+                if first is not None and last is not None:
+                    ranges[row[0]] = (first[0], last[0])
+    except OSError:
+        pass
+    return ranges
+
+
+def file_time(path):
+    """Time of the first reading in a log file, from its name, or None"""
+    match = FILE_TIME.match(os.path.basename(path))
+    if match is None:
+        return None
+    return calendar.timegm(time.strptime(match.group(1), FILE_TIME_FORMAT))
+
+
+def file_ranges(paths, manifest):
+    """(first, last) bounds of each file's readings, None where not known. Times in names and
+    the manifest are cut to the second, so the bounds are widened by a second."""
+    firsts = [file_time(path) for path in paths]
+    named = sorted(set(first for first in firsts if first is not None))
+    ranges = []
+    for path, first in zip(paths, firsts):
+        name = os.path.basename(path)
+        if name in manifest:
+            ranges.append((manifest[name][0], manifest[name][1] + 1))
+        elif first is None:
+            ranges.append((None, None))
+        else:
+            # a log ends before the next one starts (a file with a count added to its name
+            # started in the same second, so the next second on is the bound)
+            following = named[bisect.bisect_right(named, first):]
+            ranges.append((first, following[0] + 1 if following else None))
+    return ranges
+
+
+def outside(file_range, start, end):
+    first, last = file_range
+    return (end is not None and first is not None and first > end) or \
+           (start is not None and last is not None and last < start)
+
+
+def query(directory, start=None, end=None, columns=None, pattern='*'):
+    """Yield the header (projected to columns) and then every row from start to end, both
+    seconds since epoch (None for no limit), across the log files in directory"""
+    header = None
+    paths = log_files(directory, pattern)
+    for path, file_range in zip(paths, file_ranges(paths, manifest_ranges(directory))):
+        if outside(file_range, start, end):
+            continue
+        if is_binary_log(path):
+            log = BinaryLog(path)
+            headers = log.names
+            rows = binary_rows_between(log, start, end)
+        else:
+            try:
+                log_index = LogIndex(path)
+            except (OSError, ValueError, StopIteration):
+                sys.stderr.write(f"Couldn't index {path}: skipped.\n")
+                continue
+            if log_index.first is None or (end is not None and log_index.first > end) or \
+                    (start is not None and log_index.last < start):
+                continue
+            headers = log_index.headers
+            rows = log_index.rows_between(start, end)
+        selection = [headers.index(column) for column in columns if column in headers] if columns else None
+        projected = [headers[i] for i in selection] if selection is not None else headers
+        if projected != header:
+            header = projected
+            yield header
+        for row in rows:
+            yield [row[i] for i in selection] if selection is not None else row
+
+
+def parse_time_argument(value):
+    stamp = parse_time(value)
+    if stamp is None:
+        raise argparse.ArgumentTypeError(f'expected "YYYY/MM/DD HH:MM:SS" or ISO time, got {value}')
+    return stamp[0]
+
+
+# starts here
+if __name__ == '__main__':
+    cmd_parser = argparse.ArgumentParser(description='Print logged readings between two times as CSV.')
+    cmd_parser.add_argument('--start', type=parse_time_argument, default=None, help='first time, UTC "YYYY/MM/DD HH:MM:SS"')
+    cmd_parser.add_argument('--end', type=parse_time_argument, default=None, help='last time, UTC "YYYY/MM/DD HH:MM:SS"')
+    cmd_parser.add_argument('--columns', nargs='?', default=None, help='comma separated columns to print, all by default')
+    cmd_parser.add_argument('--dir', nargs='?', default=LOGDIR, help='log directory')
+    cmd_parser.add_argument('--files', nargs='?', default='*', help='glob of log files to search, eg "rollup-15m.csv"')
+    args = cmd_parser.parse_args()
+    try:
+        output = csv.writer(sys.stdout, lineterminator='\n')
+        for row in query(args.dir, args.start, args.end, args.columns.split(',') if args.columns else None, args.files):
+            output.writerow(row)
+
+    except BrokenPipeError:
+        sys.exit(0)
+    except (OSError, ValueError):
+        sys.stderr.write('Error reading the log files.\n')
+        sys.exit(1)
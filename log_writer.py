@@ -0,0 +1,341 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Background log writer for the acquisition loop.
+# Records are put on a bounded queue and collected by a separate thread into a spool in
+# RAM, so a slow write or fsync on cheap USB flash (which can take seconds) cannot push
+# the next reading past its time slot. The durability policy says when the spool is
+# written to the log file in one sequential batch and fsync'd: after a number of
+# records, a number of bytes or a number of seconds, whichever comes first (None
+# disables that trigger).
+# If the log directory goes missing or a write fails (eg the USB stick is pulled or
+# remounting) the file is closed and records stay in the spool, up to spool_size bytes
+# (the oldest are dropped beyond that). The file is reopened every retry_seconds and
+# the spool drained once the stick is back, so no readings are lost during a swap.
+# A new file gets the header line first. With log_format 'binary' records are packed into
+# a binary log instead (see binary_log.py), its columns named by the header line and typed
+# by column_types.
+# The path may hold strftime fields, filled in with the UTC time of the first record in
+# the file. With rotate 'hourly' or 'daily' a new file is started at each boundary (by the
+# time each record was written, so spooled records still land in the right file), and
+# with rotate_bytes once a file reaches that size. Closed files are handed to a
+# SegmentArchiver thread running at low priority, which compresses them with gzip or xz
+# and appends their name, time range and record count to a manifest.csv beside them.
+# write() never blocks: if the queue is full the record is dropped and counted.
+# A writer given previous, a writer whose thread has died, carries on from it: it keeps
+# the same file, spool and archiver and takes over any records still on its queue.
+# stats() reports the queue depth, spool fill, fsync latency and dropped records.
+
+import collections
+import gzip
+import lzma
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+
+
+LOG_QUEUE_SIZE = 1000         # records held between the acquisition loop and the writer thread
+SPOOL_SIZE = 4 * 1024 * 1024  # bytes held in RAM while the log file can't be written
+RETRY_SECONDS = 5.0           # seconds between attempts to reopen a missing log file
+FLUSH_RECORDS = 10            # write the spool out after this many records
+FLUSH_BYTES = None            # or after this many bytes
+FLUSH_SECONDS = None          # or after this many seconds
+ROTATE_PERIODS = { None: None, 'hourly': 3600, 'daily': 86400 }
+COMPRESSORS = { 'gzip': ('.gz', gzip.open), 'xz': ('.xz', lzma.open) }
+MANIFEST = 'manifest.csv'
+TIME_FORMAT = '%Y/%m/%d %H:%M:%S'
+
+
+class SegmentArchiver(threading.Thread):
+    """Compresses closed log files in the background and records them in the manifest"""
+
+    def __init__(self, compression='gzip'):
+        super().__init__(daemon=True)
+        if compression is not None and compression not in COMPRESSORS:
+            sys.stderr.write(f'No compression called {compression}.\n')
+            raise ValueError()
+        self.compression = compression
+        self.segments = queue.Queue()
+        self.archived = 0
+        self.start()
+
+    def archive(self, path, first, last, records):
+        self.segments.put((path, first, last, records))
+
+    def compress(self, path):
+        extension, open_compressed = COMPRESSORS[self.compression]
+        # written under a temporary name so a partial archive is never mistaken for a whole one
+        with open(path, 'rb') as source, open_compressed(path + extension + '.tmp', 'wb') as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        with open(path + extension + '.tmp', 'rb') as target:
+            os.fsync(target.fileno())
+        os.replace(path + extension + '.tmp', path + extension)
+        os.remove(path)
+        if os.path.exists(path + '.idx'):
+            os.remove(path + '.idx')    # a log_query.py index of the uncompressed file
+        return path + extension
+
+    def write_manifest(self, path, first, last, records):
+        manifest = os.path.join(os.path.dirname(path), MANIFEST)
+        new_file = not os.path.exists(manifest)
+        with open(manifest, 'a') as f:
+            if new_file:
+                f.write('"Segment","First","Last","Records","Bytes"\n')
+            f.write(f'"{os.path.basename(path)}","{time.strftime(TIME_FORMAT, time.gmtime(first))}",'
+                    f'"{time.strftime(TIME_FORMAT, time.gmtime(last))}",{records},{os.path.getsize(path)}\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def run(self):
+        try:
+            # compression must never take CPU from acquisition (Linux sets priority per thread)
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            segment = self.segments.get()
+            if segment is None:
+                break
+            path, first, last, records = segment
+            try:
+                if self.compression is not None:
+                    path = self.compress(path)
+                self.write_manifest(path, first, last, records)
+                self.archived = self.archived + 1
+            except OSError as e:
+                # eg the USB stick was pulled: the file is left as it is
+                sys.stderr.write(f"Couldn't archive {path}: {e}\n")
+
+    def close(self):
+        if self.is_alive():
+            self.segments.put(None)
+            self.join()
+
+
+class LogWriter(threading.Thread):
+
+    def __init__(self, path, header=None, flush_records=FLUSH_RECORDS, flush_bytes=FLUSH_BYTES,
+                 flush_seconds=FLUSH_SECONDS, spool_size=SPOOL_SIZE, retry_seconds=RETRY_SECONDS,
+                 queue_size=LOG_QUEUE_SIZE, log_format='csv', rotate=None, rotate_bytes=None, compression=None,
+                 previous=None, column_types=None):
+        super().__init__(daemon=True)
+        if rotate not in ROTATE_PERIODS:
+            sys.stderr.write(f'No log rotation called {rotate}.\n')
+            raise ValueError()
+        self.path = path
+        self.header = header
+        self.log_format = log_format
+        self.column_types = column_types
+        self.rotate_period = ROTATE_PERIODS[rotate]
+        self.rotate_bytes = rotate_bytes
+        if previous is not None and previous.archiver is not None and previous.archiver.is_alive():
+            self.archiver = previous.archiver   # may still be compressing files the previous writer closed
+        else:
+            self.archiver = SegmentArchiver(compression) if rotate is not None or rotate_bytes is not None else None
+        self.file_path = None           # path of the current file, kept while the stick is missing
+        self.file_period = None         # rotation period the current file belongs to
+        self.file_first = None          # time of the first and last records in the current file
+        self.file_last = None
+        self.file_records = 0
+        self.closed_paths = collections.deque(maxlen=16)
+        self.flush_records = flush_records
+        self.flush_bytes = flush_bytes
+        self.flush_seconds = flush_seconds
+        self.spool_size = spool_size
+        self.retry_seconds = retry_seconds
+        self.records = queue.Queue(queue_size)
+        self.file = None
+        self.spool = collections.deque()
+        self.spool_bytes = 0
+        self.spool_since = None         # monotonic time of the oldest record in the spool
+        self.detached = False           # True while the log file can't be written
+        self.next_retry = 0.0
+        self.dropped = 0                # records lost because the queue or spool was full
+        self.written = 0
+        self.fsyncs = 0
+        self.fsync_time = None          # seconds taken by the last batch write and fsync
+        self.max_fsync_time = 0.0
+        if previous is not None:
+            self.take_over(previous)
+        self.start()
+
+    def take_over(self, previous):
+        # called before the thread starts, from the thread that calls write()
+        try:
+            if previous.file is not None:
+                previous.file.close()
+        except:
+            pass
+        self.file_path = previous.file_path
+        self.file_period = previous.file_period
+        self.file_first = previous.file_first
+        self.file_last = previous.file_last
+        self.file_records = previous.file_records
+        self.closed_paths = previous.closed_paths
+        self.dropped = previous.dropped
+        self.written = previous.written
+        for stamp, record in previous.spool:
+            self.add(stamp, record)
+        while True:
+            try:
+                entry = previous.records.get_nowait()
+            except queue.Empty:
+                break
+            if entry is not None:
+                self.add(*entry)
+
+    def write(self, record):
+        try:
+            self.records.put_nowait((time.time(), record))
+        except queue.Full:
+            self.dropped = self.dropped + 1
+            sys.stderr.write('Log writer queue full: record dropped.\n')
+
+    def spool_fill(self):
+        """Fraction of the spool in use, 0.0 to 1.0"""
+        return min(self.spool_bytes / self.spool_size, 1.0)
+
+    def add(self, stamp, record):
+        if not self.spool:
+            self.spool_since = time.monotonic()
+        self.spool.append((stamp, record))
+        self.spool_bytes = self.spool_bytes + len(record)
+        while self.spool_bytes > self.spool_size and len(self.spool) > 1:
+            self.spool_bytes = self.spool_bytes - len(self.spool.popleft()[1])
+            self.dropped = self.dropped + 1
+
+    def period(self, stamp):
+        if self.rotate_period is None:
+            return None
+        return int(stamp // self.rotate_period)
+
+    def flush_due(self):
+        return (self.flush_records is not None and len(self.spool) >= self.flush_records) or \
+            (self.flush_bytes is not None and self.spool_bytes >= self.flush_bytes) or \
+            (self.flush_seconds is not None and time.monotonic() - self.spool_since >= self.flush_seconds)
+
+    def open_file(self, stamp):
+        if self.file_path is None:
+            # a new file, named by the time of its first record, with a count added if a file
+            # closed by size in the same second already has that name
+            path = time.strftime(self.path, time.gmtime(stamp))
+            root, extension = os.path.splitext(path)
+            count = 0
+            while path in self.closed_paths:
+                count = count + 1
+                path = f'{root}-{count}{extension}'
+            self.file_path = path
+            self.file_period = self.period(stamp)
+            self.file_first = stamp
+            self.file_records = 0
+        directory = os.path.dirname(self.file_path) or '.'
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(f'{directory} not found')
+        if self.log_format == 'binary':
+            from binary_log import BinaryLogFile
+            self.file = BinaryLogFile(self.file_path, self.header, column_types=self.column_types)
+            return
+        new_file = not os.path.exists(self.file_path)
+        self.file = open(self.file_path, 'a')
+        if new_file and self.header is not None:
+            self.file.write(self.header)
+
+    def close_file(self):
+        """Close the current file for good and hand it to the archiver"""
+        self.file.close()
+        self.file = None
+        self.closed_paths.append(self.file_path)
+        if self.archiver is not None and self.file_records:
+            self.archiver.archive(self.file_path, self.file_first, self.file_last, self.file_records)
+        self.file_path = None
+
+    def drain(self):
+        """Write the whole spool to the log file in one batch per file and fsync it"""
+        if self.detached and time.monotonic() < self.next_retry:
+            return
+        try:
+            start = time.monotonic()
+            while self.spool:
+                period = self.period(self.spool[0][0])
+                if self.file is not None and period != self.file_period:
+                    self.close_file()
+                if self.file is None:
+                    self.open_file(self.spool[0][0])
+                batch = []
+                for stamp, record in self.spool:
+                    if self.period(stamp) != period:
+                        break
+                    batch.append(record)
+                self.file.write(''.join(batch))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                for record in batch:
+                    self.file_last = self.spool.popleft()[0]
+                    self.spool_bytes = self.spool_bytes - len(record)
+                self.file_records = self.file_records + len(batch)
+                self.written = self.written + len(batch)
+                if self.rotate_bytes is not None and os.path.getsize(self.file_path) >= self.rotate_bytes:
+                    self.close_file()
+        except OSError as e:
+            if not self.detached:
+                sys.stderr.write(f'Error writing the log file, spooling readings: {e}\n')
+            self.detached = True
+            self.next_retry = time.monotonic() + self.retry_seconds
+            try:
+                if self.file is not None:
+                    self.file.close()
+            except OSError:
+                pass
+            self.file = None
+            return
+        if self.detached:
+            sys.stderr.write('Log file written again after spooling readings.\n')
+            self.detached = False
+        self.fsync_time = time.monotonic() - start
+        self.max_fsync_time = max(self.max_fsync_time, self.fsync_time)
+        self.fsyncs = self.fsyncs + 1
+
+    def run(self):
+        while True:
+            # wake up in time to retry the file or honour flush_seconds even when no records arrive
+            timeout = None
+            if self.detached and self.spool:
+                timeout = max(self.next_retry - time.monotonic(), 0)
+            elif self.flush_seconds is not None and self.spool:
+                timeout = max(self.spool_since + self.flush_seconds - time.monotonic(), 0)
+            try:
+                entry = self.records.get(timeout=timeout)
+            except queue.Empty:
+                entry = (None, '')
+            if entry is None:
+                if self.spool:
+                    self.next_retry = 0.0
+                    self.drain()
+                break
+            stamp, record = entry
+            if record:
+                self.add(stamp, record)
+            if self.spool and (self.detached or self.flush_due()):
+                self.drain()
+
+    def close(self):
+        """Write out everything queued and spooled if possible, then close the file"""
+        if self.is_alive():
+            self.records.put(None)
+            self.join()
+        try:
+            if self.file is not None:
+                self.close_file()
+        except OSError:
+            pass
+        if self.archiver is not None:
+            self.archiver.close()
+
+    def stats(self):
+        return { 'queue_depth': self.records.qsize(), 'spool_records': len(self.spool), 'spool_bytes': self.spool_bytes,
+                 'spool_fill': self.spool_fill(), 'detached': self.detached, 'written': self.written,
+                 'dropped': self.dropped, 'fsyncs': self.fsyncs, 'fsync_time': self.fsync_time,
+                 'max_fsync_time': self.max_fsync_time }
@@ -0,0 +1,262 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Persistent in-process acquisition drivers for continuous_read.py.
+# Each driver finds and opens its serial port once and keeps the configured instrument
+# warm between readings, instead of a new acquisition process per sample.
+# read_line() returns one CSV line in the same format the acquisition program writes
+# to stdout. If a read fails the port is closed and ConnectionError raised; the next
+# read_line() finds and reopens the port, so a temporary disconnection recovers as before.
+# Driver modules are imported on first connect so that eg a CC128 installation does not
+# need minimalmodbus. Modbus drivers given arbiter (the socket of rs485_arbiter.py) send
+# their reads through the arbiter daemon instead of opening the serial port themselves.
+
+import csv
+import io
+import os
+import select
+import subprocess
+import sys
+import time
+from register_decoder import log_column_type
+
+
+AUTO_BAUD = True              # find the meter's baud rate on connect
+UPGRADE_BAUD = False          # also switch a DDS238 to its fastest rate on connect: writes the meter's configuration
+
+
+class MeterDriver:
+    name = None
+    csv_headers = None
+    column_types = None           # binary_log.py type of each column, see register_decoder.log_column_type()
+    power_column = None           # columns rolled up into interval statistics, see rollups.py
+    energy_column = None
+    pf_column = None
+    energy_per_power_second = 1 / 3600   # energy units per power unit for one second, kWh per kW here
+
+    def __init__(self, arbiter=None):
+        self.instrument = None
+        self.port = None
+        self.arbiter = arbiter
+        self.cache = {}                 # last good value of each field, see register_decoder.read_blocks()
+
+    def connect(self):
+        raise NotImplementedError
+
+    def connect_arbiter(self, address):
+        from rs485_arbiter import ArbiterClient, ArbiterInstrument
+        self.port = self.arbiter
+        self.instrument = ArbiterInstrument(ArbiterClient(self.arbiter), address)
+
+    def read(self):
+        raise NotImplementedError
+
+    def close(self):
+        if self.instrument is not None:
+            try:
+                self.serial().close()
+            except:
+                pass
+        self.instrument = None
+
+    def serial(self):
+        return self.instrument.serial
+
+    def read_line(self):
+        try:
+            if self.instrument is None:
+                self.connect()
+            return self.read()
+        except ConnectionError:
+            self.close()
+            raise
+        except:
+            sys.stderr.write(f'Failed to read {self.name} meter.\n')
+            self.close()
+            raise ConnectionError('Modbus error')
+
+
+class IEM2150Driver(MeterDriver):
+    name = 'iem2150'
+    csv_headers = '"Time","Voltage","Current","Power","Reactive power","Power factor","Power factor direction","Frequency","Cumulative energy","Quality"'
+    column_types = ['time', 'f4', 'f4', 'f4', 'f4', 'f4', 'text7', 'f4', 'f4', 'text8']     # a quality code per register
+    power_column = 'Power'
+    energy_column = 'Cumulative energy'
+    pf_column = 'Power factor'
+
+    def connect(self):
+        import schneider_iEM2150
+        self.module = schneider_iEM2150
+        if self.arbiter is not None:
+            self.connect_arbiter(self.module.MODBUS_ADDRESS)
+            return
+        self.port = self.module.find_serial_device()
+        self.instrument = self.module.configure(self.port)
+        if AUTO_BAUD:
+            self.module.negotiate_baudrate(self.instrument)
+
+    def read(self):
+        return self.module.format_csv_readings(*self.module.get_readings(self.instrument, self.cache)) + '\n'
+
+
+class DDS238Driver(MeterDriver):
+    name = 'dds238'
+    csv_headers = '"Time","Voltage","Current","Power","Reactive power","Power factor","Frequency","Cumulative energy","Quality"'
+    column_types = ['time', 'f4', 'f4', 'f4', 'f4', 'f4', 'f4', 'f8', 'text7']            # a quality code per register
+    power_column = 'Power'
+    energy_column = 'Cumulative energy'
+    pf_column = 'Power factor'
+    energy_per_power_second = 1 / 3600000   # power in W, energy in kWh
+
+    def connect(self):
+        import hiking_dds238_2
+        self.module = hiking_dds238_2
+        if self.arbiter is not None:
+            self.connect_arbiter(1)
+            return
+        self.port = self.module.find_serial_device()
+        self.instrument = self.module.configure(self.port)
+        if UPGRADE_BAUD:
+            self.module.upgrade_baudrate(self.instrument)
+        elif AUTO_BAUD:
+            self.module.negotiate_baudrate(self.instrument)
+
+    def read(self):
+        return self.module.csv_readings(self.instrument, self.port, self.cache)
+
+
+class PM5100Driver(MeterDriver):
+    name = 'pm5100'
+    power_column = 'total_power_sensor'
+    energy_column = 'total_energy_accumulator'
+    pf_column = 'total_power_factor_sensor'
+    energy_per_power_second = 1000 / 3600   # power in kW, energy in Wh
+
+    def __init__(self, device_address=1, baudrate=9600, arbiter=None, fast_energy=False):
+        super().__init__(arbiter)
+        import schneider_PM5100
+        self.module = schneider_PM5100
+        self.device_address = device_address
+        self.baudrate = baudrate
+        self.register_map = self.module.PM5100_REGISTER_MAP
+        if fast_energy:
+            # rollups credit energy to the interval it is read in, so it is read every tick
+            # rather than in a lump every POLL_SLOW ticks
+            self.register_map = { k:spec[:3] + (self.module.POLL_FAST,) if k == self.energy_column else spec
+                                  for k, spec in self.register_map.items() }
+        # identity and slow registers are cached across readings, see get_tiered_readings()
+        self.tick = 0
+        self.cache = {}
+        self.plans = {}
+        self.csv_headers = ','.join(f'"{k}"' for k in list(self.module.PM5100_REGISTER_MAP.keys()) + ['timestamp'])
+        self.column_types = [log_column_type(k, spec[2]) for k, spec in self.module.PM5100_REGISTER_MAP.items()] + ['isotimez']
+
+    def connect(self):
+        if self.arbiter is not None:
+            self.connect_arbiter(self.device_address)
+        else:
+            self.port = self.module.find_serial_device()
+            self.instrument = self.module.configure(self.port, self.device_address, self.baudrate)
+            if AUTO_BAUD:
+                self.module.negotiate_baudrate(self.instrument)
+        # a reconnected meter may have been swapped, so re-read its identity
+        self.tick = 0
+
+    def read(self):
+        readings = self.module.get_tiered_readings(self.instrument, self.register_map,
+                                                   self.tick, self.cache, plans=self.plans)
+        self.tick = self.tick + 1
+        output = io.StringIO()
+        csv.writer(output, lineterminator='\n').writerow(readings.values())
+        return output.getvalue()
+
+
+class CC128Driver(MeterDriver):
+    name = 'cc128'
+    csv_headers = '"Time", "Watts #1", "Watts #2", "Watts #3", "Watts #4", "Watts #5", "Watts #6", "Watts #7", "Watts #8", "Watts #9"'
+    column_types = ['time'] + ['f4'] * 9
+    power_column = 'Watts #1'
+    energy_per_power_second = 1 / 3600000   # power in W, integrated as kWh
+
+    def __init__(self, arbiter=None, on_history=None):
+        super().__init__(arbiter)
+        self.on_history = on_history    # given the periods of each history message, see backfill.py
+
+    def connect(self):
+        import current_cost
+        self.module = current_cost
+        try:
+            # parses the base station's messages on its own thread into a table of sensor readings
+            self.instrument = self.module.CC128Reader(on_history=self.on_history)
+        except:
+            sys.stderr.write("Couldn't open serial interface.\n")
+            raise ConnectionError('Serial error')
+        self.port = self.instrument.port
+
+    def serial(self):
+        return self.instrument
+
+    def read(self):
+        output = io.StringIO()
+        csv.writer(output, quoting=csv.QUOTE_NONNUMERIC).writerow(self.instrument.snapshot())
+        return output.getvalue()
+
+
+class StreamDriver(MeterDriver):
+    """Runs an acquisition program once with --stream and reads its output continuously.
+    A child that exits, or writes nothing for watchdog seconds, is killed and restarted on
+    the next read_line()."""
+    name = 'stream'
+
+    def __init__(self, program, interval, csv_headers, watchdog=None):
+        super().__init__()
+        self.program = program
+        self.interval = interval
+        self.csv_headers = csv_headers
+        self.watchdog = watchdog if watchdog is not None else 3 * interval
+        self.buffer = b''
+
+    def connect(self):
+        try:
+            self.instrument = subprocess.Popen([self.program, '--stream', '--interval', str(self.interval)],
+                                               stdout=subprocess.PIPE, bufsize=0)
+        except OSError:
+            sys.stderr.write("Problem running acquisition sub-process.\n")
+            raise ConnectionError()
+        self.port = self.program
+        self.buffer = b''
+
+    def close(self):
+        if self.instrument is not None:
+            self.instrument.kill()
+            self.instrument.wait()
+            self.instrument.stdout.close()
+        self.instrument = None
+
+    def read(self):
+        # wait for at least one complete line, then return every complete line received
+        deadline = time.monotonic() + self.watchdog
+        while b'\n' not in self.buffer:
+            remaining = deadline - time.monotonic()
+            ready, _, _ = select.select([self.instrument.stdout], [], [], max(remaining, 0))
+            if not ready:
+                sys.stderr.write("Acquisition sub-process stalled: restarting.\n")
+                raise ConnectionError()
+            data = os.read(self.instrument.stdout.fileno(), 4096)
+            if not data:
+                sys.stderr.write("Acquisition sub-process exited: restarting.\n")
+                raise ConnectionError()
+            self.buffer = self.buffer + data
+        lines, _, self.buffer = self.buffer.rpartition(b'\n')
+        return lines.decode('utf-8') + '\n'
+
+
+DRIVERS = { driver.name:driver for driver in (IEM2150Driver, DDS238Driver, PM5100Driver, CC128Driver) }
+
+
+def load_driver(name, **options):
+    try:
+        return DRIVERS[name](**options)
+    except KeyError:
+        sys.stderr.write(f'No acquisition driver called {name}.\n')
+        raise ValueError()
@@ -0,0 +1,294 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Lean Modbus RTU transactions on an open pyserial port, for the meter drivers.
+# Every request a driver sends is constant (eg 01 03 0b d3 00 02 37 d6 for the iEM2150
+# voltage), so request frames are built with their CRC once per (slave, function,
+# register, count) and cached, and the response unpacking struct is cached per register
+# count. Responses are checked with a table-driven CRC-16 (the CRC of a frame including
+# its own CRC is zero) and read with exactly the expected length: the first 5 bytes tell
+# an exception response (5 bytes in all) from a normal one, then the rest is read in one
+# call. Before each request the line is kept idle for the 3.5 character inter-frame gap
+# (1.75 ms above 19200 baud), timed from the end of the previous transaction.
+# RtuInstrument has the minimalmodbus Instrument methods the drivers use and a serial
+# attribute, so configure() can return either. Instruments on the same port share the
+# port and its gap timing, as minimalmodbus instruments do.
+# Errors raise ConnectionError; callers report them.
+# Timeouts adapt to each meter: the turnaround of every response (the time taken less
+# the time the bytes spend on the wire) is kept for the last LATENCY_SAMPLES transactions,
+# and once there are MIN_SAMPLES the timeout is TIMEOUT_MARGIN times the
+# TIMEOUT_PERCENTILE turnaround plus the response's time on the wire, between
+# MIN_TIMEOUT and the configured timeout. A transaction that times out counts as a
+# turnaround of the timeout used, so a meter that has become slower soon gets a longer
+# timeout, while the odd lost reply on a noisy bus doesn't move the percentile.
+# The adaptive timeout is the wait for the first byte of the response, done with select()
+# on the port, so the port's own timeout (and its termios settings) is set once when it is
+# opened rather than on every transaction. Ports that can't be waited on (eg on Windows)
+# have their timeout changed instead, when it differs.
+# find_baudrate() detects the fastest rate every meter on a port answers at, and
+# upgrade_baudrate() also switches meters that can be told a new rate to the fastest they
+# all support, falling back to a rate that works if they stop answering. The rate found
+# is kept for the port, so a reconnect starts at it.
+# requires serial library: sudo pip3 install pyserial
+
+import collections
+import functools
+import select
+import struct
+import threading
+import time
+import serial
+
+
+BAUDRATE = 9600
+TIMEOUT = 0.5                 # seconds to wait for a response
+CHARACTER_BITS = 11           # start, 8 data, parity or second stop, stop bits per character
+MIN_FRAME_GAP = 0.00175       # 3.5 characters is fixed at 1.75 ms above 19200 baud
+EXCEPTION_LENGTH = 5          # slave, function | 0x80, exception code, CRC
+LINE_BITS = 10                # bits on the wire per byte at 8N1
+LATENCY_SAMPLES = 100         # turnarounds kept per meter
+MIN_SAMPLES = 10              # turnarounds needed before the timeout adapts
+TIMEOUT_PERCENTILE = 95
+TIMEOUT_MARGIN = 2.0
+MIN_TIMEOUT = 0.05            # shortest adaptive timeout, in seconds
+BAUDRATES = (38400, 19200, 9600, 4800, 2400, 1200)
+
+
+def crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+CRC_TABLE = crc_table()
+
+
+def crc16(data):
+    """Modbus CRC-16 of data, using the precomputed table"""
+    crc = 0xFFFF
+    table = CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def with_crc(frame):
+    return frame + struct.pack('<H', crc16(frame))
+
+
+@functools.lru_cache(maxsize=None)
+def read_request(slave, function, register, count):
+    """The complete request frame for reading count registers, built once"""
+    return with_crc(struct.pack('>BBHH', slave, function, register, count))
+
+
+@functools.lru_cache(maxsize=None)
+def words_struct(count):
+    return struct.Struct(f'>{count}H')
+
+
+def wire_time(length, baudrate):
+    return length * LINE_BITS / baudrate
+
+
+def frame_gap(baudrate):
+    """Seconds of silence that must separate two frames at baudrate"""
+    return 3.5 * CHARACTER_BITS / baudrate if baudrate <= 19200 else MIN_FRAME_GAP
+
+
+class RtuBus:
+    """One open serial port shared by the instruments on it"""
+
+    def __init__(self, port, baudrate=BAUDRATE, timeout=TIMEOUT):
+        self.port = port
+        self.serial = serial.Serial(port, baudrate, bytesize=8, parity=serial.PARITY_NONE, stopbits=1, timeout=timeout)
+        self.lock = threading.Lock()
+        self.idle_since = 0.0           # monotonic time the line last went quiet
+
+    def fileno(self):
+        """The port's file descriptor to wait on, or None"""
+        try:
+            return self.serial.fileno()
+        except Exception:
+            return None
+
+    def transaction(self, request, response_length, timeout=None, latencies=None):
+        """Send a request frame and return the complete, CRC-checked response frame. The
+        turnaround, or the timeout if there was no reply, is appended to latencies."""
+        with self.lock:
+            baudrate = self.serial.baudrate
+            wait = self.idle_since + frame_gap(baudrate) - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                fd = self.fileno() if timeout is not None else None
+                if fd is None and timeout is not None and timeout != self.serial.timeout:
+                    self.serial.timeout = timeout
+                sent = time.monotonic()
+                # a late reply to an earlier request must not be taken for this one
+                if self.serial.in_waiting:
+                    self.serial.reset_input_buffer()
+                self.serial.write(request)
+                if fd is not None and not select.select([fd], [], [], max(sent + timeout - time.monotonic(), 0))[0]:
+                    response = b''
+                else:
+                    response = self.serial.read(EXCEPTION_LENGTH)
+                if len(response) == EXCEPTION_LENGTH and not response[1] & 0x80:
+                    response = response + self.serial.read(response_length - EXCEPTION_LENGTH)
+            except (OSError, serial.SerialException) as e:
+                raise ConnectionError(f'Serial error: {e}')
+            finally:
+                finished = self.idle_since = time.monotonic()
+        complete = len(response) == (EXCEPTION_LENGTH if response[1:2] and response[1] & 0x80 else response_length)
+        if latencies is not None:
+            if complete:
+                latencies.append(finished - sent - wire_time(len(request) + len(response), baudrate))
+            else:
+                latencies.append(timeout if timeout is not None else self.serial.timeout)
+        if not response:
+            raise ConnectionError('No response')
+        if not complete:
+            raise ConnectionError('Incomplete response')
+        if crc16(response) != 0:
+            raise ConnectionError('Response CRC error')
+        if response[0] != request[0]:
+            raise ConnectionError('Response from the wrong slave')
+        if response[1] & 0x80:
+            raise ConnectionError(f'Modbus exception {response[2]}')
+        if response[1] != request[1]:
+            raise ConnectionError('Unexpected response')
+        return response
+
+
+BUSES = {}                    # port: RtuBus
+BUSES_LOCK = threading.Lock()
+PORT_BAUDRATES = {}           # port: rate found by find_baudrate() or upgrade_baudrate()
+
+
+def open_bus(port, baudrate=BAUDRATE, timeout=TIMEOUT):
+    """The shared bus for port, opening (or reopening after close) the serial port"""
+    with BUSES_LOCK:
+        bus = BUSES.get(port)
+        if bus is None or not bus.serial.is_open:
+            bus = RtuBus(port, PORT_BAUDRATES.get(port, baudrate), timeout)
+            BUSES[port] = bus
+        return bus
+
+
+class RtuInstrument:
+    """The minimalmodbus Instrument methods used by the drivers, on a shared RtuBus"""
+
+    def __init__(self, port, slaveaddress, baudrate=BAUDRATE, timeout=TIMEOUT):
+        self.address = slaveaddress
+        self.bus = open_bus(port, baudrate, timeout)
+        self.serial = self.bus.serial
+        self.max_timeout = timeout
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def timeout(self, response_length):
+        """Seconds to wait for a response of response_length bytes from this meter"""
+        if len(self.latencies) < MIN_SAMPLES:
+            return self.max_timeout
+        turnaround = sorted(self.latencies)[(len(self.latencies) - 1) * TIMEOUT_PERCENTILE // 100]
+        timeout = TIMEOUT_MARGIN * turnaround + wire_time(response_length, self.serial.baudrate)
+        return min(max(timeout, MIN_TIMEOUT), self.max_timeout)
+
+    def transaction(self, request, response_length):
+        return self.bus.transaction(request, response_length, self.timeout(response_length), self.latencies)
+
+    def read_registers(self, registeraddress, number_of_registers, functioncode=3):
+        request = read_request(self.address, functioncode, registeraddress, number_of_registers)
+        response = self.transaction(request, 5 + 2 * number_of_registers)
+        if response[2] != 2 * number_of_registers:
+            raise ConnectionError('Unexpected response length')
+        return list(words_struct(number_of_registers).unpack_from(response, 3))
+
+    def read_register(self, registeraddress, number_of_decimals=0, functioncode=3, signed=False):
+        value = self.read_registers(registeraddress, 1, functioncode)[0]
+        if signed and value >= 0x8000:
+            value = value - 0x10000
+        return value / 10 ** number_of_decimals if number_of_decimals else value
+
+    def read_long(self, registeraddress, functioncode=3, signed=False):
+        high, low = self.read_registers(registeraddress, 2, functioncode)
+        return struct.unpack('>i' if signed else '>I', struct.pack('>HH', high, low))[0]
+
+    def read_float(self, registeraddress, functioncode=3, number_of_registers=2):
+        words = self.read_registers(registeraddress, number_of_registers, functioncode)
+        return struct.unpack('>f' if number_of_registers == 2 else '>d', words_struct(number_of_registers).pack(*words))[0]
+
+    def read_string(self, registeraddress, number_of_registers=16, functioncode=3):
+        words = self.read_registers(registeraddress, number_of_registers, functioncode)
+        return words_struct(number_of_registers).pack(*words).decode('latin-1')
+
+    def write_registers(self, registeraddress, values):
+        count = len(values)
+        request = with_crc(struct.pack(f'>BBHHB{count}H', self.address, 16, registeraddress, count, 2 * count, *values))
+        response = self.transaction(request, 8)
+        if response[2:6] != request[2:6]:
+            raise ConnectionError('Unexpected response')
+
+    def write_register(self, registeraddress, value, number_of_decimals=0, functioncode=16, signed=False):
+        value = int(round(value * 10 ** number_of_decimals)) & 0xFFFF
+        if functioncode == 6:
+            request = with_crc(struct.pack('>BBHH', self.address, 6, registeraddress, value))
+            if self.transaction(request, 8) != request:
+                raise ConnectionError('Unexpected response')
+        else:
+            self.write_registers(registeraddress, [value])
+
+
+def answers(probes):
+    try:
+        for probe in probes:
+            probe()
+        return True
+    except Exception:
+        return False
+
+
+def find_baudrate(serial_port, probes, baudrates=BAUDRATES):
+    """Set serial_port to a rate at which every probe (a read from each meter on the port)
+    succeeds, trying the current rate first and then the others fastest first. Returns the
+    rate, or raises ConnectionError with the port back at its original rate."""
+    original = serial_port.baudrate
+    for baudrate in [original] + sorted(set(baudrates) - {original}, reverse=True):
+        serial_port.baudrate = baudrate
+        if answers(probes):
+            PORT_BAUDRATES[serial_port.port] = baudrate
+            return baudrate
+    serial_port.baudrate = original
+    raise ConnectionError('No baud rate found')
+
+
+def upgrade_baudrate(serial_port, probes, switches, baudrates=BAUDRATES):
+    """Move every meter on serial_port to the fastest of baudrates. switches are functions
+    telling one meter a new rate, one per meter that can be switched; every meter must
+    support every rate in baudrates. Falls back to a rate that works if the meters don't
+    answer at the new rate. Returns the rate in use."""
+    current = find_baudrate(serial_port, probes, baudrates)
+    for baudrate in sorted(baudrates, reverse=True):
+        if baudrate <= current:
+            break
+        for switch in switches:
+            try:
+                switch(baudrate)
+            except Exception:
+                pass                    # some meters change rate before replying
+        serial_port.baudrate = baudrate
+        if answers(probes):
+            PORT_BAUDRATES[serial_port.port] = baudrate
+            return baudrate
+        # switch back, whichever rate the meters are listening at now
+        for rate in (baudrate, current):
+            serial_port.baudrate = rate
+            for switch in switches:
+                try:
+                    switch(current)
+                except Exception:
+                    pass
+        serial_port.baudrate = current
+    return find_baudrate(serial_port, probes, baudrates)
@@ -0,0 +1,341 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Shared register decoding for the modbus meter drivers.
+# A register map has entries of the form  name: (register, length, decoder, ...)  where
+# register is the first register number, length is the number of 16-bit registers and
+# decoder is one of the types in DECODER_FORMATS, 'STRINGn' for n characters, or either
+# with a '.d' suffix to divide the value by 10**d (eg 'INT16U.2').
+# plan_block_reads() groups the map into contiguous block reads, compile_layout() turns
+# each block into precompiled struct formats once, and decode_block() then unpacks every
+# field of a block in a single pass. decode_batch() decodes many blocks at once, using
+# NumPy views when numpy is installed and the batch is large.
+# read_blocks() reads a whole plan without letting one failed transaction drop the sample:
+# a block that fails is retried one field at a time (fields sharing registers together),
+# so a noisy line only has to carry the shorter frames, until RETRY_BUDGET seconds have
+# passed. Fields still unread are given their last value, flagged stale, for up to
+# STALE_SECONDS, or are None and flagged missing. ConnectionError is raised only when
+# nothing at all was read.
+
+import operator
+import struct
+import sys
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+MODBUS_MAX_REGISTERS = 125    # most registers a single read_registers request may return
+BLOCK_MAX_GAP = 10            # unused registers tolerated inside one block read
+NUMPY_BATCH_THRESHOLD = 32    # blocks per batch before decode_batch() switches to NumPy
+RETRY_BUDGET = 1.0            # seconds one sample may spend retrying failed reads
+RETRY_PASSES = 2              # times each field of a failed block is retried
+STALE_SECONDS = 60.0          # how long a value from an earlier sample may stand in for a failed read
+QUALITY_CODES = { 'good': 'g', 'stale': 's', 'missing': 'm' }
+
+# struct format and number of unpacked values for each decoder type
+DECODER_FORMATS = {
+    'INT16U':         ('H', 1),
+    'INT16':          ('h', 1),
+    'INT32U':         ('I', 1),
+    'INT32':          ('i', 1),
+    'INT64U':         ('Q', 1),
+    'INT64':          ('q', 1),
+    'FLOAT32':        ('f', 1),
+    'FLOAT64':        ('d', 1),
+    'PF4Q':           ('f', 1),    # Schneider 4 quadrant power factor
+    'PF4Q_DIRECTION': ('f', 1),    # 'leading' or 'lagging' from the same register
+    'FIRMWARE':       ('3H', 3),   # 3 registers 'A.B.C'
+}
+
+
+def pf_from_pf4q(pf4q):
+    """Schneider meters encode directionality of real and reactive power in 4 quadrant form"""
+    # NaN special case
+    if pf4q != pf4q:
+        pf = 1.0
+    # quadrant II, negative real power, positive reactive power
+    elif pf4q < -1:
+        pf = -2 - pf4q
+    # quadrant IV, positive real power, negative reactive power
+    elif pf4q > 1:
+        pf = 2 - pf4q
+    # quadrant I, positive real power, positive reactive power
+    # quadrant III, negative real power, negative reactive power
+    else:
+        pf = pf4q
+    return pf
+
+
+def pf_direction_from_pf4q(pf4q):
+    if pf4q != pf4q or pf4q < -1 or pf4q >= 1:
+        return 'leading'
+    return 'lagging'
+
+
+def parse_decoder(decoder):
+    """Split a decoder name into its base type and decimal scaling"""
+    base, _, decimals = decoder.partition('.')
+    return base, int(decimals or 0)
+
+
+def plan_block_reads(register_map, max_gap=BLOCK_MAX_GAP, max_length=MODBUS_MAX_REGISTERS):
+    """Coalesce the register map into the fewest contiguous read_registers spans.
+    Entries are merged while the unused gap between them is at most max_gap registers
+    and the span stays within max_length registers. Returns (start, length, keys) tuples."""
+    spans = []
+    for k, spec in sorted(register_map.items(), key=lambda item: item[1][0]):
+        register, length = spec[0], spec[1]
+        end = register + length
+        if spans and register - spans[-1][1] <= max_gap and max(end, spans[-1][1]) - spans[-1][0] <= max_length:
+            spans[-1][1] = max(end, spans[-1][1])
+            spans[-1][2].append(k)
+        else:
+            spans.append([register, end, [k]])
+    return [(start, end - start, keys) for start, end, keys in spans]
+
+
+class BlockLayout:
+    """Precompiled decoding of one block read. Fields that overlap (eg two names for the
+    same register) are placed in separate lanes, each decoded by one struct call."""
+
+    def __init__(self, register_map, start, length, keys, word_order='big', byte_order='big'):
+        self.start = start
+        self.length = length
+        self.keys = list(keys)
+        # registers arrive as 16-bit words; packing them in the device byte order gives
+        # a buffer where every value is big-endian within each word
+        self.word_struct = struct.Struct(('>' if byte_order == 'big' else '<') + f'{length}H')
+        self.word_order = word_order
+        self.byte_order = byte_order
+        self.lanes = []
+        for lane_fields in self._assign_lanes(register_map):
+            self.lanes.append(self._compile_lane(lane_fields))
+        self.field_layouts = None       # one layout per field, compiled on the first retry
+
+    def _assign_lanes(self, register_map):
+        lanes = []
+        for k in sorted(self.keys, key=lambda k: register_map[k][0]):
+            register, length, decoder = register_map[k][:3]
+            offset = register - self.start
+            if offset < 0 or offset + length > self.length:
+                raise ValueError(f'{k} lies outside block {self.start}+{self.length}')
+            for lane in lanes:
+                if lane[-1][1] + lane[-1][2] <= offset:
+                    lane.append((k, offset, length, decoder))
+                    break
+            else:
+                lanes.append([(k, offset, length, decoder)])
+        return lanes
+
+    def _compile_lane(self, lane_fields):
+        fmt = '>'
+        position = 0          # register offset reached by fmt
+        index = list(range(self.length))
+        plain_keys, plain_positions, special = [], [], []
+        numpy_fields = []
+        value_count = 0
+        for k, offset, length, decoder in lane_fields:
+            base, decimals = parse_decoder(decoder)
+            if offset > position:
+                fmt += f'{2 * (offset - position)}x'
+            if base[:6] == 'STRING':
+                code, count = f'{int(base[6:])}s', 1
+            elif base in DECODER_FORMATS:
+                code, count = DECODER_FORMATS[base]
+                if self.word_order == 'little' and base != 'FIRMWARE':
+                    # least significant word first: reverse the words of this value
+                    index[offset:offset + length] = reversed(index[offset:offset + length])
+            else:
+                sys.stderr.write(f"No implementation for {decoder}.\n")
+                code, count, base = '', 0, 'UNKNOWN'
+            fmt += code
+            used = struct.calcsize('>' + code) // 2
+            if length > used:
+                fmt += f'{2 * (length - used)}x'
+            position = offset + length
+            if base in ('INT16U', 'INT16', 'INT32U', 'INT32', 'INT64U', 'INT64', 'FLOAT32', 'FLOAT64') and decimals == 0:
+                plain_keys.append(k)
+                plain_positions.append(value_count)
+            else:
+                special.append((k, value_count, base, decimals))
+            if count:
+                numpy_fields.append((k, 2 * offset, code))
+            value_count += count
+        if position < self.length:
+            fmt += f'{2 * (self.length - position)}x'
+        if len(plain_positions) == 1:
+            plain_getter = lambda values, p=plain_positions[0]: (values[p],)
+        elif plain_positions:
+            plain_getter = operator.itemgetter(*plain_positions)
+        else:
+            plain_getter = lambda values: ()
+        if index == list(range(self.length)):
+            index = None
+        lane_dtype = self._numpy_dtype(numpy_fields) if numpy is not None else None
+        return index, struct.Struct(fmt), plain_keys, plain_getter, special, lane_dtype
+
+    def _numpy_dtype(self, numpy_fields):
+        names, formats, offsets = [], [], []
+        for k, byte_offset, code in numpy_fields:
+            names.append(k)
+            offsets.append(byte_offset)
+            if code[-1] == 's':
+                formats.append(f'S{code[:-1]}')
+            elif code == '3H':
+                formats.append(('>u2', 3))
+            else:
+                formats.append(numpy.dtype('>' + code).str)
+        return numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': 2 * self.length})
+
+
+def compile_layout(register_map, start, length, keys, word_order='big', byte_order='big'):
+    return BlockLayout(register_map, start, length, keys, word_order, byte_order)
+
+
+def compile_block_plan(register_map, block_plan, word_order='big', byte_order='big'):
+    """Compile every (start, length, keys) span of plan_block_reads() into a BlockLayout"""
+    return [compile_layout(register_map, start, length, keys, word_order, byte_order)
+                for start, length, keys in block_plan]
+
+
+def log_column_type(name, decoder):
+    """The binary_log.py column type that stores a decoded value without loss"""
+    base, decimals = parse_decoder(decoder)
+    if base[:6] == 'STRING':
+        # decoded as latin-1, at most 2 bytes a character in UTF-8
+        return f'text{2 * int(base[6:])}'
+    if base == 'FIRMWARE':
+        return 'text17'                 # up to '65535.65535.65535'
+    if base == 'PF4Q_DIRECTION':
+        return 'text7'                  # 'leading' or 'lagging'
+    if base in ('FLOAT32', 'PF4Q') and decimals == 0 and 'energy' not in name.lower():
+        return 'f4'
+    if base in ('INT16U', 'INT16') and 'energy' not in name.lower():
+        return 'f4'                     # 16 bit values with their decimals fit in float32's 7 digits
+    return 'f8'
+
+
+def post_process(value, base, decimals):
+    if base == 'PF4Q':
+        return pf_from_pf4q(value)
+    elif base == 'PF4Q_DIRECTION':
+        return pf_direction_from_pf4q(value)
+    elif base == 'FIRMWARE':
+        return f'{value[0]}.{value[1]}.{value[2]}'
+    elif base[:6] == 'STRING':
+        return value.decode('latin-1').split('\x00',1)[0]   # drop everything after the first \x00 character
+    elif base == 'UNKNOWN':
+        return 0.0
+    return value / 10 ** decimals
+
+
+def decode_block(words, layout, result=None):
+    """Decode every field of one block read (a list of register words) into a dict"""
+    if result is None:
+        result = {}
+    for index, lane_struct, plain_keys, plain_getter, special, lane_dtype in layout.lanes:
+        lane_words = words if index is None else [words[i] for i in index]
+        values = lane_struct.unpack(layout.word_struct.pack(*lane_words))
+        result.update(zip(plain_keys, plain_getter(values)))
+        for k, position, base, decimals in special:
+            if base == 'FIRMWARE':
+                result[k] = post_process(values[position:position + 3], base, decimals)
+            else:
+                result[k] = post_process(values[position] if base != 'UNKNOWN' else None, base, decimals)
+    return result
+
+
+def decode_batch(blocks, layout):
+    """Decode many block reads that share one layout, eg the same block from many meters
+    or many samples. Returns a dict of columns, NumPy arrays when the batch is large."""
+    if numpy is None or len(blocks) < NUMPY_BATCH_THRESHOLD:
+        rows = [decode_block(words, layout) for words in blocks]
+        return { k:[row[k] for row in rows] for k in layout.keys }
+    words = numpy.asarray(blocks, dtype=numpy.uint16)
+    word_type = '>u2' if layout.byte_order == 'big' else '<u2'
+    columns = {}
+    for index, lane_struct, plain_keys, plain_getter, special, lane_dtype in layout.lanes:
+        lane_words = words if index is None else words[:, index]
+        records = numpy.ascontiguousarray(lane_words, dtype=word_type).view(lane_dtype)[:, 0]
+        for k in plain_keys:
+            columns[k] = records[k]
+        for k, position, base, decimals in special:
+            if base == 'UNKNOWN':
+                columns[k] = numpy.zeros(len(blocks))
+                continue
+            values = records[k]
+            if base == 'PF4Q':
+                columns[k] = numpy.where(values != values, 1.0,
+                                 numpy.where(values < -1, -2 - values, numpy.where(values > 1, 2 - values, values)))
+            elif base == 'PF4Q_DIRECTION':
+                columns[k] = numpy.where((values != values) | (values < -1) | (values >= 1), 'leading', 'lagging')
+            elif base == 'FIRMWARE' or base[:6] == 'STRING':
+                columns[k] = [post_process(v, base, decimals) for v in values]
+            else:
+                columns[k] = values / 10 ** decimals
+    return columns
+
+
+def field_layouts(register_map, layout):
+    """Layouts reading the fields of a block one at a time, overlapping fields together"""
+    if layout.field_layouts is None:
+        fields_map = { k:register_map[k] for k in layout.keys }
+        layout.field_layouts = compile_block_plan(fields_map, plan_block_reads(fields_map, max_gap=-1),
+                                                  layout.word_order, layout.byte_order)
+    return layout.field_layouts
+
+
+def read_blocks(read, block_plan, register_map, cache=None, budget=RETRY_BUDGET, stale=STALE_SECONDS):
+    """Read and decode every block of a plan with read(start, length). Returns the readings
+    and the quality of each, 'good', 'stale' or 'missing'. cache (a dict kept by the caller
+    between samples) holds the last good value and time of each field."""
+    deadline = time.monotonic() + budget
+    readings = {}
+    retries = []
+    for layout in block_plan:
+        try:
+            decode_block(read(layout.start, layout.length), layout, readings)
+        except Exception:
+            retries.extend(field_layouts(register_map, layout))
+    for attempt in range(RETRY_PASSES):
+        if not retries:
+            break
+        failed = []
+        for layout in retries:
+            if time.monotonic() >= deadline:
+                failed.append(layout)
+                continue
+            try:
+                decode_block(read(layout.start, layout.length), layout, readings)
+            except Exception:
+                failed.append(layout)
+        if not readings:
+            # nothing answers, so the meter is gone rather than the line noisy
+            break
+        retries = failed
+    if not readings:
+        raise ConnectionError('No registers read')
+    now = time.monotonic()
+    quality = {}
+    for layout in block_plan:
+        for k in layout.keys:
+            if k in readings:
+                quality[k] = 'good'
+                if cache is not None:
+                    cache[k] = (readings[k], now)
+            elif cache is not None and k in cache and now - cache[k][1] <= stale:
+                readings[k] = cache[k][0]
+                quality[k] = 'stale'
+            else:
+                readings[k] = None
+                quality[k] = 'missing'
+    return readings, quality
+
+
+def quality_codes(quality, keys):
+    """One letter per field (see QUALITY_CODES), in the order of keys, eg 'ggsgggmg'"""
+    return ''.join(QUALITY_CODES[quality[k]] for k in keys)
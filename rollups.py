@@ -0,0 +1,174 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Incremental interval rollups of the readings, so reports read one row per interval
+# instead of every 10 second reading.
+# Each rollup level (1 minute, 15 minutes, hourly, daily by default) keeps a running count,
+# sum, minimum and maximum of the power column and the energy used, in constant memory,
+# and writes one CSV row to its own file when a reading arrives in the next interval.
+# Intervals are aligned to UTC boundaries; intervals without readings produce no row.
+# Energy is taken from the meter's cumulative energy register: each increment between
+# consecutive readings is credited to the interval of the later reading, so interval
+# deltas add up exactly. A decrease is a counter rollover when rollover (the counter's
+# modulus) is given and the previous value was in the top half of its range, otherwise
+# the meter was reset and the new value is counted from zero.
+# Peak demand is the highest 15 minute mean power within each interval of 15 minutes or
+# longer.
+
+import csv
+import math
+import os
+import sys
+import time
+from binary_log import parse_time
+from log_writer import LogWriter
+
+
+ROLLUP_LEVELS = (('1m', 60), ('15m', 900), ('hourly', 3600), ('daily', 86400))
+DEMAND_PERIOD = 900           # seconds over which peak demand is averaged
+TIME_FORMAT = '%Y/%m/%d %H:%M:%S'
+ROLLUP_HEADERS = '"Start","End","Samples","Power mean","Power min","Power max","Energy delta","Peak demand"'
+
+
+class IntervalAggregator:
+    """Streaming statistics for one rollup level"""
+
+    def __init__(self, name, period, output):
+        self.name = name
+        self.period = period
+        self.output = output            # called with each closed interval's CSV row
+        self.start = None
+        self.reset()
+
+    def reset(self):
+        self.samples = 0
+        self.power_samples = 0
+        self.power_sum = 0.0
+        self.power_min = math.inf
+        self.power_max = -math.inf
+        self.energy_delta = None
+        self.peak_demand = None
+
+    def interval(self, stamp):
+        return stamp - stamp % self.period
+
+    def add(self, stamp, power, energy_delta):
+        self.samples = self.samples + 1
+        if power is not None:
+            self.power_samples = self.power_samples + 1
+            self.power_sum = self.power_sum + power
+            self.power_min = min(self.power_min, power)
+            self.power_max = max(self.power_max, power)
+        if energy_delta is not None:
+            self.energy_delta = (self.energy_delta or 0.0) + energy_delta
+
+    def mean_power(self):
+        return self.power_sum / self.power_samples if self.power_samples else None
+
+    def add_demand(self, demand):
+        if demand is not None and self.period >= DEMAND_PERIOD:
+            self.peak_demand = demand if self.peak_demand is None else max(self.peak_demand, demand)
+
+    def close(self):
+        """Write the current interval's row and return its mean power"""
+        if self.period == DEMAND_PERIOD:
+            self.add_demand(self.mean_power())
+        mean = self.mean_power()
+        if self.samples:
+            fields = [self.samples, mean, self.power_min if self.power_samples else None,
+                      self.power_max if self.power_samples else None, self.energy_delta, self.peak_demand]
+            self.output(f'"{time.strftime(TIME_FORMAT, time.gmtime(self.start))}",'
+                        f'"{time.strftime(TIME_FORMAT, time.gmtime(self.start + self.period))}",' +
+                        ','.join('' if field is None else str(field) for field in fields) + '\n')
+        self.reset()
+        return mean
+
+
+class Rollups:
+    """Feeds each reading to every rollup level"""
+
+    def __init__(self, csv_headers, power_column, energy_column=None, outputs=None,
+                 levels=ROLLUP_LEVELS, rollover=None):
+        self.headers = next(csv.reader([csv_headers.strip()], skipinitialspace=True))
+        self.time_index = self.column(self.headers[0] if self.headers[0].lower() in ('time', 'timestamp') else 'timestamp')
+        self.power_index = self.column(power_column)
+        self.energy_index = self.column(energy_column) if energy_column is not None else None
+        self.rollover = rollover
+        self.last_energy = None
+        self.levels = []
+        for name, period in sorted(levels, key=lambda level: level[1]):
+            self.levels.append(IntervalAggregator(name, period, outputs[name]))
+
+    def column(self, name):
+        try:
+            return self.headers.index(name)
+        except ValueError:
+            sys.stderr.write(f'No column called {name} to roll up.\n')
+            raise ValueError()
+
+    def energy_delta(self, energy):
+        if energy is None:
+            return None
+        last, self.last_energy = self.last_energy, energy
+        if last is None:
+            return None
+        delta = energy - last
+        if delta < 0:
+            if self.rollover is not None and last > self.rollover / 2:
+                delta = delta + self.rollover
+            else:
+                delta = energy
+        return delta
+
+    def add(self, stamp, power, energy):
+        delta = self.energy_delta(energy)
+        # shortest level first, so each 15 minute interval's demand reaches the longer
+        # levels before they close
+        for level in self.levels:
+            interval = level.interval(stamp)
+            if level.start is not None and interval != level.start:
+                demand = level.close()
+                if level.period == DEMAND_PERIOD:
+                    for longer in self.levels:
+                        if longer.period > level.period:
+                            longer.add_demand(demand)
+            level.start = interval
+            level.add(stamp, power, delta)
+
+    def close(self):
+        """Write the rows of the intervals in progress, eg when logging stops"""
+        for level in self.levels:
+            if level.start is not None:
+                demand = level.close()
+                level.start = None
+                if level.period == DEMAND_PERIOD:
+                    for longer in self.levels:
+                        if longer.period > level.period:
+                            longer.add_demand(demand)
+
+    def add_csv(self, text):
+        for values in csv.reader(text.splitlines(), skipinitialspace=True):
+            if not values:
+                continue
+            stamp = parse_time(values[self.time_index])
+            if stamp is None:
+                continue
+            self.add(stamp[0], number(values, self.power_index), number(values, self.energy_index))
+
+
+def number(values, index):
+    try:
+        value = float(values[index])
+    except (IndexError, TypeError, ValueError):
+        return None
+    return value if value == value else None
+
+
+def open_rollups(directory, csv_headers, power_column, energy_column=None, rollover=None, levels=ROLLUP_LEVELS):
+    """Rollups writing each level to rollup-<level>.csv in directory through its own LogWriter.
+    Returns the Rollups and the writers, which should be closed when done."""
+    writers = { name: LogWriter(os.path.join(directory, f'rollup-{name}.csv'), ROLLUP_HEADERS + '\n', flush_records=1)
+                for name, period in levels }
+    rollups = Rollups(csv_headers, power_column, energy_column,
+                      { name: writer.write for name, writer in writers.items() }, levels, rollover)
+    return rollups, writers
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# Copyright 2024 Arup
+# MIT License
+
+# RS485 bus arbiter: a small daemon that owns the serial port and performs register
+# reads on behalf of local client processes, replacing the /rs485 posix_ipc semaphore.
+# Clients connect to a Unix socket and send one JSON request per line:
+#   {"address": 1, "function": 3, "register": 3027, "count": 2, "priority": 5, "max_age": 0.5}
+# and receive one JSON line back: {"registers": [...]} or {"error": "..."}.
+# Requests are queued by priority (lower numbers first). Identical reads that arrive
+# while one is already queued are answered by the same bus transaction, and results are
+# kept for a short time (--cache_ttl, or the request's max_age) so repeated reads are
+# answered without touching the bus. A client that stalls cannot hold the bus, so no
+# other client ever waits on it or needs to unlink a stuck semaphore.
+# ArbiterInstrument gives clients the minimalmodbus Instrument read methods used by the
+# drivers, so eg schneider_iEM2150.get_readings() works unchanged through the arbiter.
+# Usage: ./rs485_arbiter.py --port /dev/ttyUSB0 &
+# requires minimalmodbus library: sudo pip3 install minimalmodbus
+
+import argparse
+import itertools
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+SOCKET_PATH = '/tmp/rs485_arbiter.sock'
+SOCKET_MODE = 0o660           # the socket is only usable by its owner and group (eg dialout)
+CACHE_TTL = 0.5               # seconds a register read may be reused by other requests
+DEFAULT_PRIORITY = 5          # lower numbers are served first
+REQUEST_TIMEOUT = 5.0         # seconds a client waits for its answer
+
+
+class ReadRequest:
+
+    def __init__(self, key):
+        self.key = key                  # (address, function, register, count)
+        self.priority = None
+        self.done = threading.Event()
+        self.registers = None
+        self.error = None
+
+
+class BusArbiter:
+    """Serialises every register read onto the one bus thread"""
+
+    def __init__(self, port, baudrate=9600, cache_ttl=CACHE_TTL):
+        self.port = port
+        self.baudrate = baudrate
+        self.cache_ttl = cache_ttl
+        self.requests = queue.PriorityQueue()
+        self.order = itertools.count()  # keeps equal priorities first come, first served
+        self.lock = threading.Lock()
+        self.pending = {}               # key: ReadRequest queued but not yet read
+        self.cache = {}                 # key: (monotonic time, registers)
+        self.instruments = {}
+        self.transactions = 0
+        self.merged = 0
+        self.cache_hits = 0
+
+    def instrument(self, address):
+        if address not in self.instruments:
+            import minimalmodbus
+            # minimalmodbus shares one serial port object between instruments on the same port
+            instrument = minimalmodbus.Instrument(self.port, address, mode='rtu')
+            instrument.serial.baudrate = self.baudrate
+            instrument.serial.bytesize = 8
+            instrument.serial.stopbits = 1
+            instrument.serial.parity = minimalmodbus.serial.PARITY_NONE
+            instrument.serial.timeout = 0.5
+            self.instruments[address] = instrument
+        return self.instruments[address]
+
+    def submit(self, key, priority=DEFAULT_PRIORITY, max_age=None):
+        max_age = self.cache_ttl if max_age is None else max_age
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and time.monotonic() - cached[0] <= max_age:
+                self.cache_hits = self.cache_hits + 1
+                request = ReadRequest(key)
+                request.registers = cached[1]
+                request.done.set()
+                return request
+            if key in self.pending:
+                # share the transaction already queued; queue it again if this caller is more urgent
+                self.merged = self.merged + 1
+                request = self.pending[key]
+                if priority >= request.priority:
+                    return request
+            else:
+                request = ReadRequest(key)
+            self.requests.put((priority, next(self.order), request))
+            # only once it is queued, so a failed put leaves nothing to merge with
+            request.priority = priority
+            self.pending[key] = request
+            return request
+
+    def run(self):
+        while True:
+            priority, order, request = self.requests.get()
+            if request.done.is_set():
+                continue                # already answered through a higher priority entry
+            address, function, register, count = request.key
+            try:
+                registers = self.instrument(address).read_registers(register, count, functioncode=function)
+                error = None
+            except Exception as e:
+                registers = None
+                error = f'{type(e).__name__}: {e}'
+            with self.lock:
+                self.transactions = self.transactions + 1
+                if registers is not None:
+                    self.cache[request.key] = (time.monotonic(), registers)
+                del self.pending[request.key]
+                request.registers = registers
+                request.error = error
+                request.done.set()
+
+
+class ArbiterRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        arbiter = self.server.arbiter
+        for line in self.rfile:
+            try:
+                message = json.loads(line)
+                key = (int(message['address']), int(message.get('function', 3)),
+                       int(message['register']), int(message['count']))
+                # checked here, so a bad value can't reach the queue and stall the bus thread
+                priority = int(message.get('priority', DEFAULT_PRIORITY))
+                max_age = float(message['max_age']) if message.get('max_age') is not None else None
+                request = arbiter.submit(key, priority, max_age)
+                if not request.done.wait(REQUEST_TIMEOUT):
+                    answer = { 'error': 'timed out waiting for the bus' }
+                elif request.error is not None:
+                    answer = { 'error': request.error }
+                else:
+                    answer = { 'registers': request.registers }
+            except (ValueError, KeyError, TypeError) as e:
+                answer = { 'error': f'bad request: {e}' }
+            self.wfile.write((json.dumps(answer) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class ArbiterServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, arbiter):
+        self.arbiter = arbiter
+        super().__init__(path, ArbiterRequestHandler)
+
+    def server_bind(self):
+        # bound under a restrictive umask so no other user can connect before the chmod
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, SOCKET_MODE)
+
+
+class ArbiterClient:
+    """Connection to the arbiter daemon"""
+
+    def __init__(self, path=SOCKET_PATH, priority=DEFAULT_PRIORITY, timeout=REQUEST_TIMEOUT + 1):
+        self.priority = priority
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(path)
+        except OSError:
+            sys.stderr.write(f"Couldn't connect to RS485 arbiter at {path}.\n")
+            raise ConnectionError('Arbiter error')
+        self.file = self.sock.makefile('rwb')
+
+    def read_registers(self, address, register, count, functioncode=3, max_age=None):
+        message = { 'address': address, 'function': functioncode, 'register': register,
+                    'count': count, 'priority': self.priority }
+        if max_age is not None:
+            message['max_age'] = max_age
+        self.file.write((json.dumps(message) + '\n').encode('utf-8'))
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError('Arbiter closed the connection')
+        answer = json.loads(line)
+        if 'error' in answer:
+            raise IOError(answer['error'])
+        return answer['registers']
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class ArbiterInstrument:
+    """The minimalmodbus Instrument read methods used by the drivers, served by the arbiter.
+    serial is the client connection so that drivers closing the port close the connection."""
+
+    def __init__(self, client, address):
+        self.serial = client
+        self.address = address
+
+    def read_registers(self, registeraddress, number_of_registers, functioncode=3):
+        return self.serial.read_registers(self.address, registeraddress, number_of_registers, functioncode)
+
+    def read_register(self, registeraddress, number_of_decimals=0, functioncode=3):
+        value = self.read_registers(registeraddress, 1, functioncode)[0]
+        return value / 10 ** number_of_decimals if number_of_decimals else value
+
+    def read_long(self, registeraddress, functioncode=3):
+        words = self.read_registers(registeraddress, 2, functioncode)
+        return (words[0] << 16) + words[1]
+
+    def read_float(self, registeraddress, functioncode=3):
+        words = self.read_registers(registeraddress, 2, functioncode)
+        return struct.unpack('>f', struct.pack('>2H', *words))[0]
+
+    def read_string(self, registeraddress, number_of_registers=16, functioncode=3):
+        words = self.read_registers(registeraddress, number_of_registers, functioncode)
+        return struct.pack(f'>{number_of_registers}H', *words).decode('latin-1')
+
+
+# starts here
+if __name__ == '__main__':
+    cmd_parser = argparse.ArgumentParser(description='Share one RS485 bus between local processes.')
+    cmd_parser.add_argument('--port', nargs='?', default=None, help='serial port, found automatically by default')
+    cmd_parser.add_argument('--baudrate', nargs='?', type=int, default=9600, help='RS485 communication baud rate')
+    cmd_parser.add_argument('--socket', nargs='?', default=SOCKET_PATH, help='Unix socket for client requests')
+    cmd_parser.add_argument('--cache_ttl', type=float, nargs='?', default=CACHE_TTL, help='seconds a read may be reused')
+    args = cmd_parser.parse_args()
+    try:
+        if args.port is None:
+            import schneider_iEM2150
+            args.port = schneider_iEM2150.find_serial_device()
+        arbiter = BusArbiter(args.port, args.baudrate, args.cache_ttl)
+        # a socket left behind by a previous run would stop the server binding
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = ArbiterServer(args.socket, arbiter)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        arbiter.run()
+
+    except ConnectionError:
+        sys.stderr.write('Error communicating with hardware.\n')
+        sys.exit(1)
@@ -0,0 +1,111 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Deadline scheduling for the acquisition loops.
+# Deadlines are kept on time.monotonic(), so stepping the wall clock (eg NTP at boot)
+# cannot stretch, skip or repeat a tick, but ticks are aligned to wall-clock boundaries
+# (a 10 s period ticks at :00, :10, :20 ...). If the wall clock is stepped the schedule
+# re-aligns to the new boundaries at the next tick. A caller that overruns its slot
+# waits for the next boundary; the ticks it missed are counted rather than run late.
+# Periods may be fractions of a second, and Scheduler runs several schedules with
+# different periods (eg one per meter) in one loop.
+
+import math
+import time
+
+
+CLOCK_STEP_TOLERANCE = 0.1    # seconds of wall clock jump treated as a step rather than jitter
+
+
+class Schedule:
+
+    def __init__(self, period, offset=0.0):
+        if period <= 0:
+            raise ValueError('Schedule period must be positive.')
+        self.period = period
+        self.offset = offset            # seconds after each wall-clock boundary
+        self.ticks = 0
+        self.overruns = 0               # waits that started after their deadline
+        self.missed = 0                 # ticks skipped because of overruns
+        self.clock_steps = 0
+        self.wall_offset = time.time() - time.monotonic()
+        self.deadline = self.first_deadline(time.monotonic())
+
+    def first_deadline(self, now):
+        # monotonic time of the first wall-clock boundary after now
+        wall_now = now + self.wall_offset
+        boundary = math.floor((wall_now - self.offset) / self.period + 1) * self.period + self.offset
+        return boundary - self.wall_offset
+
+    def check_clock_step(self, now):
+        wall_offset = time.time() - now
+        if abs(wall_offset - self.wall_offset) > CLOCK_STEP_TOLERANCE:
+            self.clock_steps = self.clock_steps + 1
+            self.wall_offset = wall_offset
+            self.deadline = self.first_deadline(now)
+
+    def due(self, now=None):
+        return (time.monotonic() if now is None else now) >= self.deadline
+
+    def skip_missed(self, now):
+        # the caller overran its slot: count the ticks already late and move to the next future boundary
+        if now >= self.deadline:
+            late = math.floor((now - self.deadline) / self.period) + 1
+            self.overruns = self.overruns + 1
+            self.missed = self.missed + late
+            self.deadline = self.deadline + late * self.period
+
+    def advance(self, now):
+        # move past the tick that has just run, skipping any that are already late
+        self.ticks = self.ticks + 1
+        self.deadline = self.deadline + self.period
+        self.skip_missed(now)
+
+    def wait(self):
+        """Sleep until the next tick and return its wall-clock time in seconds since epoch"""
+        now = time.monotonic()
+        self.check_clock_step(now)
+        self.skip_missed(now)
+        time.sleep(self.deadline - now)
+        tick_time = self.deadline + self.wall_offset
+        self.ticks = self.ticks + 1
+        self.deadline = self.deadline + self.period
+        return tick_time
+
+    def stats(self):
+        return { 'period': self.period, 'ticks': self.ticks, 'overruns': self.overruns,
+                 'missed': self.missed, 'clock_steps': self.clock_steps }
+
+
+class Scheduler:
+    """Several named schedules with different periods, eg one per meter on a bus"""
+
+    def __init__(self):
+        self.schedules = {}
+        self.tick_time = None           # wall-clock time of the last tick returned by wait()
+
+    def add(self, name, period, offset=0.0):
+        self.schedules[name] = Schedule(period, offset)
+        return self.schedules[name]
+
+    def wait(self):
+        """Sleep until the earliest deadline and return the names of every schedule due"""
+        now = time.monotonic()
+        for schedule in self.schedules.values():
+            schedule.check_clock_step(now)
+            # as in Schedule.wait(), a tick the caller overran waits for the next boundary
+            # rather than running late under its old time
+            schedule.skip_missed(now)
+        earliest = min(self.schedules.values(), key=lambda schedule: schedule.deadline)
+        deadline = earliest.deadline
+        self.tick_time = deadline + earliest.wall_offset
+        if now < deadline:
+            time.sleep(deadline - now)
+            now = time.monotonic()
+        due = [name for name, schedule in self.schedules.items() if schedule.due(now)]
+        for name in due:
+            self.schedules[name].advance(now)
+        return due
+
+    def stats(self):
+        return { name:schedule.stats() for name, schedule in self.schedules.items() }
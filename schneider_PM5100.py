@@ -9,6 +9,7 @@
 # requires minimalmodbus library: sudo pip3 install minimalmodbus
 
 import minimalmodbus
+import modbus_rtu
 import datetime
 import time
 import sys
@@ -18,107 +19,104 @@ import json
 import csv
 import argparse
 import serial.tools.list_ports
+from scheduler import Schedule
+from register_decoder import BLOCK_MAX_GAP, plan_block_reads, compile_block_plan, decode_block
+
+WORD_ORDER = 'big'            # most significant register first
+BYTE_ORDER = 'big'            # most significant byte first within each register
+SUPPORTED_BAUDRATES = (38400, 19200, 9600)
+MODBUS_ENGINE = 'rtu'         # 'rtu' for the lean transactions of modbus_rtu.py, or 'minimalmodbus'
+
+# poll classes: how often each register map entry is re-read, in ticks of --interval
+POLL_ONCE = 0                 # once per session, eg identity labels that never change
+POLL_SLOW = 12                # every 12th tick, eg harmonic distortion and energy accumulators
+POLL_FAST = 1                 # every tick, eg power and current
 
 
 PM5100_REGISTER_MAP = {
-    "manufacturer_label":                                        (70, 20, 'STRING40'),
-    "product_label":                                             (30, 20, 'STRING40'),
-    "serial_number_label":                                       (130, 2, 'INT32U'),
-    "firmware_version_status":                                   (1638, 4, 'FIRMWARE'), # 3 registers 'A.B.C'
-    "line1_neutral_voltage_sensor":                              (3028, 2, 'FLOAT32'),
-    "line2_neutral_voltage_sensor":                              (3030, 2, 'FLOAT32'),
-    "line3_neutral_voltage_sensor":                              (3032, 2, 'FLOAT32'),
-    "average_neutral_voltage_sensor":                            (3028, 2, 'FLOAT32'),
-    "line1_line2_voltage_sensor":                                (3020, 2, 'FLOAT32'),
-    "line2_line3_voltage_sensor":                                (3022, 2, 'FLOAT32'),
-    "line3_line1_voltage_sensor":                                (3024, 2, 'FLOAT32'),
-    "average_line_voltage_sensor":                               (3026, 2, 'FLOAT32'),
-    "line1_current_sensor":                                      (3000, 2, 'FLOAT32'),
-    "line2_current_sensor":                                      (3002, 2, 'FLOAT32'),
-    "line3_current_sensor":                                      (3004, 2, 'FLOAT32'),
-    "neutral_current_sensor":                                    (3006, 2, 'FLOAT32'),
-    "average_line_current_sensor":                               (3010, 2, 'FLOAT32'),
-    "line1_neutral_power_sensor":                                (3054, 2, 'FLOAT32'),
-    "line2_neutral_power_sensor":                                (3056, 2, 'FLOAT32'),
-    "line3_neutral_power_sensor":                                (3058, 2, 'FLOAT32'),
-    "total_power_sensor":                                        (3060, 2, 'FLOAT32'),
-    "line1_neutral_apparent_power_sensor":                       (3070, 2, 'FLOAT32'),
-    "line2_neutral_apparent_power_sensor":                       (3072, 2, 'FLOAT32'),
-    "line3_neutral_apparent_power_sensor":                       (3074, 2, 'FLOAT32'),
-    "total_apparent_power_sensor":                               (3076, 2, 'FLOAT32'),
-    "line1_neutral_reactive_power_sensor":                       (3062, 2, 'FLOAT32'),
-    "line2_neutral_reactive_power_sensor":                       (3064, 2, 'FLOAT32'),
-    "line3_neutral_reactive_power_sensor":                       (3066, 2, 'FLOAT32'),
-    "total_reactive_power_sensor":                               (3068, 2, 'FLOAT32'),
-    "total_power_factor_sensor":                                 (3084, 2, 'PF4Q'),
-    "total_energy_accumulator":                                  (3204, 4, 'INT64U'),
-    "total_reactive_energy_accumulator":                         (3220, 4, 'INT64U'),
-    "frequency_sensor":                                          (3110, 2, 'FLOAT32'),
-    "line1_neutral_harmonic_distortion_voltage_sensor":          (21330, 2, 'FLOAT32'),
-    "line2_neutral_harmonic_distortion_voltage_sensor":          (21332, 2, 'FLOAT32'),
-    "line3_neutral_harmonic_distortion_voltage_sensor":          (21334, 2, 'FLOAT32'),
-    "average_line_neutral_harmonic_distortion_voltage_sensor":   (21338, 2, 'FLOAT32'),
-    "line1_harmonic_distortion_current_sensor":                  (21300, 2, 'FLOAT32'),
-    "line2_harmonic_distortion_current_sensor":                  (21302, 2, 'FLOAT32'),
-    "line3_harmonic_distortion_current_sensor":                  (21304, 2, 'FLOAT32'),
-    "neutral_harmonic_distortion_current_sensor":                (21306, 2, 'FLOAT32')
+    "manufacturer_label":                                        (70, 20, 'STRING40', POLL_ONCE),
+    "product_label":                                             (30, 20, 'STRING40', POLL_ONCE),
+    "serial_number_label":                                       (130, 2, 'INT32U', POLL_ONCE),
+    "firmware_version_status":                                   (1638, 4, 'FIRMWARE', POLL_ONCE), # 3 registers 'A.B.C'
+    "line1_neutral_voltage_sensor":                              (3028, 2, 'FLOAT32', POLL_FAST),
+    "line2_neutral_voltage_sensor":                              (3030, 2, 'FLOAT32', POLL_FAST),
+    "line3_neutral_voltage_sensor":                              (3032, 2, 'FLOAT32', POLL_FAST),
+    "average_neutral_voltage_sensor":                            (3028, 2, 'FLOAT32', POLL_FAST),
+    "line1_line2_voltage_sensor":                                (3020, 2, 'FLOAT32', POLL_FAST),
+    "line2_line3_voltage_sensor":                                (3022, 2, 'FLOAT32', POLL_FAST),
+    "line3_line1_voltage_sensor":                                (3024, 2, 'FLOAT32', POLL_FAST),
+    "average_line_voltage_sensor":                               (3026, 2, 'FLOAT32', POLL_FAST),
+    "line1_current_sensor":                                      (3000, 2, 'FLOAT32', POLL_FAST),
+    "line2_current_sensor":                                      (3002, 2, 'FLOAT32', POLL_FAST),
+    "line3_current_sensor":                                      (3004, 2, 'FLOAT32', POLL_FAST),
+    "neutral_current_sensor":                                    (3006, 2, 'FLOAT32', POLL_FAST),
+    "average_line_current_sensor":                               (3010, 2, 'FLOAT32', POLL_FAST),
+    "line1_neutral_power_sensor":                                (3054, 2, 'FLOAT32', POLL_FAST),
+    "line2_neutral_power_sensor":                                (3056, 2, 'FLOAT32', POLL_FAST),
+    "line3_neutral_power_sensor":                                (3058, 2, 'FLOAT32', POLL_FAST),
+    "total_power_sensor":                                        (3060, 2, 'FLOAT32', POLL_FAST),
+    "line1_neutral_apparent_power_sensor":                       (3070, 2, 'FLOAT32', POLL_FAST),
+    "line2_neutral_apparent_power_sensor":                       (3072, 2, 'FLOAT32', POLL_FAST),
+    "line3_neutral_apparent_power_sensor":                       (3074, 2, 'FLOAT32', POLL_FAST),
+    "total_apparent_power_sensor":                               (3076, 2, 'FLOAT32', POLL_FAST),
+    "line1_neutral_reactive_power_sensor":                       (3062, 2, 'FLOAT32', POLL_FAST),
+    "line2_neutral_reactive_power_sensor":                       (3064, 2, 'FLOAT32', POLL_FAST),
+    "line3_neutral_reactive_power_sensor":                       (3066, 2, 'FLOAT32', POLL_FAST),
+    "total_reactive_power_sensor":                               (3068, 2, 'FLOAT32', POLL_FAST),
+    "total_power_factor_sensor":                                 (3084, 2, 'PF4Q', POLL_FAST),
+    "total_energy_accumulator":                                  (3204, 4, 'INT64U', POLL_SLOW),
+    "total_reactive_energy_accumulator":                         (3220, 4, 'INT64U', POLL_SLOW),
+    "frequency_sensor":                                          (3110, 2, 'FLOAT32', POLL_FAST),
+    "line1_neutral_harmonic_distortion_voltage_sensor":          (21330, 2, 'FLOAT32', POLL_SLOW),
+    "line2_neutral_harmonic_distortion_voltage_sensor":          (21332, 2, 'FLOAT32', POLL_SLOW),
+    "line3_neutral_harmonic_distortion_voltage_sensor":          (21334, 2, 'FLOAT32', POLL_SLOW),
+    "average_line_neutral_harmonic_distortion_voltage_sensor":   (21338, 2, 'FLOAT32', POLL_SLOW),
+    "line1_harmonic_distortion_current_sensor":                  (21300, 2, 'FLOAT32', POLL_SLOW),
+    "line2_harmonic_distortion_current_sensor":                  (21302, 2, 'FLOAT32', POLL_SLOW),
+    "line3_harmonic_distortion_current_sensor":                  (21304, 2, 'FLOAT32', POLL_SLOW),
+    "neutral_harmonic_distortion_current_sensor":                (21306, 2, 'FLOAT32', POLL_SLOW)
 }
 
 
-def pf_from_pf4q(pf4q):
-    """Schneider meters encode directionality of real and reactive power in 4 quadrant form"""
-    # NaN special case
-    if pf4q != pf4q:
-        pf = 1.0
-    # quadrant II, negative real power, positive reactive power
-    elif pf4q < -1:
-        pf = -2 - pf4q
-    # quadrant IV, positive real power, negative reactive power
-    elif pf4q > 1:
-        pf = 2 - pf4q
-    # quadrant I, positive real power, positive reactive power
-    # quadrant III, negative real power, negative reactive power
-    else:
-        pf = pf4q
-    return pf
-
-
-def get_reading(instrument, register, decoder):
-    reg_addr = register - 1
-    if decoder == 'FLOAT32':
-        output = instrument.read_float(reg_addr)  
-    elif decoder == 'INT16U':
-        output = instrument.read_register(reg_addr)  
-    elif decoder == 'INT32U':
-        vs = instrument.read_registers(reg_addr, 2)  
-        output = (vs[0] << 16) + vs[1]
-    elif decoder == 'INT64U':
-        vs = instrument.read_registers(reg_addr, 4)  
-        output = (vs[0] << 48) + (vs[1] << 32) + (vs[2] << 16) + vs[3]
-    elif decoder == 'FIRMWARE':
-        vs = instrument.read_registers(reg_addr, 4)
-        output = f'{vs[0]}.{vs[1]}.{vs[2]}' 
-    elif decoder[:6] == 'STRING':
-        length = int(decoder[6:])
-        output = instrument.read_string(reg_addr, length//2)  # 2 characters per register
-        output = output.split('\x00',1)[0]       # drop everything after the first \x00 character
-    elif decoder == 'PF4Q':
-        output = pf_from_pf4q(instrument.read_float(reg_addr))
-    else:
-        sys.stderr.write(f"No implementation for {decoder}.\n")
-        output = 0.0
-    return output 
-
-
-def get_readings(instrument, register_map):
-    result = { k:get_reading(instrument, register, decoder) \
-                   for k in register_map.keys() \
-                       for register, length, decoder in [register_map[k]] }
+def compile_readings_plan(register_map, max_gap=BLOCK_MAX_GAP, word_order=WORD_ORDER, byte_order=BYTE_ORDER):
+    return compile_block_plan(register_map, plan_block_reads(register_map, max_gap), word_order, byte_order)
+
+
+def get_readings(instrument, register_map, block_plan=None):
+    if block_plan is None:
+        block_plan = compile_readings_plan(register_map)
+    decoded = {}
+    for layout in block_plan:
+        # one bus transaction per span, then decode every field from the returned block
+        decode_block(instrument.read_registers(layout.start - 1, layout.length), layout, decoded)
+    # keep the register map ordering so output columns are unchanged
+    result = { k:decoded[k] for k in register_map.keys() }
     # apply timestamp
     result['timestamp'] = datetime.datetime.utcnow().isoformat('T')+'Z'
     return result
 
 
+def poll_due(poll, tick):
+    """True if a register map entry with this poll class is read on the given tick"""
+    if poll == POLL_ONCE:
+        return tick == 0
+    return tick % poll == 0
+
+
+def get_tiered_readings(instrument, register_map, tick, cache, max_gap=BLOCK_MAX_GAP, plans=None):
+    """Read only the register map entries due on this tick, merging cached values
+    for the rest so every record stays complete. Tick 0 reads the whole map.
+    Compiled block plans are kept in plans, keyed by the set of due entries."""
+    due_map = { k:register_map[k] for k in register_map.keys() if poll_due(register_map[k][3], tick) }
+    if plans is None:
+        plans = {}
+    due_keys = tuple(due_map.keys())
+    if due_keys not in plans:
+        plans[due_keys] = compile_readings_plan(due_map, max_gap)
+    cache.update(get_readings(instrument, due_map, plans[due_keys]))
+    return { k:cache[k] for k in list(register_map.keys()) + ['timestamp'] }
+
+
 # on Ubuntu/Raspberry Pi, serial ports are in the form '/dev/ttyUSBx' where x is an integer 0-7
 # on Windows, serial ports are in the form 'COMx' where x is an integer 1-8
 def find_serial_device():
@@ -144,6 +142,9 @@ def find_serial_device():
         
 def configure(port, modbus_device_address, baudrate):
     try:
+        if MODBUS_ENGINE == 'rtu':
+            # cached request frames on the open port, see modbus_rtu.py
+            return modbus_rtu.RtuInstrument(port, modbus_device_address, baudrate, timeout=0.5)
         instrument = minimalmodbus.Instrument(port, modbus_device_address, mode='rtu')
         instrument.serial.baudrate = baudrate
         instrument.serial.bytesize = 8
@@ -156,6 +157,16 @@ def configure(port, modbus_device_address, baudrate):
         raise ConnectionError('Modbus error')
 
 
+def probe(instrument):
+    instrument.read_registers(3109, 2)     # frequency
+
+def negotiate_baudrate(instrument):
+    # the rate is set on the meter's display, so it is found rather than changed
+    if MODBUS_ENGINE == 'rtu':
+        modbus_rtu.find_baudrate(instrument.serial, [lambda: probe(instrument)], SUPPORTED_BAUDRATES)
+        instrument.latencies.clear()
+
+
 def filtered_readings(readings):
     # filter readings to remove 'NaN' values (eg single phase application)
     filtered_readings = { k:readings[k] for k in readings.keys() if readings[k] == readings[k] }
@@ -173,49 +184,50 @@ def print_readings(readings, output_format, csv_writer):
 
 
 # starts here
-try:
-    cmd_parser = argparse.ArgumentParser(description='Read data from Schneider PM5100 energy meter.')
-    cmd_parser.add_argument('--interval', type=int, nargs='?', default=5, help='interval in seconds between successive readings')
-    cmd_parser.add_argument('--quantity', type=int, nargs='?', default=1, help='total number of readings')
-    cmd_parser.add_argument('--json', action='store_true', help='output in JSON format')
-    cmd_parser.add_argument('--csv', action='store_true', help='output in CSV format')
-    cmd_parser.add_argument('--text', action='store_true', help='output in text format')
-    cmd_parser.add_argument('--device_address', type=int, nargs='?', default=1, help='modbus address of meter')
-    cmd_parser.add_argument('--baudrate', nargs='?', type=int, default=9600, help='RS485 communication baud rate')
-    args = cmd_parser.parse_args()
-
-    # connect to meter
-    port = find_serial_device()
-    instrument = configure(port, args.device_address, args.baudrate)
-    if args.json:
-        output_format = 'json'
-    elif args.csv:
-        output_format = 'csv'
-    elif args.text:
-        output_format = 'text'
-    else:
-        output_format = 'text'
-    # create a CSV output object 
-    # we use \n rather than os.linesep because the file sys.stdout is already open and
-    # the stream object will convert the \n to \r\n on Windows.
-    csv_writer = csv.writer(sys.stdout, lineterminator='\n')
-    # if we're outputting in CSV format, output the header first
-    if output_format == 'csv':
-        readings = get_readings(instrument, PM5100_REGISTER_MAP)
-        csv_writer.writerow(filtered_readings(readings).keys())
-    # figure out starting time in seconds (since epoch)
-    start_time = int(time.time())
-    # now output the required number of readings
-    for i in range(args.quantity):
-        readings = get_readings(instrument, PM5100_REGISTER_MAP)
-        print_readings(readings, output_format, csv_writer)
-        while (int(time.time()) - start_time) % args.interval != 0:
-            time.sleep(0.1)   # pause briefly until the right interval is reached
-
-except ConnectionError:
-    print("Error: failed attempt to communicate with hardware.", file=sys.stderr)
-    sys.exit(1)
-
-
-
-
+if __name__ == '__main__':
+    try:
+        cmd_parser = argparse.ArgumentParser(description='Read data from Schneider PM5100 energy meter.')
+        cmd_parser.add_argument('--interval', type=float, nargs='?', default=5, help='interval in seconds between successive readings')
+        cmd_parser.add_argument('--quantity', type=int, nargs='?', default=1, help='total number of readings')
+        cmd_parser.add_argument('--json', action='store_true', help='output in JSON format')
+        cmd_parser.add_argument('--csv', action='store_true', help='output in CSV format')
+        cmd_parser.add_argument('--text', action='store_true', help='output in text format')
+        cmd_parser.add_argument('--device_address', type=int, nargs='?', default=1, help='modbus address of meter')
+        cmd_parser.add_argument('--baudrate', nargs='?', type=int, default=9600, help='RS485 communication baud rate')
+        cmd_parser.add_argument('--max_gap', type=int, nargs='?', default=BLOCK_MAX_GAP, help='unused registers tolerated inside one block read')
+        args = cmd_parser.parse_args()
+
+        # connect to meter
+        port = find_serial_device()
+        instrument = configure(port, args.device_address, args.baudrate)
+        block_plan = compile_readings_plan(PM5100_REGISTER_MAP, args.max_gap)
+        if args.json:
+            output_format = 'json'
+        elif args.csv:
+            output_format = 'csv'
+        elif args.text:
+            output_format = 'text'
+        else:
+            output_format = 'text'
+        # create a CSV output object 
+        # we use \n rather than os.linesep because the file sys.stdout is already open and
+        # the stream object will convert the \n to \r\n on Windows.
+        csv_writer = csv.writer(sys.stdout, lineterminator='\n')
+        # if we're outputting in CSV format, output the header first
+        if output_format == 'csv':
+            readings = get_readings(instrument, PM5100_REGISTER_MAP, block_plan)
+            csv_writer.writerow(filtered_readings(readings).keys())
+        # ticks are aligned to wall-clock multiples of the interval
+        schedule = Schedule(args.interval)
+        # now output the required number of readings, holding slow and static values between polls
+        cache = {}
+        plans = {}
+        for i in range(args.quantity):
+            readings = get_tiered_readings(instrument, PM5100_REGISTER_MAP, i, cache, args.max_gap, plans)
+            print_readings(readings, output_format, csv_writer)
+            if i < args.quantity - 1:
+                schedule.wait()   # sleep until the next interval boundary
+
+    except ConnectionError:
+        print("Error: failed attempt to communicate with hardware.", file=sys.stderr)
+        sys.exit(1)
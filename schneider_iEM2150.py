@@ -9,15 +9,42 @@
 # requires minimalmodbus library: sudo pip3 install minimalmodbus
 
 import minimalmodbus
+import modbus_rtu
 import datetime
 import time
 import sys
 import os
 import glob
+import json
+import argparse
 import serial.tools.list_ports
+from scheduler import Schedule
+from register_decoder import plan_block_reads, compile_block_plan, read_blocks, quality_codes
 
 BAUDRATE = 9600
 MODBUS_ADDRESS = 1
+WORD_ORDER = 'big'            # most significant register first
+BYTE_ORDER = 'big'            # most significant byte first within each register
+MAX_GAP = 0                   # unused registers tolerated inside one block read: the iEM2150's
+                              # unmapped addresses between these registers aren't documented as readable
+SUPPORTED_BAUDRATES = (38400, 19200, 9600)
+MODBUS_ENGINE = 'rtu'         # 'rtu' for the lean transactions of modbus_rtu.py, or 'minimalmodbus'
+
+# register numbers as documented by Schneider, one less on the wire
+# single register reads, eg volts, typically send 01 03 0b d3 00 02 37 d6      addr(1) fn(1) start-reg(2) quant-reg(2) crc(2)
+#                                  and receive    01 03 04 43 6f 97 0a 31 9d   addr(1) fn(1) quant-bytes(1) float(4) crc(2)
+IEM2150_REGISTER_MAP = {
+    "volts":            (3028, 2, 'FLOAT32'),
+    "amps":             (3000, 2, 'FLOAT32'),
+    "power":            (3054, 2, 'FLOAT32'),
+    "reactive_power":   (3068, 2, 'FLOAT32'),
+    "pf":               (3084, 2, 'PF4Q'),
+    "pf_direction":     (3084, 2, 'PF4Q_DIRECTION'),
+    "freq":             (3110, 2, 'FLOAT32'),
+    "energy":           (45100, 2, 'FLOAT32')
+}
+IEM2150_BLOCK_PLAN = compile_block_plan(IEM2150_REGISTER_MAP, plan_block_reads(IEM2150_REGISTER_MAP, MAX_GAP),
+                                        WORD_ORDER, BYTE_ORDER)
 
 
 # on Ubuntu, serial ports are in the form '/dev/ttyUSBx' where x is an integer 0-7
@@ -36,9 +63,12 @@ def find_serial_device():
  
 
         
-def configure(port):
+def configure(port, modbus_device_address=MODBUS_ADDRESS):
     try:
-        instrument = minimalmodbus.Instrument(port, MODBUS_ADDRESS, mode='rtu')
+        if MODBUS_ENGINE == 'rtu':
+            # cached request frames on the open port, see modbus_rtu.py
+            return modbus_rtu.RtuInstrument(port, modbus_device_address, BAUDRATE, timeout=0.5)
+        instrument = minimalmodbus.Instrument(port, modbus_device_address, mode='rtu')
         instrument.serial.baudrate = BAUDRATE
         instrument.serial.bytesize = 8
         instrument.serial.stopbits = 1
@@ -49,65 +79,54 @@ def configure(port):
         sys.stderr.write('Failed to configure modbus on port ' + port + '\n')
         raise ConnectionError('Modbus error')
 
+def probe(instrument):
+    instrument.read_registers(3109, 2)     # frequency
+
+def negotiate_baudrate(instrument):
+    # the rate is set on the meter's display, so it is found rather than changed
+    if MODBUS_ENGINE == 'rtu':
+        modbus_rtu.find_baudrate(instrument.serial, [lambda: probe(instrument)], SUPPORTED_BAUDRATES)
+        instrument.latencies.clear()
+
 def get_timestamp():
     now = time.gmtime()
     return time.strftime('%Y/%m/%d %H:%M:%S', now)
 
-def pf_adjust(pf_raw):
-    if pf_raw != pf_raw:  # deals with NaN special case
-        return 1.0, "leading"
-    elif pf_raw < 0:
-        if pf_raw < -1:
-            return -2-pf_raw, "leading"
-        else:
-            return pf, "lagging"
-    else:
-        if pf_raw >= 1:
-            return 2-pf_raw, "leading"
-        else:
-            return pf, "lagging"
-
-def get_readings(instrument):
+def get_readings(instrument, cache=None):
+    # one read per mapped register (both power factor fields from one), decoded together; a
+    # failed read is retried, and the last column gives each value's quality
     try:
-        # resulting low level bus comms noted in comments
-        volts = instrument.read_float(3027)
-            # typically sends 01 03 0b d3 00 02 37 d6      addr(1) fn(1) start-reg(2) quant-reg(2) crc(2)
-            # and receives    01 03 04 43 6f 97 0a 31 9d   addr(1) fn(1) quant-bytes(1) float(4) crc(2)
-        amps = instrument.read_float(2999)
-            # typically sends 01 03 0b b7 00 02 76 09
-            # and receives    01 03 04 3c cc cc cd a2 c9
-        power = instrument.read_float(3053)
-            # typically sends 01 03 0b ed 00 02 56 1a
-            # and receives    01 03 04 38 30 29 28 e8 d2
-        reactive_power = instrument.read_float(3067)
-            # typically sends 01 03 0b fb 00 02 b7 de
-            # and receives    01 03 04 bb b0 96 35 70 87
-        pf, pf_direction = pf_adjust(instrument.read_float(3083))
-            # typically sends 01 03 0c 0b 00 02 b6 99
-            # and receives    01 03 04 3f ff 00 69 06 39
-        freq = instrument.read_float(3109)
-            # typically sends 01 03 0c 25 00 02 d6 90
-            # and receives    01 03 04 42 47 f2 b1 db 4a
-        energy = instrument.read_float(45099)
-            # typically sends 01 03 b0 2b 00 02 92 c3
-            # and receives    01 03 04 43 2c d7 f7 30 08
-        timestamp = get_timestamp()
-        return timestamp, volts, amps, power, reactive_power, pf, pf_direction, freq, energy
+        readings, quality = read_blocks(lambda start, length: instrument.read_registers(start - 1, length),
+                                        IEM2150_BLOCK_PLAN, IEM2150_REGISTER_MAP, cache)
     except:
         sys.stderr.write('Failed to read instrument.\n')
         raise ConnectionError('Modbus error')
+    timestamp = get_timestamp()
+    return (timestamp,) + tuple(readings[k] for k in IEM2150_REGISTER_MAP.keys()) + \
+           (quality_codes(quality, IEM2150_REGISTER_MAP.keys()),)
 
 
-def print_csv_all_readings(timestamp, volts, amps, power, reactive_power, pf, pf_direction, freq, energy):
-    output = f'"{timestamp}",{volts},{amps},{power},{reactive_power},{pf},"{pf_direction}",{freq},{energy}'
+def format_csv_readings(timestamp, volts, amps, power, reactive_power, pf, pf_direction, freq, energy, quality):
+    # missing values are left empty
+    volts, amps, power, reactive_power, pf, freq, energy = \
+        ('' if value is None else value for value in (volts, amps, power, reactive_power, pf, freq, energy))
+    pf_direction = '' if pf_direction is None else f'"{pf_direction}"'
+    return f'"{timestamp}",{volts},{amps},{power},{reactive_power},{pf},{pf_direction},{freq},{energy},"{quality}"'
+
+
+def print_csv_all_readings(timestamp, volts, amps, power, reactive_power, pf, pf_direction, freq, energy, quality):
+    output = format_csv_readings(timestamp, volts, amps, power, reactive_power, pf, pf_direction, freq, energy, quality)
     print(output)
 
 
-def print_json_all_readings(timestamp, volts, amps, power, reactive_power, pf, pf_direction, freq, energy):
+def print_json_all_readings(timestamp, volts, amps, power, reactive_power, pf, pf_direction, freq, energy, quality):
+    volts, amps, power, reactive_power, pf, pf_direction, freq, energy = \
+        ('null' if value is None else value for value in (volts, amps, power, reactive_power, pf, pf_direction, freq, energy))
     output = \
 f'''{{
     "version": 1,
     "timestamp": "{timestamp}",
+    "quality": "{quality}",
     "points": {{
         "voltage": {{"present_value": {volts}}},
         "current": {{"present_value": {amps}}},
@@ -122,7 +141,7 @@ f'''{{
     print(output)
 
 
-def print_all_readings(timestamp, volts, amps, power, reactive_power, pf, pf_direction, freq, energy):
+def print_all_readings(timestamp, volts, amps, power, reactive_power, pf, pf_direction, freq, energy, quality):
     output = \
 f'''{timestamp}
 {volts} V
@@ -132,26 +151,42 @@ f'''{timestamp}
 {pf} pf
 {pf_direction} pf direction
 {freq} Hz
-{energy} kWh'''
+{energy} kWh
+{quality} quality'''
     print(output)
 
 
-# starts here
-try:
-    port = find_serial_device()
-    instrument = configure(port)
-    timestamp, volts, amps, power, reactive_power, pf, pf_direction, freq, energy = get_readings(instrument)
-    #print_csv_all_readings(timestamp, volts, amps, power, reactive_power, pf, pf_direction, freq, energy)
-    #print_json_all_readings(timestamp, volts, amps, power, reactive_power, pf, pf_direction, freq, energy)
-    print_all_readings(timestamp, volts, amps, power, reactive_power, pf, pf_direction, freq, energy)
-
-except ConnectionError:
-    sys.stderr.write('Error communicating with hardware.\n')
-    sys.exit(1)
-
-
-
-        
-
+def stream_readings(instrument, interval, ndjson):
+    # keep the port open and write one line per tick, flushed so a reading process sees it at once
+    schedule = Schedule(interval)
+    cache = {}
+    while True:
+        readings = get_readings(instrument, cache)
+        if ndjson:
+            print(json.dumps(dict(zip(['timestamp'] + list(IEM2150_REGISTER_MAP.keys()) + ['quality'], readings))), flush=True)
+        else:
+            print(format_csv_readings(*readings), flush=True)
+        schedule.wait()
 
 
+# starts here
+if __name__ == '__main__':
+    try:
+        cmd_parser = argparse.ArgumentParser(description='Read data from Schneider iEM2150 energy meter.')
+        cmd_parser.add_argument('--stream', action='store_true', help='keep reading, one CSV line per interval')
+        cmd_parser.add_argument('--interval', type=float, nargs='?', default=10.0, help='interval in seconds between streamed readings')
+        cmd_parser.add_argument('--ndjson', action='store_true', help='stream one JSON object per line instead of CSV')
+        args = cmd_parser.parse_args()
+
+        port = find_serial_device()
+        instrument = configure(port)
+        if args.stream:
+            stream_readings(instrument, args.interval, args.ndjson)
+        timestamp, volts, amps, power, reactive_power, pf, pf_direction, freq, energy, quality = get_readings(instrument)
+        #print_csv_all_readings(timestamp, volts, amps, power, reactive_power, pf, pf_direction, freq, energy, quality)
+        #print_json_all_readings(timestamp, volts, amps, power, reactive_power, pf, pf_direction, freq, energy, quality)
+        print_all_readings(timestamp, volts, amps, power, reactive_power, pf, pf_direction, freq, energy, quality)
+
+    except ConnectionError:
+        sys.stderr.write('Error communicating with hardware.\n')
+        sys.exit(1)
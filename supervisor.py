@@ -0,0 +1,121 @@
+# Copyright 2024 Arup
+# MIT License
+
+# In-process supervisor for the parts of the logger that can fail independently, such
+# as the meter driver, the log writer thread and the LED service thread.
+# Each component is made by a start function, which is given the failed instance (or
+# None the first time) so that a replacement can carry on where it stopped, eg the same
+# log file. A component fails when a call through call() raises, or when its alive check
+# returns False (a thread that has died). It is then stopped and restarted by check()
+# after a backoff that doubles with each failure in a row, from BACKOFF_START up to
+# BACKOFF_MAX seconds, and returns to BACKOFF_START after a successful call or once the
+# component has stayed up for STABLE_SECONDS. check() never waits, so the acquisition
+# loop keeps its cadence while a component is down; restarts and failures are counted.
+
+import sys
+import time
+
+
+BACKOFF_START = 1.0           # seconds before the first restart of a failed component
+BACKOFF_MAX = 60.0            # longest wait between restarts
+STABLE_SECONDS = 60.0         # seconds a restarted component must stay up to reset its backoff
+
+
+class Component:
+
+    def __init__(self, name, start, stop=None, alive=None):
+        self.name = name
+        self.start = start              # called with the previous instance, returns a new one
+        self.stop = stop                # called with a failed instance to release it
+        self.alive = alive              # called with the instance, False if it has died
+        self.instance = None
+        self.previous = None
+        self.backoff = BACKOFF_START
+        self.restart_at = 0.0           # monotonic time of the next restart attempt
+        self.started_at = None
+        self.failures = 0
+        self.restarts = 0
+        self.last_error = None
+
+
+class Supervisor:
+
+    def __init__(self, backoff_start=BACKOFF_START, backoff_max=BACKOFF_MAX, stable_seconds=STABLE_SECONDS):
+        self.backoff_start = backoff_start
+        self.backoff_max = backoff_max
+        self.stable_seconds = stable_seconds
+        self.components = {}
+
+    def add(self, name, start, stop=None, alive=None):
+        """Start a component; an error starting it for the first time is raised to the caller"""
+        component = Component(name, start, stop, alive)
+        component.backoff = self.backoff_start
+        component.instance = start(None)
+        component.started_at = time.monotonic()
+        self.components[name] = component
+        return component.instance
+
+    def get(self, name):
+        """The running instance of a component, or None while it waits to restart"""
+        return self.components[name].instance
+
+    def call(self, name, function, *args):
+        """function(instance, *args), marking the component failed if it raises. Raises
+        ConnectionError while the component is waiting to restart."""
+        component = self.components[name]
+        if component.instance is None:
+            raise ConnectionError(f'{name} is waiting to restart')
+        try:
+            result = function(component.instance, *args)
+        except Exception as e:
+            self.failed(name, e)
+            raise
+        component.backoff = self.backoff_start
+        return result
+
+    def failed(self, name, error=None):
+        component = self.components[name]
+        if component.instance is None:
+            return
+        component.failures = component.failures + 1
+        component.last_error = error
+        sys.stderr.write(f'{name} failed ({error}), restarting in {component.backoff:g} s.\n')
+        if component.stop is not None:
+            try:
+                component.stop(component.instance)
+            except Exception:
+                pass
+        component.previous = component.instance
+        component.instance = None
+        component.restart_at = time.monotonic() + component.backoff
+        component.backoff = min(component.backoff * 2, self.backoff_max)
+
+    def check(self):
+        """Restart any component that has died or is due a restart; never waits"""
+        now = time.monotonic()
+        for name, component in self.components.items():
+            if component.instance is not None:
+                if component.alive is not None and not component.alive(component.instance):
+                    self.failed(name, 'stopped')
+                elif now - component.started_at >= self.stable_seconds:
+                    component.backoff = self.backoff_start
+                continue
+            if now < component.restart_at:
+                continue
+            try:
+                component.instance = component.start(component.previous)
+            except Exception as e:
+                sys.stderr.write(f"Couldn't restart {name} ({e}).\n")
+                component.restart_at = now + component.backoff
+                component.backoff = min(component.backoff * 2, self.backoff_max)
+                continue
+            component.previous = None
+            component.started_at = now
+            component.restarts = component.restarts + 1
+            sys.stderr.write(f'{name} restarted ({component.restarts} restarts).\n')
+
+    def stats(self):
+        return { name: { 'up': component.instance is not None, 'failures': component.failures,
+                         'restarts': component.restarts, 'backoff': component.backoff,
+                         'last_error': None if component.last_error is None else str(component.last_error) }
+                 for name, component in self.components.items() }
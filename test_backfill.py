@@ -0,0 +1,105 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Tests for backfill.py: run with  python -m pytest -q
+
+import csv
+import time
+import pytest
+from backfill import BACKFILL_HEADERS, HistoryBackfill, TIME_FORMAT
+from rollups import ROLLUP_HEADERS
+
+
+HOUR = 3600
+# midnight UTC three days ago, so every period below has ended
+BASE = int(time.time()) // 86400 * 86400 - 3 * 86400
+
+
+class Rows:
+    """Stands in for the LogWriter of rollup-backfill.csv"""
+
+    def __init__(self):
+        self.rows = []
+
+    def write(self, text):
+        self.rows.extend(csv.reader(text.splitlines()))
+
+    def close(self):
+        pass
+
+
+def stamp(seconds):
+    return time.strftime(TIME_FORMAT, time.gmtime(seconds))
+
+
+def write_rollups(directory, logged_hours):
+    with open(directory / 'rollup-hourly.csv', 'w') as f:
+        f.write(ROLLUP_HEADERS + '\n')
+        for hour in logged_hours:
+            f.write(f'"{stamp(BASE + hour * HOUR)}","{stamp(BASE + (hour + 1) * HOUR)}",360,100.0,90.0,110.0,0.1,\n')
+
+
+def backfill(directory):
+    rows = Rows()
+    return HistoryBackfill(str(directory), rows), rows.rows
+
+
+def two_hours(start_hour, sensor=1, energy=0.5):
+    return (sensor, BASE + start_hour * HOUR, BASE + (start_hour + 2) * HOUR, energy, 'h')
+
+
+def test_gap_between_logged_hours_is_backfilled(tmp_path):
+    write_rollups(tmp_path, [0, 1, 2, 3, 4, 5, 10])
+    history, rows = backfill(tmp_path)
+    history.add_history([two_hours(6), two_hours(8), two_hours(4)])
+    assert [(row[0], row[2], row[5]) for row in rows] == \
+        [(stamp(BASE + 6 * HOUR), '1', '2 hourly'), (stamp(BASE + 8 * HOUR), '1', '2 hourly')]
+    assert float(rows[0][4]) == pytest.approx(250.0)      # 0.5 kWh over 2 hours
+    # each period is written once
+    history.add_history([two_hours(6)])
+    assert len(rows) == 2
+
+
+def test_hour_in_progress_at_stop_counts_as_logged(tmp_path):
+    write_rollups(tmp_path, [0, 1, 2])
+    history, rows = backfill(tmp_path)
+    history.add_history([two_hours(2), two_hours(4)])
+    assert [row[0] for row in rows] == [stamp(BASE + 4 * HOUR)]
+
+
+def test_history_before_the_first_rollup_is_not_a_gap(tmp_path):
+    write_rollups(tmp_path, [10, 11])
+    history, rows = backfill(tmp_path)
+    history.add_history([two_hours(0), two_hours(6), (1, BASE - 86400, BASE, 5.0, 'd')])
+    assert rows == []
+
+
+def test_history_before_installation_is_not_a_gap(tmp_path):
+    history, rows = backfill(tmp_path)
+    history.add_history([two_hours(0), (1, BASE, BASE + 86400, 5.0, 'd')])
+    assert rows == []
+
+
+def test_day_is_not_written_over_two_hour_periods(tmp_path):
+    write_rollups(tmp_path, [0, 60])
+    history, rows = backfill(tmp_path)
+    history.add_history([(1, BASE + 86400, BASE + 2 * 86400, 5.0, 'd'), two_hours(30)])
+    assert [row[5] for row in rows] == ['2 hourly']
+
+
+def test_logged_readings_and_unknown_sensors(tmp_path):
+    write_rollups(tmp_path, [0])
+    history, rows = backfill(tmp_path)
+    history.add_csv(f'"{stamp(BASE + 6 * HOUR + 10)}",100,,,,,,,,\n')
+    history.add_history([two_hours(6), two_hours(8, sensor=0), two_hours(8, sensor=2)])
+    assert [(row[0], row[2]) for row in rows] == [(stamp(BASE + 8 * HOUR), '2')]
+
+
+def test_backfilled_periods_are_remembered(tmp_path):
+    write_rollups(tmp_path, [0, 10])
+    with open(tmp_path / 'rollup-backfill.csv', 'w') as f:
+        f.write(BACKFILL_HEADERS + '\n')
+        f.write(f'"{stamp(BASE + 6 * HOUR)}","{stamp(BASE + 8 * HOUR)}",1,0.5,250.0,"2 hourly"\n')
+    history, rows = backfill(tmp_path)
+    history.add_history([two_hours(6), two_hours(6, sensor=2)])
+    assert [row[2] for row in rows] == ['2']
@@ -0,0 +1,151 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Tests for binary_log.py: run with  python -m pytest -q
+
+import gzip
+import io
+import pytest
+import binary_log
+import meter_drivers
+from binary_log import BinaryLog, BinaryLogFile, is_binary_log
+
+
+HEADERS = '"Time","Voltage","Cumulative energy","Power factor direction","Serial","Timestamp"'
+COLUMN_TYPES = ['time', 'f4', 'f8', 'text', 'text8', 'isotimez']
+ROWS = [
+    ['2024/01/01 00:00:10', '230.1', '12345.678', 'lagging', 'AB\xe9', '2024-01-01T00:00:10.123456Z'],
+    ['2024/01/01 00:00:20', '', '12345.7', 'leading', '', '2024-01-01T00:00:20Z'],
+] + [[f'2024/01/01 00:{i // 6:02}:{i % 6 * 10:02}', '229.5', str(12346 + i), 'lagging', 'AB', '2024-01-01T00:01:00Z']
+     for i in range(3, 12)]
+
+
+def write_log(path, rows=ROWS, column_types=COLUMN_TYPES, segment_records=4):
+    log = BinaryLogFile(str(path), HEADERS, segment_records, column_types)
+    for row in rows:
+        log.write(','.join(f'"{field}"' for field in row) + '\n')
+    log.close()
+
+
+def read_rows(path, verify=True):
+    log = BinaryLog(str(path))
+    try:
+        return [log.csv_row(values) for values in log.records(verify)]
+    finally:
+        log.close()
+
+
+def test_round_trip_across_segments(tmp_path):
+    path = tmp_path / 'log.bin'
+    write_log(path)
+    assert read_rows(path) == ROWS
+    log = BinaryLog(str(path))
+    assert [count for start, count in log.segments()] == [4, 4, 3]
+    assert log.names == ['Time', 'Voltage', 'Cumulative energy', 'Power factor direction', 'Serial', 'Timestamp']
+    log.close()
+
+
+def test_append_to_existing_log(tmp_path):
+    path = tmp_path / 'log.bin'
+    write_log(path, ROWS[:6])
+    write_log(path, ROWS[6:])
+    assert read_rows(path) == ROWS
+
+
+def test_text_columns_are_truncated(tmp_path):
+    path = tmp_path / 'log.bin'
+    row = ROWS[0][:4] + ['much longer than eight bytes'] + ROWS[0][5:]
+    write_log(path, [row])
+    assert read_rows(path)[0][4] == 'much lon'
+
+
+def test_short_line_is_padded(tmp_path):
+    path = tmp_path / 'log.bin'
+    write_log(path, [ROWS[0][:2]])
+    assert read_rows(path) == [ROWS[0][:2] + ['', '', '', '']]
+
+
+def test_compressed_log(tmp_path):
+    path = tmp_path / 'log.bin'
+    write_log(path)
+    with open(path, 'rb') as f, gzip.open(str(path) + '.gz', 'wb') as compressed:
+        compressed.write(f.read())
+    assert is_binary_log(str(path)) and is_binary_log(str(path) + '.gz')
+    assert not is_binary_log(str(tmp_path / 'log.csv.gz'))
+    assert read_rows(str(path) + '.gz') == ROWS
+
+
+def test_corrupt_segment_is_skipped(tmp_path):
+    path = tmp_path / 'log.bin'
+    write_log(path)
+    log = BinaryLog(str(path))
+    first_record = next(log.segments())[0]
+    log.close()
+    with open(path, 'r+b') as f:
+        f.seek(first_record + 8)
+        f.write(b'\xff')
+    assert read_rows(path) == ROWS[4:]
+    assert len(read_rows(path, verify=False)) == len(ROWS)
+
+
+def test_not_a_binary_log(tmp_path):
+    path = tmp_path / 'log.bin'
+    path.write_bytes(b'"Time","Power"\n')
+    with pytest.raises(ValueError):
+        BinaryLog(str(path))
+
+
+def test_export_csv(tmp_path):
+    path = tmp_path / 'log.bin'
+    write_log(path, ROWS[:1])
+    output = io.StringIO()
+    log = BinaryLog(str(path))
+    log.export_csv(output)
+    log.close()
+    assert output.getvalue() == HEADERS + '\n' + \
+        '"2024/01/01 00:00:10",230.1,12345.678,"lagging","AB\xe9","2024-01-01T00:00:10.123456Z"\n'
+
+
+def test_types_guessed_without_schema(tmp_path):
+    path = tmp_path / 'log.bin'
+    write_log(path, ROWS[:1], column_types=None)
+    log = BinaryLog(str(path))
+    assert [column for name, column in log.columns] == ['time', 'f4', 'f8', 'text', 'text', 'isotimez']
+    log.close()
+
+
+@pytest.mark.parametrize('driver, line, size', [
+    ('iem2150', '"2024/01/01 00:00:10",230.12344,1.2345679,283.12344,12.345678,0.99812347,"lagging",50.012344,12345.678,'
+                '"ggggggsg"', 51),
+    ('dds238', '"2024/01/01 00:00:10",230.1,1.23,283,12,0.998,50.01,12345.67,"ggggggg"', 47),
+])
+def test_driver_schemas(tmp_path, driver, line, size):
+    path = tmp_path / 'log.bin'
+    driver = meter_drivers.DRIVERS[driver]
+    log = BinaryLogFile(str(path), driver.csv_headers, column_types=driver.column_types)
+    log.write(line + '\n')
+    log.close()
+    log = BinaryLog(str(path))
+    assert log.record.size == size
+    output = io.StringIO()
+    log.export_csv(output)
+    log.close()
+    assert output.getvalue() == driver.csv_headers + '\n' + line + '\n'
+
+
+def test_array(tmp_path):
+    numpy = pytest.importorskip('numpy')
+    path = tmp_path / 'log.bin'
+    write_log(path)
+    log = BinaryLog(str(path))
+    records = log.array()
+    assert len(records) == len(ROWS)
+    assert records['Cumulative energy'][0] == 12345.678
+    assert numpy.isnan(records['Voltage'][1])
+    log.close()
+
+
+def test_parse_time():
+    assert binary_log.parse_time('1970/01/01 00:01:00') == (60, 'time')
+    assert binary_log.parse_time('1970-01-01T00:01:00.5Z') == (60.5, 'isotime')
+    assert binary_log.parse_time('230.1') is None
@@ -0,0 +1,134 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Tests for bus_poller.py, with simulated meters: run with  python -m pytest -q
+
+import argparse
+import csv
+import pytest
+
+pytest.importorskip('serial')
+pytest.importorskip('minimalmodbus')
+
+import bus_poller
+from bus_poller import BusMeter, BusPoller, MultiBusPoller, RecordWriter, bus_pollers, parse_meter
+
+
+class SimulatedPort:
+    """The serial port methods bus_poller.py uses"""
+
+    def __init__(self):
+        self.is_open = True
+        self.baudrate = 9600
+        self.closes = 0
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+        self.closes = self.closes + 1
+
+
+class SimulatedBus:
+    """Meters answering on simulated ports, failing while their port is dead"""
+
+    def __init__(self):
+        self.ports = {}
+        self.dead = set()               # ports whose adapter has gone
+        self.unplugged = set()          # ports that can't be opened
+        self.configured = 0
+
+    def configure(self, port, address):
+        if port in self.unplugged:
+            raise ConnectionError('Modbus error')
+        self.configured = self.configured + 1
+        serial_port = self.ports.setdefault(port, SimulatedPort())
+        return argparse.Namespace(serial=serial_port, address=address)
+
+    def read(self, meter):
+        if meter.port in self.dead or meter.address == 99:
+            raise ConnectionError('Modbus error')
+        return { 'timestamp': '2024/01/01 00:00:00', 'address': meter.address, 'tick': meter.tick }
+
+
+@pytest.fixture
+def bus(monkeypatch):
+    bus = SimulatedBus()
+    monkeypatch.setitem(bus_poller.METER_MODELS, 'iem2150', (bus.configure, bus.read))
+    return bus
+
+
+def test_failed_meter_is_skipped(bus):
+    poller = BusPoller('/dev/ttyUSB0', [BusMeter(1, 'iem2150'), BusMeter(99, 'iem2150')])
+    poller.open()
+    results = poller.poll()
+    assert [(meter.name, record['address']) for meter, record in results] == [('iem2150@1', 1)]
+    assert poller.meters['iem2150@99'].stats()['failures'] == 1
+    assert poller.poll(['iem2150@1'])[0][1]['tick'] == 1
+    assert poller.failed_polls == 0
+
+
+def test_dead_bus_is_reopened(bus):
+    poller = BusPoller('/dev/ttyUSB0', [BusMeter(1, 'iem2150'), BusMeter(2, 'iem2150')])
+    poller.open()
+    port = bus.ports['/dev/ttyUSB0']
+    bus.dead.add('/dev/ttyUSB0')
+    for i in range(bus_poller.REOPEN_FAILURES - 1):
+        assert poller.poll() == []
+    assert port.closes == 0 and bus.configured == 2
+    assert poller.poll() == []
+    assert port.closes == 1 and port.is_open and bus.configured == 4
+    bus.dead.clear()
+    assert len(poller.poll()) == 2
+
+
+def test_unplugged_adapter_is_tried_again(bus):
+    poller = BusPoller('/dev/ttyUSB0', [BusMeter(1, 'iem2150')])
+    poller.open()
+    bus.dead.add('/dev/ttyUSB0')
+    bus.unplugged.add('/dev/ttyUSB0')
+    for i in range(2 * bus_poller.REOPEN_FAILURES):
+        assert poller.poll() == []
+    assert bus.ports['/dev/ttyUSB0'].closes == 2
+    bus.dead.clear()
+    bus.unplugged.clear()
+    for i in range(bus_poller.REOPEN_FAILURES):
+        poller.poll()
+    assert len(poller.poll()) == 1
+
+
+def test_buses_are_polled_together(bus):
+    meters = [BusMeter(1, 'iem2150', bus='/dev/ttyUSB0'), BusMeter(1, 'iem2150', 60, bus='/dev/ttyUSB1'),
+              BusMeter(2, 'iem2150', bus='/dev/ttyUSB0')]
+    pollers = bus_pollers(meters, 9600)
+    assert [(poller.port, list(poller.meters)) for poller in pollers] == \
+        [('/dev/ttyUSB0', ['iem2150@1', 'iem2150@2']), ('/dev/ttyUSB1', ['iem2150@1'])]
+    poller = MultiBusPoller(pollers, 10)
+    poller.open()
+    results = poller.poll()
+    assert sorted(meter.name for meter, record in results) == \
+        ['ttyUSB0/iem2150@1', 'ttyUSB0/iem2150@2', 'ttyUSB1/iem2150@1']
+    assert [meter.name for meter, record in poller.poll(['ttyUSB1/iem2150@1'])] == ['ttyUSB1/iem2150@1']
+    poller.close()
+    assert not bus.ports['/dev/ttyUSB0'].is_open and not bus.ports['/dev/ttyUSB1'].is_open
+
+
+def test_record_writer(bus, tmp_path):
+    meter = BusMeter(1, 'iem2150')
+    meter.open('/dev/ttyUSB0', 9600)
+    writer = RecordWriter(str(tmp_path))
+    writer.write_tick(0, [(meter, meter.read())])
+    writer.write_tick(10, [(meter, meter.read())])
+    writer.close()
+    with open(tmp_path / 'iem2150-1.csv', newline='') as f:
+        assert list(csv.reader(f)) == [['timestamp', 'address', 'tick'], ['2024/01/01 00:00:00', '1', '0'],
+                                       ['2024/01/01 00:00:00', '1', '1']]
+
+
+def test_parse_meter():
+    meter = parse_meter('1=2:pm5100:60')
+    assert (meter.bus, meter.address, meter.model, meter.period) == ('1', 2, 'pm5100', 60.0)
+    assert parse_meter('3:dds238').bus is None
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_meter('iem2150')
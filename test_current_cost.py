@@ -0,0 +1,114 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Tests for current_cost.py, with a simulated base station: run with  python -m pytest -q
+
+import queue
+import time
+import pytest
+
+pytest.importorskip('serial')
+
+import current_cost
+from current_cost import CC128Reader, MessageParser, get_readings, history_intervals, sensor_reading
+
+
+def message(sensor, watts, channels=1):
+    return (f'<msg><src>CC128-v1.29</src><dsb>00089</dsb><time>13:02:39</time><tmpr>18.7</tmpr>'
+            f'<sensor>{sensor}</sensor><id>01234</id><type>1</type>'
+            + ''.join(f'<ch{i + 1}><watts>{watts + i:05}</watts></ch{i + 1}>' for i in range(channels)) +
+            '</msg>\r\n').encode('ascii')
+
+
+HISTORY = (b'<msg><src>CC128-v1.29</src><dsb>00089</dsb><time>13:10:50</time><hist><dsw>00032</dsw>'
+           b'<type>1</type><units>kwhr</units>'
+           b'<data><sensor>1</sensor><h004>1.330</h004><h006>0.500</h006><d001>5.0</d001><m001>150.0</m001></data>'
+           b'<data><sensor>x</sensor><h004>9.9</h004></data>'
+           b'</hist></msg>\r\n')
+
+
+class SimulatedPort:
+    """read() and in_waiting of the serial port, answering with queued data"""
+
+    def __init__(self, data=()):
+        self.data = queue.Queue()
+        for chunk in data:
+            self.data.put(chunk)
+        self.closed = False
+
+    @property
+    def in_waiting(self):
+        return 0
+
+    def read(self, size):
+        if self.closed:
+            raise OSError('port closed')
+        try:
+            return self.data.get(timeout=0.05)
+        except queue.Empty:
+            return b''
+
+    def close(self):
+        self.closed = True
+
+
+def test_messages_split_anywhere():
+    data = b'noise' + message(1, 250) + message(2, 1500, channels=3)
+    parser = MessageParser()
+    messages = []
+    for i in range(0, len(data), 7):
+        messages.extend(parser.feed(data[i:i + 7]))
+    assert [sensor_reading(m) for m in messages] == [(1, [250]), (2, [1500, 1501, 1502])]
+    assert parser.errors == 0
+
+
+def test_parser_resynchronises_after_noise():
+    parser = MessageParser()
+    assert parser.feed(message(1, 250)[:60] + b'<<garbage>') == []
+    assert parser.errors == 1
+    assert [sensor_reading(m) for m in parser.feed(b'\xff\x00' + message(3, 40))] == [(3, [40])]
+
+
+def test_history_intervals():
+    received = 1704067200 + 3 * 3600 + 600              # 2024/01/01 03:10:00
+    messages = MessageParser().feed(HISTORY)
+    assert sensor_reading(messages[0]) is None
+    # the current 2 hour period started at 02:00; h004 is the one ending 2 hours before it
+    assert history_intervals(messages[0], received) == [
+        (1, 1704067200 - 2 * 3600, 1704067200, 1.33, 'h'),
+        (1, 1704067200 - 4 * 3600, 1704067200 - 2 * 3600, 0.5, 'h'),
+        (1, 1704067200 - 86400, 1704067200, 5.0, 'd'),
+    ]
+    assert history_intervals(MessageParser().feed(message(1, 250))[0], received) == []
+
+
+def test_one_shot_reading_waits_for_a_round():
+    port = SimulatedPort([message(1, 250), message(2, 30), message(12, 5), message(1, 260)])
+    readings = get_readings(port)
+    assert readings[1:] == [250, 30] + [None] * 7
+
+
+def test_reader_keeps_the_latest_readings(monkeypatch):
+    port = SimulatedPort([message(1, 250), HISTORY, message(2, 30), message(1, 260)])
+    monkeypatch.setattr(current_cost, 'open_meter', lambda port_name: port)
+    history = []
+    reader = CC128Reader(on_history=history.extend)
+    deadline = time.monotonic() + 2
+    while reader.messages < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    readings = reader.snapshot()
+    assert readings[1:] == [260, 30] + [None] * 7
+    assert [interval[4] for interval in history] == ['h', 'h', 'd']
+    with pytest.raises(ConnectionError):
+        reader.snapshot(stale=-1)       # every sensor stale
+    reader.close()
+    with pytest.raises(ConnectionError):
+        reader.snapshot()
+
+
+def test_nothing_received(monkeypatch):
+    monkeypatch.setattr(current_cost, 'open_meter', lambda port_name: SimulatedPort())
+    reader = CC128Reader()
+    with pytest.raises(ConnectionError):
+        reader.snapshot(timeout=0.1)
+    reader.close()
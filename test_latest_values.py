@@ -0,0 +1,87 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Tests for latest_values.py, on a private shared memory segment: run with  python -m pytest -q
+
+import math
+import os
+import pytest
+
+posix_ipc = pytest.importorskip('posix_ipc')
+
+import latest_values
+from latest_values import LatestValuesReader, LatestValuesWriter
+
+
+@pytest.fixture
+def segment():
+    name = f'/energy_scribe_test_{os.getpid()}'
+    writer = LatestValuesWriter(name, slots=2)
+    reader = LatestValuesReader(name)
+    yield writer, reader
+    reader.close()
+    writer.close()
+    posix_ipc.unlink_shared_memory(name)
+
+
+def test_publish_and_read(segment):
+    writer, reader = segment
+    writer.publish('iem2150', { 'timestamp': '2024/01/01 00:00:00', 'volts': 230.5, 'pf_direction': 'lagging',
+                                'power': '1.5', 'ok': True })
+    stamp, values = reader.read('iem2150')
+    assert values == { 'volts': 230.5, 'power': 1.5 }
+    assert reader.value('iem2150', 'volts') == 230.5
+    assert reader.value('iem2150', 'ok') is None
+    assert reader.value('pm5100', 'volts') is None
+    assert reader.meters() == ['iem2150']
+
+
+def test_missing_value_keeps_its_place(segment):
+    writer, reader = segment
+    writer.publish('iem2150', { 'volts': 230.5, 'power': 1.5 })
+    assert reader.value('iem2150', 'power') == 1.5
+    writer.publish('iem2150', { 'volts': 231.0, 'power': None })
+    assert math.isnan(reader.value('iem2150', 'power'))
+    assert reader.value('iem2150', 'volts') == 231.0
+
+
+def test_new_field_changes_the_layout(segment):
+    writer, reader = segment
+    writer.publish('iem2150', { 'volts': 230.5 })
+    assert reader.value('iem2150', 'volts') == 230.5
+    writer.publish('iem2150', { 'amps': 2.0, 'volts': 231.0 })
+    assert reader.value('iem2150', 'amps') == 2.0
+    assert reader.read('iem2150')[1] == { 'volts': 231.0, 'amps': 2.0 }
+
+
+def test_long_pm5100_names(segment):
+    writer, reader = segment
+    name = 'average_line_neutral_harmonic_distortion_voltage_sensor'
+    too_long = 'x' * (latest_values.NAME_LENGTH + 1)
+    writer.publish('pm5100', { name: 1.25, too_long: 2.0 })
+    assert reader.value('pm5100', name) == 1.25
+    assert reader.read('pm5100')[1] == { name: 1.25 }
+    with pytest.raises(ValueError):
+        writer.publish(too_long, { name: 1.0 })
+
+
+def test_publish_csv_uses_the_last_line(segment):
+    writer, reader = segment
+    writer.publish_csv('dds238', '"Time","Voltage","Power"', '"2024/01/01 00:00:00",230,1\n"2024/01/01 00:00:10",231,2\n')
+    assert reader.read('dds238')[1] == { 'Voltage': 231.0, 'Power': 2.0 }
+
+
+def test_slots_run_out(segment):
+    writer, reader = segment
+    writer.publish('a', { 'v': 1 })
+    writer.publish('b', { 'v': 2 })
+    with pytest.raises(ValueError):
+        writer.publish('c', { 'v': 3 })
+
+
+def test_numeric():
+    assert latest_values.numeric('1.5') == 1.5
+    assert latest_values.numeric(3) == 3.0
+    assert latest_values.numeric(True) is None
+    assert latest_values.numeric('lagging') is None
+    assert latest_values.numeric(None) is None
@@ -0,0 +1,93 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Tests for log_analysis.py: run with  python -m pytest -q
+
+import gzip
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+import meter_drivers
+from log_analysis import MeterAnalysis, analyse, meter_driver, read_chunks
+
+
+IEM2150_HEADERS = meter_drivers.DRIVERS['iem2150'].csv_headers
+DDS238_HEADERS = meter_drivers.DRIVERS['dds238'].csv_headers
+NAN = float('nan')
+
+
+def chunk(times, power, energy=None, pf=None, units=1.0):
+    array = lambda values: numpy.array(values, dtype=numpy.float64) if values is not None else None
+    return { 'time': array(times), 'power': array(power), 'energy': array(energy), 'pf': array(pf),
+             'energy_per_power_second': units }
+
+
+def total_energy(analysis):
+    return sum(energy for start, energy, integrated, ratio in analysis.consumption() if energy is not None)
+
+
+def test_consumption_and_integrated_power():
+    analysis = MeterAnalysis(period=3600)
+    analysis.add(chunk([0, 10, 20, 3600], [1.0, 1.0, 1.0, 1.0], [5.0, 5.5, 6.0, 7.0], units=0.05))
+    rows = analysis.consumption()
+    assert [(start, energy) for start, energy, integrated, ratio in rows] == [(0, 1.0), (3600, 1.0)]
+    # 20 s at 1.0 by 0.05; the 3580 s gap is longer than MAX_GAP and not integrated
+    assert rows[0][2] == pytest.approx(1.0) and rows[0][3] == pytest.approx(1.0)
+
+
+def test_missing_energy_reading_is_not_lost():
+    analysis = MeterAnalysis()
+    analysis.add(chunk([0, 10, 20, 30], [1.0] * 4, [1.0, NAN, NAN, 1.5]))
+    assert total_energy(analysis) == pytest.approx(0.5)
+
+
+def test_missing_energy_reading_across_chunks():
+    analysis = MeterAnalysis()
+    analysis.add(chunk([0, 10], [1.0, 1.0], [1.0, NAN]))
+    analysis.add(chunk([20], [1.0], [NAN]))
+    analysis.add(chunk([30, 40], [1.0, 1.0], [1.5, 2.0]))
+    assert total_energy(analysis) == pytest.approx(1.0)
+
+
+def test_rollover_and_reset():
+    analysis = MeterAnalysis(rollover=1000)
+    analysis.add(chunk([0, 10, 20], [1.0] * 3, [998.0, 2.0, 1.0]))
+    assert total_energy(analysis) == pytest.approx(5.0)
+
+
+def test_profile_peak_and_pf():
+    analysis = MeterAnalysis(profile_bin=900, demand_window=900)
+    analysis.add(chunk([0, 450, 900, 1350], [1.0, 3.0, 10.0, NAN], pf=[0.92, 0.92, -0.48, NAN]))
+    profile = dict(analysis.daily_profile())
+    assert profile[0] == 2.0 and profile[900] == 10.0 and profile[1800] is None
+    assert analysis.peak_demand() == (900.0, 10.0)
+    counts = [(round(low, 2), count) for low, high, count in analysis.pf_distribution() if count]
+    assert counts == [(-0.5, 1), (0.9, 2)]
+
+
+def test_meter_driver_prefers_exact_headers():
+    headers = DDS238_HEADERS.replace('"', '').split(',')
+    assert meter_driver(headers) is meter_drivers.DRIVERS['dds238']
+    assert meter_driver(IEM2150_HEADERS.replace('"', '').split(',')) is meter_drivers.DRIVERS['iem2150']
+    assert meter_driver(['Time', 'Power', 'Other']).power_column == 'Power'
+    with pytest.raises(ValueError):
+        meter_driver(['Time', 'Watts'])
+
+
+def test_read_csv_chunks(tmp_path):
+    path = tmp_path / '20240101-00.00.00.csv.gz'
+    with gzip.open(path, 'wt') as f:
+        f.write(DDS238_HEADERS + '\n')
+        f.write('"2024/01/01 00:00:00",230,1,100,0,0.9,50,10.0,"ggggggg"\n')
+        f.write('"2024/01/01 00:00:10",230\n"2024/01/01 00:00:20",230\n')
+        f.write('"2024/01/01 00:00:30",230,1,,0,0.9,50,,"ggmgggm"\n')
+        f.write('"2024/01/01 00:00:40",230,1,300,0,0.9,50,10.2,"ggggggg"\n')
+    chunks = list(read_chunks(str(path), chunk_rows=2))
+    # batches of two rows, less the short ones
+    assert [len(c['time']) for c in chunks] == [1, 1, 1]
+    assert chunks[0]['time'][0] == 1704067200
+    assert numpy.isnan(chunks[1]['power'][0])
+    assert chunks[1]['energy_per_power_second'] == meter_drivers.DRIVERS['dds238'].energy_per_power_second
+    analysis = analyse([str(path)])
+    assert total_energy(analysis) == pytest.approx(0.2)
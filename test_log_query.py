@@ -0,0 +1,107 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Tests for log_query.py: run with  python -m pytest -q
+
+import gzip
+import shutil
+import pytest
+import log_query
+from binary_log import BinaryLogFile, parse_time
+from log_query import LogIndex, query
+
+
+HEADERS = '"Time","Voltage","Power"'
+
+
+def seconds(stamp):
+    return parse_time(stamp)[0]
+
+
+def lines(hour, count):
+    return ''.join(f'"2024/01/01 {hour:02}:{i // 60:02}:{i % 60:02}",230,{i}\n' for i in range(count))
+
+
+def write_csv(path, hour, count):
+    with open(path, 'w') as f:
+        f.write(HEADERS + '\n' + lines(hour, count))
+
+
+def write_binary(path, hour, count):
+    log = BinaryLogFile(str(path), HEADERS, 16, ['time', 'f4', 'f4'])
+    log.write(lines(hour, count))
+    log.close()
+
+
+def compress(path):
+    with open(path, 'rb') as source, gzip.open(str(path) + '.gz', 'wb') as target:
+        shutil.copyfileobj(source, target)
+    path.unlink()
+
+
+def test_csv_query_uses_the_index(tmp_path):
+    path = tmp_path / '20240101-00.00.00.csv'
+    write_csv(path, 0, 1000)
+    rows = list(query(str(tmp_path), seconds('2024/01/01 00:10:00'), seconds('2024/01/01 00:10:02')))
+    assert rows == [['Time', 'Voltage', 'Power']] + \
+        [[f'2024/01/01 00:10:0{i}', '230', str(600 + i)] for i in range(3)]
+    index = LogIndex(str(path))
+    assert index.rows == 1000 and len(index.times) == 8
+    assert index.first == seconds('2024/01/01 00:00:00') and index.last == seconds('2024/01/01 00:16:39')
+
+
+def test_index_follows_a_growing_file(tmp_path):
+    path = tmp_path / '20240101-00.00.00.csv'
+    write_csv(path, 0, 10)
+    assert len(list(query(str(tmp_path)))) == 11
+    with open(path, 'a') as f:
+        f.write('"2024/01/01 00:00:10",230,10\n"2024/01/01 00:00:11",2')
+    rows = list(query(str(tmp_path), seconds('2024/01/01 00:00:09')))
+    assert [row[2] for row in rows[1:]] == ['9', '10']
+    assert LogIndex(str(path)).rows == 11
+
+
+def test_binary_and_compressed_logs(tmp_path):
+    write_binary(tmp_path / '20240101-00.00.00.bin', 0, 100)
+    compress(tmp_path / '20240101-00.00.00.bin')
+    write_binary(tmp_path / '20240101-01.00.00.bin', 1, 100)
+    rows = list(query(str(tmp_path), seconds('2024/01/01 00:01:38'), seconds('2024/01/01 01:00:01'),
+                      columns=['Time', 'Power']))
+    assert rows == [['Time', 'Power'], ['2024/01/01 00:01:38', '98'], ['2024/01/01 00:01:39', '99'],
+                    ['2024/01/01 01:00:00', '0'], ['2024/01/01 01:00:01', '1']]
+
+
+def test_files_outside_the_range_are_not_opened(tmp_path, monkeypatch, capsys):
+    # unreadable logs: opening either would fail
+    (tmp_path / '20240101-00.00.00.csv.gz').write_bytes(b'not gzip')
+    (tmp_path / '20240101-01.00.00.bin.gz').write_bytes(b'not gzip')
+    write_binary(tmp_path / '20240101-02.00.00.bin', 2, 10)
+    write_csv(tmp_path / '20240101-03.00.00.csv', 3, 10)
+    with open(tmp_path / 'manifest.csv', 'w') as f:
+        f.write('"Segment","First","Last","Records","Bytes"\n')
+        f.write('"20240101-01.00.00.bin.gz","2024/01/01 01:00:00","2024/01/01 01:30:00",1800,1000\n')
+    opened = []
+    binary_log = log_query.BinaryLog
+    monkeypatch.setattr(log_query, 'BinaryLog', lambda path: opened.append(path) or binary_log(path))
+    rows = list(query(str(tmp_path), seconds('2024/01/01 01:45:00'), seconds('2024/01/01 02:00:01')))
+    assert [row[0] for row in rows] == ['Time', '2024/01/01 02:00:00', '2024/01/01 02:00:01']
+    assert opened == [str(tmp_path / '20240101-02.00.00.bin')]
+    assert capsys.readouterr().err == ''
+
+
+def test_file_ranges():
+    paths = ['20240101-00.00.00-1.csv', '20240101-00.00.00.csv', '20240101-01.00.00.csv.gz', 'other.csv']
+    start = seconds('2024/01/01 00:00:00')
+    manifest = { '20240101-01.00.00.csv.gz': (start + 3600, start + 3700) }
+    assert log_query.file_ranges(paths, manifest) == \
+        [(start, start + 3601), (start, start + 3601), (start + 3600, start + 3701), (None, None)]
+
+
+def test_rollups_are_queried_by_start(tmp_path):
+    with open(tmp_path / 'rollup-hourly.csv', 'w') as f:
+        f.write('"Start","End","Power"\n')
+        f.write('"2024/01/01 00:00:00","2024/01/01 01:00:00",100\n')
+        f.write('"2024/01/01 01:00:00","2024/01/01 02:00:00",200\n')
+    assert list(query(str(tmp_path))) == []
+    rows = list(query(str(tmp_path), seconds('2024/01/01 00:30:00'), pattern='rollup-hourly.csv'))
+    assert rows == [['Start', 'End', 'Power'], ['2024/01/01 01:00:00', '2024/01/01 02:00:00', '200']]
@@ -0,0 +1,128 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Tests for log_writer.py: run with  python -m pytest -q
+
+import gzip
+import time
+import pytest
+from log_writer import LogWriter
+
+
+HEADER = '"Time","Power"\n'
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def record(i):
+    return f'"2024/01/01 00:00:{i:02}",{i}\n'
+
+
+def test_records_are_written_in_batches(tmp_path):
+    path = tmp_path / 'log.csv'
+    writer = LogWriter(str(path), HEADER, flush_records=3)
+    writer.write(record(0))
+    writer.write(record(1))
+    assert wait_for(lambda: writer.records.empty())
+    assert not path.exists()
+    writer.write(record(2))
+    assert wait_for(lambda: writer.written == 3)
+    assert path.read_text() == HEADER + record(0) + record(1) + record(2)
+    writer.write(record(3))
+    writer.close()
+    assert path.read_text().endswith(record(3))
+    assert writer.stats()['written'] == 4 and writer.stats()['dropped'] == 0
+
+
+def test_flush_seconds(tmp_path):
+    path = tmp_path / 'log.csv'
+    writer = LogWriter(str(path), HEADER, flush_records=None, flush_seconds=0.05)
+    writer.write(record(0))
+    assert wait_for(lambda: writer.written == 1)
+    writer.close()
+
+
+def test_records_are_spooled_while_the_directory_is_missing(tmp_path):
+    directory = tmp_path / 'stick'
+    writer = LogWriter(str(directory / 'log.csv'), HEADER, flush_records=1, retry_seconds=0.05)
+    for i in range(3):
+        writer.write(record(i))
+    assert wait_for(lambda: writer.detached and len(writer.spool) == 3)
+    directory.mkdir()
+    assert wait_for(lambda: writer.written == 3)
+    assert not writer.detached
+    writer.close()
+    assert (directory / 'log.csv').read_text() == HEADER + ''.join(record(i) for i in range(3))
+
+
+def test_full_spool_drops_the_oldest(tmp_path):
+    writer = LogWriter(str(tmp_path / 'missing' / 'log.csv'), HEADER, flush_records=1,
+                       spool_size=2 * len(record(0)), retry_seconds=60)
+    for i in range(4):
+        writer.write(record(i))
+    assert wait_for(lambda: writer.dropped == 2)
+    assert [entry[1] for entry in writer.spool] == [record(2), record(3)]
+    assert writer.spool_fill() == 1.0
+    writer.close()
+
+
+def test_take_over_keeps_the_spool(tmp_path):
+    directory = tmp_path / 'stick'
+    previous = LogWriter(str(directory / 'log.csv'), HEADER, flush_records=1, retry_seconds=60)
+    previous.write(record(0))
+    assert wait_for(lambda: len(previous.spool) == 1)
+    previous.records.put(None)
+    previous.join()
+    previous.records.put((time.time(), record(1)))
+    directory.mkdir()
+    writer = LogWriter(str(directory / 'log.csv'), HEADER, flush_records=1, previous=previous)
+    writer.write(record(2))
+    writer.close()
+    assert (directory / 'log.csv').read_text() == HEADER + record(0) + record(1) + record(2)
+
+
+def test_binary_format(tmp_path):
+    binary_log = pytest.importorskip('binary_log')
+    path = tmp_path / 'log.bin'
+    writer = LogWriter(str(path), HEADER, flush_records=1, log_format='binary', column_types=['time', 'f4'])
+    writer.write(record(0))
+    writer.write(record(1))
+    writer.close()
+    log = binary_log.BinaryLog(str(path))
+    assert [log.csv_row(values) for values in log.records()] == [['2024/01/01 00:00:00', '0'], ['2024/01/01 00:00:01', '1']]
+    log.close()
+
+
+def test_hourly_rotation_and_manifest(tmp_path):
+    start = 1704067200          # 2024/01/01 00:00:00
+    writer = LogWriter(str(tmp_path / '%Y%m%d-%H.%M.%S.csv'), HEADER, flush_records=1, rotate='hourly',
+                       compression='gzip')
+    for stamp in (start + 10, start + 20, start + 3600):
+        writer.records.put((stamp, record(stamp % 60)))
+    writer.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+        ['20240101-00.00.10.csv.gz', '20240101-01.00.00.csv.gz', 'manifest.csv']
+    with gzip.open(tmp_path / '20240101-00.00.10.csv.gz', 'rt') as f:
+        assert f.read() == HEADER + record(10) + record(20)
+    manifest = (tmp_path / 'manifest.csv').read_text().splitlines()
+    assert manifest[0] == '"Segment","First","Last","Records","Bytes"'
+    assert manifest[1].startswith('"20240101-00.00.10.csv.gz","2024/01/01 00:00:10","2024/01/01 00:00:20",2,')
+    assert manifest[2].startswith('"20240101-01.00.00.csv.gz","2024/01/01 01:00:00","2024/01/01 01:00:00",1,')
+
+
+def test_size_rotation_in_the_same_second(tmp_path):
+    start = 1704067200
+    writer = LogWriter(str(tmp_path / '%Y%m%d-%H.%M.%S.csv'), HEADER, flush_records=1,
+                       rotate_bytes=len(HEADER) + 1)
+    for i in range(3):
+        writer.records.put((start, record(i)))
+    writer.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+        ['20240101-00.00.00-1.csv', '20240101-00.00.00-2.csv', '20240101-00.00.00.csv', 'manifest.csv']
@@ -0,0 +1,153 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Tests for modbus_rtu.py, with a simulated serial port: run with  python -m pytest -q
+
+import struct
+import pytest
+import modbus_rtu
+from modbus_rtu import crc16, read_request, with_crc
+
+
+# the iEM2150 voltage request and a response, as in the driver's comments
+VOLTS_REQUEST = bytes.fromhex('01 03 0b d3 00 02 37 d6')
+VOLTS_RESPONSE = bytes.fromhex('01 03 04 43 6f 97 0a 31 9d')
+
+
+class SimulatedSerial:
+    """The pyserial methods RtuBus uses, answering from registers at one baud rate.
+    It has no fileno(), so RtuBus waits with the port timeout as on Windows."""
+
+    def __init__(self, port, baudrate=9600, timeout=0.5, registers=None, answer_at=None, **settings):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.is_open = True
+        self.registers = registers if registers is not None else {}
+        self.answer_at = answer_at      # the only baud rate answered, or None for any
+        self.pending = b''
+        self.requests = []
+
+    @property
+    def in_waiting(self):
+        return len(self.pending)
+
+    def reset_input_buffer(self):
+        self.pending = b''
+
+    def write(self, request):
+        self.requests.append(request)
+        if self.answer_at is not None and self.baudrate != self.answer_at:
+            return
+        slave, function, register, count = struct.unpack('>BBHH', request[:6])
+        if register not in self.registers:
+            self.pending = with_crc(struct.pack('>BBB', slave, function | 0x80, 2))
+            return
+        words = [self.registers.get(register + i, 0) for i in range(count)]
+        self.pending = with_crc(struct.pack(f'>BBB{count}H', slave, function, 2 * count, *words))
+
+    def read(self, size):
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def close(self):
+        self.is_open = False
+
+
+@pytest.fixture
+def port(monkeypatch):
+    monkeypatch.setattr(modbus_rtu, 'BUSES', {})
+    monkeypatch.setattr(modbus_rtu, 'PORT_BAUDRATES', {})
+    monkeypatch.setattr(modbus_rtu.serial, 'Serial', SimulatedSerial)
+    return 'sim0'
+
+
+def test_crc16_of_documented_frames():
+    assert crc16(VOLTS_REQUEST[:-2]) == struct.unpack('<H', VOLTS_REQUEST[-2:])[0]
+    # the CRC of a frame including its own CRC is zero
+    assert crc16(VOLTS_REQUEST) == 0
+    assert crc16(VOLTS_RESPONSE) == 0
+    assert crc16(b'') == 0xFFFF
+
+
+def test_crc16_matches_bitwise_crc():
+    data = bytes(range(256))
+    crc = 0xFFFF
+    for byte in data:
+        crc = crc ^ byte
+        for bit in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    assert crc16(data) == crc
+
+
+def test_read_request_frame():
+    # register numbers are one less on the wire: 3028 is sent as 0x0bd3
+    assert read_request(1, 3, 3027, 2) == VOLTS_REQUEST
+    assert read_request(1, 3, 3027, 2) is read_request(1, 3, 3027, 2)
+
+
+def test_frame_gap():
+    assert modbus_rtu.frame_gap(9600) == pytest.approx(3.5 * 11 / 9600)
+    assert modbus_rtu.frame_gap(38400) == modbus_rtu.MIN_FRAME_GAP
+
+
+def test_read_registers(port):
+    instrument = modbus_rtu.RtuInstrument(port, 1)
+    instrument.serial.registers.update({ 3027: 0x436f, 3028: 0x970a })
+    assert instrument.read_registers(3027, 2) == [0x436f, 0x970a]
+    assert instrument.read_float(3027) == pytest.approx(239.59, abs=0.01)
+    assert instrument.serial.requests[0] == VOLTS_REQUEST
+
+
+def test_instruments_share_the_port(port):
+    first = modbus_rtu.RtuInstrument(port, 1)
+    second = modbus_rtu.RtuInstrument(port, 2)
+    assert first.bus is second.bus and first.serial is second.serial
+
+
+def test_exception_response(port):
+    instrument = modbus_rtu.RtuInstrument(port, 1)
+    with pytest.raises(ConnectionError, match='Modbus exception 2'):
+        instrument.read_registers(100, 2)
+
+
+def test_corrupt_response(port):
+    instrument = modbus_rtu.RtuInstrument(port, 1)
+    instrument.serial.registers[0] = 1
+    write = instrument.serial.write
+    def corrupting_write(request):
+        write(request)
+        instrument.serial.pending = instrument.serial.pending[:-1] + b'\x00'
+    instrument.serial.write = corrupting_write
+    with pytest.raises(ConnectionError, match='CRC'):
+        instrument.read_registers(0, 1)
+
+
+def test_no_response_counts_as_timeout(port):
+    instrument = modbus_rtu.RtuInstrument(port, 1, timeout=0.3)
+    instrument.serial.answer_at = 19200
+    with pytest.raises(ConnectionError, match='No response'):
+        instrument.read_registers(0, 1)
+    assert list(instrument.latencies) == [0.3]
+
+
+def test_timeout_adapts_to_turnaround(port):
+    instrument = modbus_rtu.RtuInstrument(port, 1, timeout=0.5)
+    assert instrument.timeout(9) == 0.5
+    instrument.latencies.extend([0.01] * modbus_rtu.MIN_SAMPLES)
+    expected = modbus_rtu.TIMEOUT_MARGIN * 0.01 + modbus_rtu.wire_time(9, 9600)
+    assert instrument.timeout(9) == pytest.approx(max(expected, modbus_rtu.MIN_TIMEOUT))
+    instrument.latencies.extend([1.0] * modbus_rtu.LATENCY_SAMPLES)
+    assert instrument.timeout(9) == 0.5
+
+
+def test_find_baudrate(port):
+    instrument = modbus_rtu.RtuInstrument(port, 1)
+    instrument.serial.registers[0] = 1
+    instrument.serial.answer_at = 19200
+    assert modbus_rtu.find_baudrate(instrument.serial, [lambda: instrument.read_registers(0, 1)]) == 19200
+    assert modbus_rtu.PORT_BAUDRATES[port] == 19200
+    instrument.serial.answer_at = 600
+    with pytest.raises(ConnectionError):
+        modbus_rtu.find_baudrate(instrument.serial, [lambda: instrument.read_registers(0, 1)])
+    assert instrument.serial.baudrate == 19200
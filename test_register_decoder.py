@@ -0,0 +1,186 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Tests for register_decoder.py: run with  python -m pytest -q
+
+import struct
+import pytest
+import register_decoder
+from register_decoder import (compile_block_plan, decode_batch, decode_block, plan_block_reads,
+                              quality_codes, read_blocks)
+
+
+REGISTER_MAP = {
+    "volts":        (3028, 2, 'FLOAT32'),
+    "amps":         (3000, 2, 'FLOAT32'),
+    "pf":           (3084, 2, 'PF4Q'),
+    "pf_direction": (3084, 2, 'PF4Q_DIRECTION'),
+    "count":        (3090, 1, 'INT16U.2'),
+    "total":        (3092, 2, 'INT32U'),
+    "firmware":     (3100, 3, 'FIRMWARE'),
+    "name":         (3110, 4, 'STRING8'),
+}
+VALUES = {
+    "volts": 230.5, "amps": 1.25, "pf": 0.5, "pf_direction": 'lagging', "count": 12.34,
+    "total": 70000, "firmware": '1.2.3', "name": 'iEM\xe9',
+}
+
+
+def register_words(word_order='big', byte_order='big'):
+    """Register number: word, as the meter would send VALUES"""
+    raw = {
+        3028: struct.pack('>f', 230.5), 3000: struct.pack('>f', 1.25), 3084: struct.pack('>f', 0.5),
+        3090: struct.pack('>H', 1234), 3092: struct.pack('>I', 70000),
+        3100: struct.pack('>3H', 1, 2, 3), 3110: 'iEM\xe9'.encode('latin-1') + bytes(4),
+    }
+    words = {}
+    for register, data in raw.items():
+        values = list(struct.unpack(f'>{len(data) // 2}H', data))
+        # word order applies to numbers, not to the firmware triple or text
+        if word_order == 'little' and register not in (3100, 3110):
+            values.reverse()
+        if byte_order == 'little':
+            values = [struct.unpack('<H', struct.pack('>H', value))[0] for value in values]
+        for offset, value in enumerate(values):
+            words[register + offset] = value
+    return words
+
+
+def reader(words, reads=None, fail=lambda start, length: False):
+    def read(start, length):
+        if reads is not None:
+            reads.append((start, length))
+        if fail(start, length):
+            raise ConnectionError('No response')
+        return [words.get(register, 0) for register in range(start, start + length)]
+    return read
+
+
+def decode_plan(block_plan, words):
+    readings = {}
+    for layout in block_plan:
+        decode_block(reader(words)(layout.start, layout.length), layout, readings)
+    return readings
+
+
+def test_plan_merges_gaps_within_max_gap():
+    spans = plan_block_reads(REGISTER_MAP, max_gap=30)
+    assert [(start, length) for start, length, keys in spans] == [(3000, 30), (3084, 30)]
+    assert plan_block_reads(REGISTER_MAP, max_gap=0)[0] == (3000, 2, ['amps'])
+
+
+def test_plan_keeps_overlapping_fields_together():
+    spans = plan_block_reads(REGISTER_MAP, max_gap=-1)
+    assert (3084, 2, ['pf', 'pf_direction']) in spans
+    assert len(spans) == len(REGISTER_MAP) - 1
+
+
+def test_plan_limits_block_length():
+    spans = plan_block_reads(REGISTER_MAP, max_gap=1000, max_length=20)
+    assert all(length <= 20 for start, length, keys in spans)
+    assert sorted(k for start, length, keys in spans for k in keys) == sorted(REGISTER_MAP)
+
+
+@pytest.mark.parametrize('max_gap', [-1, 0, 10, 30, 125])
+def test_block_plan_decodes_like_single_registers(max_gap):
+    words = register_words()
+    blocks = decode_plan(compile_block_plan(REGISTER_MAP, plan_block_reads(REGISTER_MAP, max_gap)), words)
+    single = decode_plan(compile_block_plan(REGISTER_MAP, [(spec[0], spec[1], [k]) for k, spec in REGISTER_MAP.items()]),
+                         words)
+    assert blocks == single
+    assert blocks == pytest.approx(VALUES)
+
+
+@pytest.mark.parametrize('word_order', ['big', 'little'])
+@pytest.mark.parametrize('byte_order', ['big', 'little'])
+def test_word_and_byte_order(word_order, byte_order):
+    block_plan = compile_block_plan(REGISTER_MAP, plan_block_reads(REGISTER_MAP), word_order, byte_order)
+    assert decode_plan(block_plan, register_words(word_order, byte_order)) == pytest.approx(VALUES)
+
+
+def test_pf4q_quadrants():
+    assert register_decoder.pf_from_pf4q(0.9) == 0.9
+    assert register_decoder.pf_from_pf4q(1.5) == pytest.approx(0.5)
+    assert register_decoder.pf_from_pf4q(-1.5) == pytest.approx(-0.5)
+    assert register_decoder.pf_from_pf4q(float('nan')) == 1.0
+    assert register_decoder.pf_direction_from_pf4q(0.9) == 'lagging'
+    assert register_decoder.pf_direction_from_pf4q(1.5) == 'leading'
+
+
+def test_decode_batch_matches_decode_block(monkeypatch):
+    block_plan = compile_block_plan(REGISTER_MAP, plan_block_reads(REGISTER_MAP, max_gap=125))
+    layout = block_plan[0]
+    words = reader(register_words())(layout.start, layout.length)
+    expected = decode_block(words, layout)
+    for threshold in (1, 1000):         # NumPy views, and decode_block() per row
+        monkeypatch.setattr(register_decoder, 'NUMPY_BATCH_THRESHOLD', threshold)
+        columns = decode_batch([words] * 3, layout)
+        for k in layout.keys:
+            assert list(columns[k]) == pytest.approx([expected[k]] * 3)
+
+
+def test_read_blocks_good():
+    block_plan = compile_block_plan(REGISTER_MAP, plan_block_reads(REGISTER_MAP, max_gap=30))
+    reads = []
+    readings, quality = read_blocks(reader(register_words(), reads), block_plan, REGISTER_MAP)
+    assert readings == pytest.approx(VALUES)
+    assert set(quality.values()) == {'good'}
+    assert len(reads) == len(block_plan)
+
+
+def test_read_blocks_retries_failed_block_field_by_field():
+    block_plan = compile_block_plan(REGISTER_MAP, plan_block_reads(REGISTER_MAP, max_gap=30))
+    reads = []
+    # the long frames are lost, the short ones get through
+    readings, quality = read_blocks(reader(register_words(), reads, fail=lambda start, length: length > 4),
+                                    block_plan, REGISTER_MAP)
+    assert readings == pytest.approx(VALUES)
+    assert set(quality.values()) == {'good'}
+    assert (3084, 2) in reads           # pf and pf_direction retried in one read
+
+
+def test_read_blocks_stale_then_missing(monkeypatch):
+    block_plan = compile_block_plan(REGISTER_MAP, plan_block_reads(REGISTER_MAP, max_gap=30))
+    words = register_words()
+    clock = [1000.0]
+    monkeypatch.setattr(register_decoder.time, 'monotonic', lambda: clock[0])
+    cache = {}
+    read_blocks(reader(words), block_plan, REGISTER_MAP, cache)
+    volts_fails = lambda start, length: start <= 3028 < start + length
+    readings, quality = read_blocks(reader(words, fail=volts_fails), block_plan, REGISTER_MAP, cache, stale=60)
+    assert quality['volts'] == 'stale' and readings['volts'] == 230.5
+    assert quality['amps'] == 'good'
+    assert quality_codes(quality, ['amps', 'volts']) == 'gs'
+    clock[0] = 1100.0
+    readings, quality = read_blocks(reader(words, fail=volts_fails), block_plan, REGISTER_MAP, cache, stale=60)
+    assert quality['volts'] == 'missing' and readings['volts'] is None
+    assert quality_codes(quality, ['amps', 'volts']) == 'gm'
+
+
+def test_read_blocks_raises_when_nothing_answers():
+    block_plan = compile_block_plan(REGISTER_MAP, plan_block_reads(REGISTER_MAP))
+    reads = []
+    with pytest.raises(ConnectionError):
+        read_blocks(reader({}, reads, fail=lambda start, length: True), block_plan, REGISTER_MAP, {})
+    # one pass of retries shows the meter is gone, so the others aren't tried
+    assert len(reads) < len(block_plan) + register_decoder.RETRY_PASSES * len(REGISTER_MAP)
+
+
+def test_read_blocks_retry_budget():
+    block_plan = compile_block_plan(REGISTER_MAP, plan_block_reads(REGISTER_MAP, max_gap=30))
+    reads = []
+    readings, quality = read_blocks(reader(register_words(), reads, fail=lambda start, length: start == 3000),
+                                    block_plan, REGISTER_MAP, budget=0)
+    # with no time for retries, the failed block's fields are missing
+    assert reads == [(layout.start, layout.length) for layout in block_plan]
+    assert quality['volts'] == 'missing' and quality['pf'] == 'good'
+
+
+def test_log_column_type():
+    assert register_decoder.log_column_type('volts', 'FLOAT32') == 'f4'
+    assert register_decoder.log_column_type('energy', 'FLOAT32') == 'f8'
+    assert register_decoder.log_column_type('count', 'INT16U.2') == 'f4'
+    assert register_decoder.log_column_type('energy', 'INT32U.2') == 'f8'
+    assert register_decoder.log_column_type('pf_direction', 'PF4Q_DIRECTION') == 'text7'
+    assert register_decoder.log_column_type('name', 'STRING8') == 'text16'
+    assert register_decoder.log_column_type('firmware', 'FIRMWARE') == 'text17'
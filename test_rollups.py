@@ -0,0 +1,86 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Tests for rollups.py: run with  python -m pytest -q
+
+import csv
+import pytest
+from rollups import Rollups, open_rollups
+
+
+HEADERS = '"Time","Power","Cumulative energy"'
+
+
+def rollups(levels, rollover=None):
+    """Rollups of HEADERS, and the rows written for each level as lists of fields"""
+    rows = { name: [] for name, period in levels }
+    outputs = { name: lambda text, name=name: rows[name].extend(csv.reader([text])) for name, period in levels }
+    return Rollups(HEADERS, 'Power', 'Cumulative energy', outputs, levels, rollover), rows
+
+
+def test_interval_row_written_when_next_interval_starts():
+    rollup, rows = rollups((('1m', 60),))
+    rollup.add(0, 100.0, 10.0)
+    rollup.add(30, 200.0, 11.0)
+    assert rows['1m'] == []
+    rollup.add(60, 300.0, 12.5)
+    assert rows['1m'] == [['1970/01/01 00:00:00', '1970/01/01 00:01:00', '2', '150.0', '100.0', '200.0', '1.0', '']]
+
+
+def test_energy_credited_to_interval_of_later_reading():
+    rollup, rows = rollups((('1m', 60),))
+    for stamp, energy in ((50, 10.0), (70, 12.0), (130, 15.0)):
+        rollup.add(stamp, 1.0, energy)
+    rollup.close()
+    # the first reading has no earlier one to take a delta from
+    assert [row[6] for row in rows['1m']] == ['', '2.0', '3.0']
+
+
+def test_close_writes_intervals_in_progress():
+    rollup, rows = rollups((('1m', 60), ('hourly', 3600)))
+    rollup.add(0, 100.0, None)
+    rollup.close()
+    assert len(rows['1m']) == 1 and len(rows['hourly']) == 1
+    rollup.close()
+    assert len(rows['1m']) == 1
+
+
+def test_rollover_and_reset():
+    rollup, rows = rollups((('1m', 60),), rollover=1000)
+    for stamp, energy in ((0, 998.0), (10, 2.0), (20, 1.0), (60, 1.0)):
+        rollup.add(stamp, 1.0, energy)
+    # 998 -> 2 wraps (4), 2 -> 1 is a reset counted from zero (1)
+    assert rows['1m'][0][6] == '5.0'
+
+
+def test_peak_demand_reaches_longer_levels():
+    rollup, rows = rollups((('15m', 900), ('hourly', 3600)))
+    for stamp, power in ((0, 100.0), (600, 300.0), (900, 500.0), (1800, 50.0), (3600, 10.0)):
+        rollup.add(stamp, power, None)
+    assert [row[7] for row in rows['15m']] == ['200.0', '500.0', '50.0']
+    assert rows['hourly'][0][7] == '500.0'
+    assert float(rows['hourly'][0][3]) == pytest.approx(950 / 4)
+
+
+def test_add_csv_skips_missing_values():
+    rollup, rows = rollups((('1m', 60),))
+    rollup.add_csv('"1970/01/01 00:00:10",100,5\n"1970/01/01 00:00:20",,6\n"not a time",1,1\n')
+    rollup.close()
+    assert rows['1m'][0][2:7] == ['2', '100.0', '100.0', '100.0', '1.0']
+
+
+def test_unknown_column():
+    with pytest.raises(ValueError):
+        Rollups(HEADERS, 'Watts', None, {})
+
+
+def test_open_rollups_writes_files(tmp_path):
+    rollup, writers = open_rollups(str(tmp_path), HEADERS, 'Power', 'Cumulative energy', levels=(('1m', 60),))
+    rollup.add(0, 100.0, 1.0)
+    rollup.close()
+    for writer in writers.values():
+        writer.close()
+    with open(tmp_path / 'rollup-1m.csv') as f:
+        lines = f.read().splitlines()
+    assert lines[0] == '"Start","End","Samples","Power mean","Power min","Power max","Energy delta","Peak demand"'
+    assert lines[1].startswith('"1970/01/01 00:00:00","1970/01/01 00:01:00",1,100.0')
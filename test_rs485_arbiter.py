@@ -0,0 +1,119 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Tests for rs485_arbiter.py, with a simulated meter: run with  python -m pytest -q
+
+import json
+import os
+import socket
+import stat
+import threading
+import pytest
+import rs485_arbiter
+from rs485_arbiter import ArbiterClient, ArbiterInstrument, ArbiterServer, BusArbiter
+
+
+class SimulatedInstrument:
+    """read_registers() of a meter whose registers hold their own number"""
+
+    def __init__(self):
+        self.reads = []
+
+    def read_registers(self, register, count, functioncode=3):
+        self.reads.append(register)
+        if register == 999:
+            raise IOError('No communication with the instrument (no answer)')
+        return list(range(register, register + count))
+
+
+@pytest.fixture
+def arbiter():
+    arbiter = BusArbiter('sim0')
+    arbiter.instruments[1] = SimulatedInstrument()
+    return arbiter
+
+
+def start(arbiter):
+    threading.Thread(target=arbiter.run, daemon=True).start()
+
+
+@pytest.fixture
+def server(arbiter, tmp_path):
+    path = str(tmp_path / 'arbiter.sock')
+    server = ArbiterServer(path, arbiter)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    start(arbiter)
+    yield path
+    server.shutdown()
+    server.server_close()
+
+
+def test_identical_reads_share_a_transaction(arbiter):
+    first = arbiter.submit((1, 3, 100, 2))
+    second = arbiter.submit((1, 3, 100, 2))
+    assert first is second and arbiter.merged == 1
+    start(arbiter)
+    assert first.done.wait(1) and first.registers == [100, 101]
+    assert arbiter.transactions == 1
+
+
+def test_cached_reads_skip_the_bus(arbiter):
+    start(arbiter)
+    assert arbiter.submit((1, 3, 100, 2)).done.wait(1)
+    request = arbiter.submit((1, 3, 100, 2))
+    assert request.done.is_set() and request.registers == [100, 101]
+    assert arbiter.cache_hits == 1
+    assert not arbiter.submit((1, 3, 100, 2), max_age=0).done.is_set()
+
+
+def test_lower_priority_numbers_first(arbiter):
+    slow = arbiter.submit((1, 3, 100, 1), priority=9)
+    urgent = arbiter.submit((1, 3, 200, 1), priority=1)
+    start(arbiter)
+    assert slow.done.wait(1) and urgent.done.wait(1)
+    assert arbiter.instruments[1].reads == [200, 100]
+
+
+def test_failed_read_reports_the_error(arbiter):
+    start(arbiter)
+    request = arbiter.submit((1, 3, 999, 1))
+    assert request.done.wait(1)
+    assert request.registers is None and 'no answer' in request.error
+
+
+def test_client_reads_through_the_socket(server):
+    client = ArbiterClient(server)
+    instrument = ArbiterInstrument(client, 1)
+    assert instrument.read_registers(100, 2) == [100, 101]
+    with pytest.raises(IOError):
+        instrument.read_registers(999, 1)
+    client.close()
+
+
+def test_bad_requests_leave_the_queue_usable(server, arbiter):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(2)
+    sock.connect(server)
+    f = sock.makefile('rwb')
+    def send(message):
+        f.write((json.dumps(message) + '\n').encode('utf-8'))
+        f.flush()
+        return json.loads(f.readline())
+    assert 'bad request' in send({ 'address': 1, 'register': 100, 'count': 1, 'priority': 'soon' })['error']
+    assert 'bad request' in send({ 'address': 1, 'register': 100, 'count': 1, 'max_age': [] })['error']
+    assert 'bad request' in send({ 'address': 1, 'count': 1 })['error']
+    assert arbiter.pending == {} and arbiter.requests.empty()
+    assert send({ 'address': 1, 'register': 100, 'count': 1, 'priority': '1' }) == { 'registers': [100] }
+    f.close()
+    sock.close()
+
+
+def test_socket_is_private(server):
+    assert stat.S_IMODE(os.stat(server).st_mode) == rs485_arbiter.SOCKET_MODE
+
+
+def test_read_string_is_latin1():
+    class Client:
+        def read_registers(self, address, register, count, functioncode=3):
+            return [0x4142, 0xe900]
+    assert ArbiterInstrument(Client(), 1).read_string(0, 2) == 'AB\xe9\x00'
@@ -0,0 +1,99 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Tests for scheduler.py, on a simulated clock: run with  python -m pytest -q
+
+import pytest
+import scheduler
+from scheduler import Schedule, Scheduler
+
+
+class SimulatedClock:
+    """time.monotonic(), time.time() and time.sleep() without waiting"""
+
+    def __init__(self, wall, monotonic=0.0):
+        self.now = monotonic
+        self.wall_offset = wall - monotonic
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now + self.wall_offset
+
+    def sleep(self, seconds):
+        assert seconds >= 0
+        self.now = self.now + seconds
+
+    def step(self, seconds):
+        """Step the wall clock, eg NTP at boot"""
+        self.wall_offset = self.wall_offset + seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimulatedClock(wall=1000.3, monotonic=0.3)
+    monkeypatch.setattr(scheduler, 'time', clock)
+    return clock
+
+
+def test_ticks_on_wall_clock_boundaries(clock):
+    schedule = Schedule(10)
+    assert [schedule.wait() for i in range(3)] == [1010, 1020, 1030]
+    assert schedule.stats()['ticks'] == 3
+
+
+def test_offset_and_fractional_period(clock):
+    assert Schedule(10, offset=2).wait() == 1002
+    schedule = Schedule(0.25)
+    assert [schedule.wait() for i in range(2)] == [1002.25, 1002.5]
+
+
+def test_overrun_skips_missed_ticks(clock):
+    schedule = Schedule(10)
+    assert schedule.wait() == 1010
+    clock.sleep(25)                     # the caller took 25 s over a 10 s slot
+    assert schedule.wait() == 1040
+    assert schedule.overruns == 1 and schedule.missed == 2
+
+
+def test_clock_step_realigns(clock):
+    schedule = Schedule(10)
+    assert schedule.wait() == 1010
+    clock.step(100.5)
+    assert schedule.wait() == 1120
+    assert schedule.clock_steps == 1
+    assert schedule.wait() == 1130
+
+
+def test_small_clock_jitter_is_ignored(clock):
+    schedule = Schedule(10)
+    schedule.wait()
+    clock.step(scheduler.CLOCK_STEP_TOLERANCE / 2)
+    schedule.wait()
+    assert schedule.clock_steps == 0
+
+
+def test_period_must_be_positive(clock):
+    with pytest.raises(ValueError):
+        Schedule(0)
+
+
+def test_scheduler_runs_several_periods(clock):
+    ticks = Scheduler()
+    ticks.add('fast', 10)
+    ticks.add('slow', 30)
+    due = []
+    for i in range(4):
+        due.append((ticks.wait(), ticks.tick_time))
+    assert due == [(['fast'], 1010), (['fast', 'slow'], 1020), (['fast'], 1030), (['fast'], 1040)]
+    assert ticks.stats()['slow']['ticks'] == 1
+
+
+def test_scheduler_overrun(clock):
+    ticks = Scheduler()
+    ticks.add('fast', 10)
+    ticks.wait()
+    clock.sleep(25)
+    assert ticks.wait() == ['fast']
+    assert ticks.stats()['fast']['missed'] == 2
@@ -0,0 +1,116 @@
+# Copyright 2024 Arup
+# MIT License
+
+# Tests for supervisor.py: run with  python -m pytest -q
+
+import pytest
+from supervisor import Supervisor
+
+
+class Part:
+    """A component instance, numbered in start order"""
+
+    def __init__(self, previous, number):
+        self.previous = previous
+        self.number = number
+        self.running = True
+        self.stopped = False
+
+    def read(self, fail=False):
+        if fail:
+            raise IOError('no answer')
+        return self.number
+
+
+class Starts:
+
+    def __init__(self):
+        self.parts = []
+        self.fail = False
+
+    def __call__(self, previous):
+        if self.fail:
+            raise IOError("can't start")
+        self.parts.append(Part(previous, len(self.parts)))
+        return self.parts[-1]
+
+
+def stop(part):
+    part.stopped = True
+
+
+def test_failed_call_restarts_the_component():
+    starts = Starts()
+    supervisor = Supervisor(backoff_start=0.0)
+    supervisor.add('driver', starts, stop=stop)
+    assert supervisor.call('driver', Part.read) == 0
+    with pytest.raises(IOError):
+        supervisor.call('driver', Part.read, True)
+    assert supervisor.get('driver') is None and starts.parts[0].stopped
+    with pytest.raises(ConnectionError):
+        supervisor.call('driver', Part.read)
+    supervisor.check()
+    assert supervisor.call('driver', Part.read) == 1
+    assert starts.parts[1].previous is starts.parts[0]
+    assert supervisor.stats()['driver'] == { 'up': True, 'failures': 1, 'restarts': 1, 'backoff': 0.0,
+                                             'last_error': 'no answer' }
+
+
+def test_backoff_doubles_and_resets():
+    starts = Starts()
+    supervisor = Supervisor(backoff_start=10.0, backoff_max=25.0)
+    supervisor.add('driver', starts)
+    component = supervisor.components['driver']
+    for backoff in (20.0, 25.0):
+        supervisor.failed('driver', 'no answer')
+        assert component.backoff == backoff
+        supervisor.check()
+        assert supervisor.get('driver') is None       # still waiting
+        component.restart_at = 0.0
+        supervisor.check()
+        assert supervisor.get('driver') is not None
+    supervisor.call('driver', Part.read)
+    assert component.backoff == 10.0
+
+
+def test_failed_restart_is_retried():
+    starts = Starts()
+    supervisor = Supervisor(backoff_start=0.0)
+    supervisor.add('writer', starts)
+    supervisor.failed('writer', 'stopped')
+    starts.fail = True
+    supervisor.check()
+    assert supervisor.get('writer') is None
+    starts.fail = False
+    supervisor.check()
+    assert supervisor.get('writer').previous is starts.parts[0]
+    assert supervisor.stats()['writer']['restarts'] == 1
+
+
+def test_dead_thread_is_restarted():
+    starts = Starts()
+    supervisor = Supervisor(backoff_start=0.0)
+    supervisor.add('leds', starts, stop=stop, alive=lambda part: part.running)
+    supervisor.check()
+    assert supervisor.get('leds') is starts.parts[0]
+    starts.parts[0].running = False
+    supervisor.check()
+    assert starts.parts[0].stopped and supervisor.get('leds') is None
+    supervisor.check()
+    assert supervisor.get('leds') is starts.parts[1]
+
+
+def test_stable_component_resets_its_backoff():
+    starts = Starts()
+    supervisor = Supervisor(backoff_start=0.0, stable_seconds=0.0)
+    supervisor.add('driver', starts)
+    supervisor.components['driver'].backoff = 8.0
+    supervisor.check()
+    assert supervisor.components['driver'].backoff == 0.0
+
+
+def test_first_start_error_is_raised():
+    starts = Starts()
+    starts.fail = True
+    with pytest.raises(IOError):
+        Supervisor().add('driver', starts)